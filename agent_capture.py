@@ -0,0 +1,249 @@
+# agent_capture.py
+"""
+Packet capture for the proxy agent: kernel-side BPF filtering and a
+header-only parser.
+
+The capture socket gets a BPF program (compiled with libpcap) attached in the
+kernel, so packets the agent does not want are never copied to user space.
+The filter is the operator's FPM_CAPTURE_FILTER, if any, plus an exclusion of
+the agent's own connection to the FPM server; without it every batch the agent
+sends would be captured, reported, sent again, and so on.
+
+Frames are read raw from the socket and parse_frame() pulls out only the
+fields an event needs (addresses, protocol, ports, IP length, TCP flags) with
+struct at fixed offsets, instead of building a full scapy packet with every
+layer dissected. Each packet reaches the handler as
+
+    handler(ts, src_ip, dst_ip, protocol, src_port, dst_port, length, tcp_flags)
+
+with ports None for protocols other than TCP/UDP (and for IP fragments).
+
+run() can hand the raw frames to another stage instead (dispatch, e.g.
+agent_pipeline.Pipeline.push), whose worker threads then call process().
+"""
+import socket
+import struct
+import sys
+import threading
+
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86DD
+VLAN_TYPES = (0x8100, 0x88A8)
+TCP = 6
+UDP = 17
+# IPv6 extension headers skipped to reach the transport header
+IPV6_EXTENSIONS = (0, 43, 60)
+
+_ports = struct.Struct("!HH")
+_ethertype = struct.Struct("!H")
+
+# scapy link-layer class name -> (offset of the ethertype, header length)
+LINK_LAYERS = {
+    "Ether": (12, 14),
+    "CookedLinux": (14, 16),
+    "CookedLinuxV2": (0, 20),
+}
+# getsockopt(SOL_PACKET, PACKET_STATISTICS): struct tpacket_stats {tp_packets, tp_drops}, reset on every read
+SOL_PACKET = 263
+PACKET_STATISTICS = 6
+_packet_stats = struct.Struct("II")
+
+# link layers carrying bare IP packets -> offset of the IP header ("Null" is the BSD loopback header)
+RAW_IP_OFFSETS = {"IP": 0, "IPv46": 0, "Null": 4}
+
+
+def server_endpoints(host, port):
+    """Resolves the FPM server to the set of (address, port) pairs the agent may connect to."""
+    try:
+        infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except socket.gaierror as e:
+        print(f"[!] Cannot resolve {host} to exclude it from capture: {e}", file=sys.stderr)
+        return set()
+    return {(info[4][0], port) for info in infos}
+
+
+def build_filter(user_filter="", exclude=()):
+    """
+    Combines the operator's BPF expression with the exclusion of (address, port) endpoints.
+
+    Returns:
+        str: The BPF expression, or "" when there is nothing to filter.
+    """
+    parts = [f"(host {address} and tcp port {port})" for address, port in sorted(exclude)]
+    own = f"not ({' or '.join(parts)})" if parts else ""
+    if user_filter and own:
+        return f"({user_filter}) and {own}"
+    return user_filter or own
+
+
+def parse_ip(data, offset=0):
+    """
+    Parses the IPv4/IPv6 packet starting at data[offset].
+
+    Returns:
+        tuple|None: (src_ip, dst_ip, protocol, src_port, dst_port, length, tcp_flags),
+                    or None if it is not a (complete enough) IP packet.
+    """
+    if len(data) < offset + 20:
+        return None
+    version = data[offset] >> 4
+    if version == 4:
+        header_length = (data[offset] & 0x0F) * 4
+        length = _ethertype.unpack_from(data, offset + 2)[0]
+        protocol = data[offset + 9]
+        src_ip = socket.inet_ntoa(data[offset + 12:offset + 16])
+        dst_ip = socket.inet_ntoa(data[offset + 16:offset + 20])
+        # non-first fragments carry no transport header
+        if _ethertype.unpack_from(data, offset + 6)[0] & 0x1FFF:
+            return src_ip, dst_ip, protocol, None, None, length, 0
+        transport = offset + header_length
+    elif version == 6:
+        if len(data) < offset + 40:
+            return None
+        length = 40 + _ethertype.unpack_from(data, offset + 4)[0]
+        protocol = data[offset + 6]
+        src_ip = socket.inet_ntop(socket.AF_INET6, data[offset + 8:offset + 24])
+        dst_ip = socket.inet_ntop(socket.AF_INET6, data[offset + 24:offset + 40])
+        transport = offset + 40
+        while protocol in IPV6_EXTENSIONS and len(data) >= transport + 8:
+            protocol = data[transport]
+            transport += (data[transport + 1] + 1) * 8
+    else:
+        return None
+    if protocol == TCP and len(data) >= transport + 14:
+        src_port, dst_port = _ports.unpack_from(data, transport)
+        return src_ip, dst_ip, protocol, src_port, dst_port, length, data[transport + 13]
+    if protocol == UDP and len(data) >= transport + 4:
+        src_port, dst_port = _ports.unpack_from(data, transport)
+        return src_ip, dst_ip, protocol, src_port, dst_port, length, 0
+    return src_ip, dst_ip, protocol, None, None, length, 0
+
+
+def parse_frame(frame, link="Ether"):
+    """Parses a captured link-layer frame (see LINK_LAYERS); returns what parse_ip() returns."""
+    if link in RAW_IP_OFFSETS:
+        return parse_ip(frame, RAW_IP_OFFSETS[link])
+    type_offset, offset = LINK_LAYERS.get(link, LINK_LAYERS["Ether"])
+    if len(frame) < offset:
+        return None
+    ethertype = _ethertype.unpack_from(frame, type_offset)[0]
+    while ethertype in VLAN_TYPES and link == "Ether" and len(frame) >= offset + 4:
+        ethertype = _ethertype.unpack_from(frame, offset + 2)[0]
+        offset += 4
+    if ethertype != ETH_P_IP and ethertype != ETH_P_IPV6:
+        return None
+    return parse_ip(frame, offset)
+
+
+class Capture:
+    """
+    Raw-socket capture with a kernel BPF filter and header-only parsing.
+
+    Args:
+        handler (callable): Called for every IP packet (see the module docstring).
+        iface (str|None): Interface to capture on; None uses scapy's default interface.
+        user_filter (str): Operator BPF expression ("" captures everything).
+        exclude (set): (address, port) TCP endpoints never reported (the FPM server).
+        buffer_bytes (int): Kernel socket receive buffer, absorbs bursts while Python catches up.
+    """
+
+    def __init__(self, handler, iface=None, user_filter="", exclude=(), buffer_bytes=4 * 1024 * 1024):
+        self.handler = handler
+        self.iface = iface
+        self.user_filter = user_filter
+        self.exclude = set(exclude)
+        self.buffer_bytes = buffer_bytes
+        self.bpf = build_filter(user_filter, self.exclude)
+        # True when the filter runs in the kernel; otherwise exclusion is done here
+        self.kernel_filter = False
+        self.stats = {"received": 0, "parsed": 0, "not_ip": 0, "excluded": 0,
+                      "kernel_packets": 0, "kernel_drops": 0}
+        # process() may run on several pipeline workers at once
+        self._stats_lock = threading.Lock()
+        self._socket = None
+        self._exclude = None
+
+    def open(self):
+        """Opens the capture socket, attaching the BPF filter in the kernel when libpcap can compile it."""
+        from scapy.all import conf
+        from scapy.error import Scapy_Exception
+
+        conf.bufsize = self.buffer_bytes
+        try:
+            self._socket = conf.L2listen(iface=self.iface, filter=self.bpf or None)
+            self.kernel_filter = bool(self.bpf)
+        except Scapy_Exception as e:
+            if self.user_filter:
+                raise
+            # Only the self-exclusion was asked for; it is cheap to do in user space instead.
+            print(f"[!] Kernel BPF filter unavailable ({e}); excluding the server connection in user space.",
+                  file=sys.stderr)
+            self._socket = conf.L2listen(iface=self.iface)
+        return self
+
+    def run(self, dispatch=None):
+        """
+        Reads packets until the socket is closed.
+
+        Args:
+            dispatch (callable|None): Called as dispatch(ts, link, frame) with every raw frame
+                                      (to queue it for process() on other threads); None
+                                      processes each frame inline.
+        """
+        if self._socket is None:
+            self.open()
+        sock = self._socket
+        stats = self.stats
+        self._exclude = None if self.kernel_filter or not self.exclude else self.exclude
+        dispatch = dispatch or self.process
+        link = sock.LL.__name__ if sock.LL is not None else "Ether"
+        while True:
+            try:
+                _, frame, ts = sock.recv_raw()
+            except OSError:
+                if self._socket is None:
+                    return
+                raise
+            if frame is None:
+                continue
+            stats["received"] += 1
+            dispatch(ts, link, frame)
+
+    def process(self, ts, link, frame):
+        """Parses one raw frame, applies the user-space exclusion and calls the handler."""
+        fields = parse_frame(frame, link)
+        if fields is None:
+            outcome = "not_ip"
+        elif self._exclude and ((fields[0], fields[3]) in self._exclude or (fields[1], fields[4]) in self._exclude):
+            outcome = "excluded"
+        else:
+            outcome = "parsed"
+        with self._stats_lock:
+            self.stats[outcome] += 1
+        if outcome == "parsed":
+            self.handler(ts, *fields)
+
+    def kernel_stats(self):
+        """
+        Adds the kernel's packet/drop counts since the last call to stats and returns stats.
+
+        These are the counters libpcap's pcap_stats() reports on Linux: packets the
+        socket's filter accepted and packets dropped because the receive buffer was
+        full. Left at 0 where the socket does not expose them.
+        """
+        sock = getattr(self._socket, "ins", None)
+        if sock is not None:
+            try:
+                packets, drops = _packet_stats.unpack(
+                    sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, _packet_stats.size))
+            except (OSError, struct.error):
+                pass
+            else:
+                self.stats["kernel_packets"] += packets
+                self.stats["kernel_drops"] += drops
+        return self.stats
+
+    def close(self):
+        sock, self._socket = self._socket, None
+        if sock is not None:
+            sock.close()
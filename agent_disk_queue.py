@@ -0,0 +1,242 @@
+# agent_disk_queue.py
+"""
+Disk-backed retry queue for the proxy agent.
+
+While the FPM server is unreachable the agent's batches are appended here
+instead of being retried in memory until the in-memory queue overflows. The
+queue is a directory of append-only NDJSON segment files
+
+    queue-00000001.ndjson  queue-00000002.ndjson  ...  checkpoint.json
+
+written at the tail and read from the head. checkpoint.json records the read
+position (segment and byte offset) and is replaced atomically only after a
+batch read from it has been acknowledged by the server, so after a crash or a
+restart draining resumes where it stopped. A batch that was delivered but not
+yet checkpointed is sent again; its event_ids make the server drop the copies.
+
+The total size is capped at max_bytes. When an append would exceed it, whole
+segments are deleted oldest first (the events least likely to still matter)
+and counted as evicted; new data is never refused.
+"""
+import json
+import os
+
+SEGMENT_PREFIX = "queue-"
+SEGMENT_SUFFIX = ".ndjson"
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+def segment_name(sequence):
+    return f"{SEGMENT_PREFIX}{sequence:08d}{SEGMENT_SUFFIX}"
+
+
+def list_segments(directory):
+    """Returns [(sequence, path)] for every queue segment in the directory, oldest first."""
+    segments = []
+    for filename in os.listdir(directory):
+        stem = filename[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]
+        if filename.startswith(SEGMENT_PREFIX) and filename.endswith(SEGMENT_SUFFIX) and stem.isdigit():
+            segments.append((int(stem), os.path.join(directory, filename)))
+    return sorted(segments)
+
+
+class DiskQueue:
+    """
+    Size-capped, append-only on-disk queue of NDJSON batches with a checkpointed read position.
+
+    Not thread-safe: the agent's sender thread is its only user.
+
+    Args:
+        directory (str): Where segments and the checkpoint are kept.
+        max_bytes (int): Cap on the total size of all segments; oldest segments are evicted beyond it.
+        segment_bytes (int): Start a new segment once the active one reaches this size.
+        fsync (bool): fsync every append and checkpoint (survives power loss, costs a disk flush).
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, segment_bytes=8 * 1024 * 1024, fsync=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = min(segment_bytes, max(1, max_bytes // 4))
+        self.fsync = fsync
+        self._segments = {}         # sequence -> [bytes, events] written to it
+        self._file = None
+        self._write_sequence = 0
+        self._read_sequence = 0
+        self._read_offset = 0
+        self._read_events = 0       # events of the read segment already delivered
+        self.stats = {"spilled_events": 0, "drained_events": 0, "evicted_events": 0, "evicted_segments": 0}
+
+    # ------------------------------------------------------------------ lifecycle
+
+    def open(self):
+        """Loads existing segments and the checkpoint, then starts a fresh segment for appends."""
+        os.makedirs(self.directory, exist_ok=True)
+        for sequence, path in list_segments(self.directory):
+            with open(path, "rb") as f:
+                data = f.read()
+            self._segments[sequence] = [len(data), data.count(b"\n")]
+        checkpoint = self._load_checkpoint()
+        if checkpoint and checkpoint.get("segment") in self._segments:
+            self._read_sequence = checkpoint["segment"]
+            self._read_offset = checkpoint.get("offset", 0)
+            self._read_events = checkpoint.get("events", 0)
+        else:
+            self._read_sequence = min(self._segments, default=1)
+            self._read_offset = self._read_events = 0
+        for sequence in [s for s in self._segments if s < self._read_sequence]:
+            self._remove_segment(sequence)
+        self._write_sequence = max(self._segments, default=0)
+        self._open_next_segment()
+        return self
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    # ------------------------------------------------------------------ backlog
+
+    def backlog_events(self):
+        """Events appended but not yet delivered."""
+        # list(): snapshot() may run on the heartbeat thread while the sender adds segments
+        return sum(events for _, events in list(self._segments.values())) - self._read_events
+
+    def backlog_bytes(self):
+        """Bytes appended but not yet delivered."""
+        return sum(size for size, _ in list(self._segments.values())) - self._read_offset
+
+    def __len__(self):
+        return self.backlog_events()
+
+    def snapshot(self):
+        """Backlog gauges plus the running counters, for status lines and telemetry."""
+        return dict(self.stats, backlog_events=self.backlog_events(), backlog_bytes=self.backlog_bytes(),
+                    segments=len(self._segments))
+
+    # ------------------------------------------------------------------ write side
+
+    def append(self, body, count):
+        """
+        Appends an NDJSON batch (complete lines) holding count events.
+
+        Evicts the oldest segments first if the queue would exceed max_bytes.
+        """
+        if self._segments[self._write_sequence][0] >= self.segment_bytes:
+            self._open_next_segment()
+        self._file.write(body)
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        segment = self._segments[self._write_sequence]
+        segment[0] += len(body)
+        segment[1] += count
+        self.stats["spilled_events"] += count
+        while self.backlog_bytes() > self.max_bytes and len(self._segments) > 1:
+            self._evict_oldest()
+
+    # ------------------------------------------------------------------ read side
+
+    def read_batch(self, max_events=5000, max_bytes=512 * 1024):
+        """
+        Reads the next batch of whole lines from the head of the queue.
+
+        Returns:
+            tuple|None: (body, count, position) where position is handed to commit()
+                        once the batch is delivered; None when the queue is empty.
+        """
+        while True:
+            size = self._segments[self._read_sequence][0]
+            if self._read_offset < size:
+                path = os.path.join(self.directory, segment_name(self._read_sequence))
+                with open(path, "rb") as f:
+                    f.seek(self._read_offset)
+                    data = f.read(min(max_bytes, size - self._read_offset))
+                end = data.rfind(b"\n") + 1
+                if end == 0 and len(data) == max_bytes:
+                    # a single line longer than max_bytes: send it alone
+                    with open(path, "rb") as f:
+                        f.seek(self._read_offset)
+                        data = f.readline()
+                    end = len(data) if data.endswith(b"\n") else 0
+                if end:
+                    data = data[:end]
+                    count = data.count(b"\n")
+                    if count > max_events:
+                        cut = 0
+                        for _ in range(max_events):
+                            cut = data.index(b"\n", cut) + 1
+                        data, count = data[:cut], max_events
+                    position = (self._read_sequence, self._read_offset + len(data), self._read_events + count)
+                    return data, count, position
+                if self._read_sequence == self._write_sequence:
+                    return None
+                # only a torn line (crash mid-write) is left in a closed segment: skip it
+            elif self._read_sequence == self._write_sequence:
+                return None
+            self._advance_read_segment()
+
+    def commit(self, position):
+        """Marks everything up to position (from read_batch) as delivered and checkpoints it."""
+        sequence, offset, events = position
+        if sequence != self._read_sequence:
+            return      # the segment was evicted while the batch was in flight
+        self.stats["drained_events"] += events - self._read_events
+        self._read_offset, self._read_events = offset, events
+        if offset >= self._segments[sequence][0] and sequence != self._write_sequence:
+            self._advance_read_segment()
+        else:
+            self._save_checkpoint()
+
+    # ------------------------------------------------------------------ internals
+
+    def _open_next_segment(self):
+        if self._file is not None:
+            self._file.close()
+        self._write_sequence += 1
+        self._segments[self._write_sequence] = [0, 0]
+        self._file = open(os.path.join(self.directory, segment_name(self._write_sequence)), "ab", buffering=0)
+        if not self._read_sequence:
+            self._read_sequence = self._write_sequence
+
+    def _advance_read_segment(self):
+        self._remove_segment(self._read_sequence)
+        self._read_sequence = min(self._segments)
+        self._read_offset = self._read_events = 0
+        self._save_checkpoint()
+
+    def _evict_oldest(self):
+        oldest = min(self._segments)
+        size, events = self._segments[oldest]
+        if oldest == self._read_sequence:
+            events -= self._read_events
+            self._remove_segment(oldest)
+            self._read_sequence = min(self._segments)
+            self._read_offset = self._read_events = 0
+            self._save_checkpoint()
+        else:
+            self._remove_segment(oldest)
+        self.stats["evicted_events"] += events
+        self.stats["evicted_segments"] += 1
+
+    def _remove_segment(self, sequence):
+        self._segments.pop(sequence, None)
+        try:
+            os.remove(os.path.join(self.directory, segment_name(sequence)))
+        except FileNotFoundError:
+            pass
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_checkpoint(self):
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"segment": self._read_sequence, "offset": self._read_offset,
+                       "events": self._read_events}, f)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,204 @@
+# agent_flows.py
+"""
+Flow aggregation for the proxy agent.
+
+Instead of one event per packet, packets are folded into a flow table keyed on
+the 5-tuple (src_ip, dst_ip, protocol, src_port, dst_port). Both directions
+of a conversation share one entry: the side seen first is the flow's source,
+and packets from the other side are counted as reply_packets / reply_bytes.
+A flow record is emitted when
+
+    - no packet was seen for idle_timeout seconds            (end_reason "idle")
+    - it has been open for active_timeout seconds            ("active"; counting restarts)
+    - a TCP RST is seen, or both sides have sent a FIN       ("rst" / "fin")
+    - the table is full and it is the least recently used    ("evicted")
+    - the agent stops                                        ("shutdown")
+
+The table is an OrderedDict kept in last-activity order, so LRU eviction and
+idle expiry only ever look at its head. Times are packet timestamps (seconds
+since the epoch), which keeps the records correct when packets are replayed.
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+TCP = 6
+UDP = 17
+
+FIN = 0x01
+SYN = 0x02
+RST = 0x04
+PSH = 0x08
+ACK = 0x10
+URG = 0x20
+_FLAG_LETTERS = ((SYN, "S"), (ACK, "A"), (PSH, "P"), (FIN, "F"), (RST, "R"), (URG, "U"))
+
+LAYERS = {TCP: "TCP", UDP: "UDP"}
+
+
+def flag_string(flags):
+    """TCP flag bits as letters in tcpdump order, e.g. 0x1b -> "SAPF"."""
+    return "".join(letter for bit, letter in _FLAG_LETTERS if flags & bit)
+
+
+def _isoformat(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+class _Flow:
+    __slots__ = ("key", "first_seen", "last_seen", "packets", "bytes", "reply_packets", "reply_bytes",
+                 "flags", "fin_forward", "fin_reply")
+
+    def __init__(self, key, ts):
+        self.key = key
+        self.first_seen = ts
+        self.last_seen = ts
+        self.packets = 0
+        self.bytes = 0
+        self.reply_packets = 0
+        self.reply_bytes = 0
+        self.flags = 0
+        self.fin_forward = False
+        self.fin_reply = False
+
+
+class FlowTable:
+    """
+    Aggregates packets into flows and hands finished flow records to emit().
+
+    Args:
+        emit (callable): Called with each flow record (a dict shaped like an agent event).
+        host (str): Value for the records' "host" field.
+        idle_timeout (float): Seconds without packets after which a flow is emitted.
+        active_timeout (float): Maximum seconds a flow is held before an interim record is emitted.
+        max_flows (int): Table size; the least recently active flow is evicted beyond it.
+        fin_linger (float): Seconds packets of a flow closed by FIN/RST are still
+                            swallowed (the final ACK) instead of starting a new flow.
+    """
+
+    def __init__(self, emit, host="", idle_timeout=15.0, active_timeout=120.0, max_flows=65536,
+                 fin_linger=2.0):
+        self.emit = emit
+        self.host = host
+        self.idle_timeout = idle_timeout
+        self.active_timeout = active_timeout
+        self.max_flows = max_flows
+        self.fin_linger = fin_linger
+        self._flows = OrderedDict()
+        self._closed = OrderedDict()     # key -> time it was closed, for fin_linger
+        self._lock = threading.Lock()
+        self.stats = {"packets": 0, "flows_emitted": 0, "evicted": 0}
+
+    def __len__(self):
+        return len(self._flows)
+
+    def add(self, ts, src_ip, dst_ip, protocol, src_port=None, dst_port=None, length=0, tcp_flags=0):
+        """Accounts one packet of length bytes seen at ts (epoch seconds)."""
+        key = (src_ip, dst_ip, protocol, src_port, dst_port)
+        with self._lock:
+            self.stats["packets"] += 1
+            flow = self._flows.get(key)
+            reply = False
+            if flow is None:
+                reverse = (dst_ip, src_ip, protocol, dst_port, src_port)
+                flow = self._flows.get(reverse)
+                if flow is not None:
+                    key, reply = reverse, True
+                elif self._closed:
+                    if self._lingering(key, ts) or self._lingering(reverse, ts):
+                        return
+            if flow is None:
+                flow = self._flows[key] = _Flow(key, ts)
+                if len(self._flows) > self.max_flows:
+                    _, oldest = self._flows.popitem(last=False)
+                    self.stats["evicted"] += 1
+                    self._emit(oldest, "evicted")
+            else:
+                self._flows.move_to_end(key)
+
+            if reply:
+                flow.reply_packets += 1
+                flow.reply_bytes += length
+            else:
+                flow.packets += 1
+                flow.bytes += length
+            if ts > flow.last_seen:
+                flow.last_seen = ts
+            if tcp_flags:
+                flow.flags |= tcp_flags
+                if tcp_flags & RST:
+                    self._close(flow, "rst", ts)
+                    return
+                if tcp_flags & FIN:
+                    if reply:
+                        flow.fin_reply = True
+                    else:
+                        flow.fin_forward = True
+                    if flow.fin_forward and flow.fin_reply:
+                        self._close(flow, "fin", ts)
+                        return
+            if ts - flow.first_seen >= self.active_timeout:
+                del self._flows[key]
+                self._emit(flow, "active")
+                # the connection goes on: the next packet opens a fresh record under the same key
+
+    def expire(self, now):
+        """Emits every flow idle for idle_timeout seconds as of now (epoch seconds)."""
+        with self._lock:
+            deadline = now - self.idle_timeout
+            while self._flows:
+                flow = next(iter(self._flows.values()))
+                if flow.last_seen > deadline:
+                    break
+                self._flows.popitem(last=False)
+                self._emit(flow, "idle")
+            linger_deadline = now - self.fin_linger
+            while self._closed and next(iter(self._closed.values())) <= linger_deadline:
+                self._closed.popitem(last=False)
+
+    def flush(self, reason="shutdown"):
+        """Emits every open flow (e.g. when the agent stops)."""
+        with self._lock:
+            while self._flows:
+                _, flow = self._flows.popitem(last=False)
+                self._emit(flow, reason)
+            self._closed.clear()
+
+    def _lingering(self, key, ts):
+        closed_at = self._closed.get(key)
+        return closed_at is not None and ts - closed_at < self.fin_linger
+
+    def _close(self, flow, reason, ts):
+        del self._flows[flow.key]
+        self._closed[flow.key] = ts
+        self._closed.move_to_end(flow.key)
+        if len(self._closed) > self.max_flows:
+            self._closed.popitem(last=False)
+        self._emit(flow, reason)
+
+    def _emit(self, flow, reason):
+        src_ip, dst_ip, protocol, src_port, dst_port = flow.key
+        record = {
+            "timestamp": _isoformat(flow.first_seen),
+            "host": self.host,
+            "type": "flow",
+            "src_ip": src_ip,
+            "dst_ip": dst_ip,
+            "protocol": protocol,
+            "layer": LAYERS.get(protocol, "Other"),
+            "first_seen": _isoformat(flow.first_seen),
+            "last_seen": _isoformat(flow.last_seen),
+            "duration": round(flow.last_seen - flow.first_seen, 6),
+            "packets": flow.packets,
+            "bytes": flow.bytes,
+            "reply_packets": flow.reply_packets,
+            "reply_bytes": flow.reply_bytes,
+            "end_reason": reason,
+        }
+        if src_port is not None:
+            record["src_port"] = src_port
+            record["dst_port"] = dst_port
+        if protocol == TCP:
+            record["tcp_flags"] = flag_string(flow.flags)
+        self.stats["flows_emitted"] += 1
+        self.emit(record)
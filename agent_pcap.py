@@ -0,0 +1,196 @@
+# agent_pcap.py
+"""
+Streaming pcap / pcapng reader for replaying captures through the agent.
+
+read_packets() yields one (timestamp, link, frame) tuple at a time while it
+reads the file block by block, so captures far larger than memory can be
+replayed. link names the frame's link layer the way agent_capture's
+parse_frame() expects it ("Ether", "CookedLinux", "IP", ...).
+
+Supported: classic pcap (either byte order, microsecond or nanosecond
+timestamps) and pcapng (section header, interface description with
+if_tsresol, enhanced and simple packet blocks; other blocks are skipped).
+Both may be gzip-compressed (".gz").
+
+replay() paces the packets: speed 0 replays as fast as possible, 1 with the
+original inter-packet gaps, 2 twice as fast, and so on.
+"""
+import gzip
+import struct
+import time
+
+PCAP_MAGIC_USEC = 0xA1B2C3D4
+PCAP_MAGIC_NSEC = 0xA1B23C4D
+PCAPNG_SECTION_HEADER = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+PCAPNG_SIMPLE_PACKET = 0x00000003
+PCAPNG_ENHANCED_PACKET = 0x00000006
+PCAPNG_OPTION_TSRESOL = 9
+
+# pcap LINKTYPE_* -> agent_capture link-layer name ("Null" = 4-byte BSD loopback header)
+LINK_TYPES = {
+    0: "Null",
+    1: "Ether",
+    12: "IP",
+    101: "IP",
+    113: "CookedLinux",
+    228: "IP",
+    229: "IP",
+    276: "CookedLinuxV2",
+}
+
+
+class PcapError(ValueError):
+    """Raised for a file that is not a readable pcap/pcapng capture."""
+
+
+def _open(path):
+    with open(path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    return gzip.open(path, "rb") if compressed else open(path, "rb")
+
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+
+def read_packets(path):
+    """Yields (timestamp, link, frame) for every packet of a pcap or pcapng file, in file order."""
+    with _open(path) as f:
+        head = _read_exact(f, 4)
+        if head is None:
+            return
+        magic_le = struct.unpack("<I", head)[0]
+        if magic_le == PCAPNG_SECTION_HEADER:
+            yield from _read_pcapng(f, head)
+        else:
+            yield from _read_pcap(f, head)
+
+
+def _read_pcap(f, head):
+    for endian in ("<", ">"):
+        magic = struct.unpack(endian + "I", head)[0]
+        if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+            break
+    else:
+        raise PcapError("not a pcap or pcapng file")
+    divisor = 1e9 if magic == PCAP_MAGIC_NSEC else 1e6
+    header = _read_exact(f, 20)
+    if header is None:
+        raise PcapError("truncated pcap file header")
+    linktype = struct.unpack(endian + "HHiIII", header)[5] & 0x0FFFFFFF
+    link = LINK_TYPES.get(linktype)
+    record = struct.Struct(endian + "IIII")
+    while True:
+        record_header = _read_exact(f, 16)
+        if record_header is None:
+            return
+        seconds, fraction, captured, _ = record.unpack(record_header)
+        frame = _read_exact(f, captured)
+        if frame is None:
+            return      # truncated last packet (capture still being written)
+        if link is not None:
+            yield seconds + fraction / divisor, link, frame
+
+
+def _read_pcapng(f, head):
+    endian = "<"
+    interfaces = []     # (link, ticks per second) by interface id
+    while True:
+        if head is not None:
+            # the first block's type was already read to detect the format
+            rest = _read_exact(f, 4)
+            block_head = head + rest if rest is not None else None
+            head = None
+        else:
+            block_head = _read_exact(f, 8)
+        if block_head is None:
+            return
+        block_type = struct.unpack(endian + "I", block_head[:4])[0]
+        if block_type == PCAPNG_SECTION_HEADER:
+            byte_order = _read_exact(f, 4)
+            if byte_order is None:
+                return
+            endian = "<" if struct.unpack("<I", byte_order)[0] == PCAPNG_BYTE_ORDER_MAGIC else ">"
+            length = struct.unpack(endian + "I", block_head[4:])[0]
+            if _read_exact(f, length - 12) is None:
+                return
+            interfaces = []
+            continue
+        length = struct.unpack(endian + "I", block_head[4:])[0]
+        if length < 12:
+            raise PcapError(f"invalid pcapng block length {length}")
+        body = _read_exact(f, length - 8)
+        if body is None:
+            return
+        if block_type == PCAPNG_INTERFACE_DESCRIPTION:
+            linktype = struct.unpack(endian + "H", body[:2])[0]
+            interfaces.append((LINK_TYPES.get(linktype), _tsresol(body[8:-4], endian)))
+        elif block_type == PCAPNG_ENHANCED_PACKET:
+            interface, high, low, captured = struct.unpack(endian + "IIII", body[:16])
+            if interface >= len(interfaces) or interfaces[interface][0] is None:
+                continue
+            link, ticks = interfaces[interface]
+            yield ((high << 32) | low) / ticks, link, body[20:20 + captured]
+        elif block_type == PCAPNG_SIMPLE_PACKET:
+            # no timestamp: the replay treats it as arriving with the previous packet
+            if interfaces and interfaces[0][0] is not None:
+                wire_length = struct.unpack(endian + "I", body[:4])[0]
+                yield None, interfaces[0][0], body[4:4 + min(wire_length, len(body) - 8)]
+
+
+def _tsresol(options, endian):
+    """Timestamp ticks per second from an interface description's options (default microseconds)."""
+    offset = 0
+    while offset + 4 <= len(options):
+        code, length = struct.unpack(endian + "HH", options[offset:offset + 4])
+        if code == 0:
+            break
+        if code == PCAPNG_OPTION_TSRESOL and length >= 1:
+            value = options[offset + 4]
+            return 2 ** (value & 0x7F) if value & 0x80 else 10 ** value
+        offset += 4 + (length + 3) // 4 * 4
+    return 10 ** 6
+
+
+def replay(paths, handler, speed=0.0, on_tick=None):
+    """
+    Feeds the packets of one or more capture files to handler(ts, link, frame).
+
+    Args:
+        paths (list): Capture files, replayed one after the other (each paced from its own start).
+        speed (float): 0 = as fast as possible, 1 = original timing, N = N times faster.
+        on_tick (callable|None): Called with the capture time about once per captured second
+                                 (the agent expires idle flows from it).
+
+    Returns:
+        int: Number of packets replayed.
+    """
+    count = 0
+    last_ts = None
+    next_tick = None
+    for path in paths:
+        first_ts = None
+        started = time.monotonic()
+        for ts, link, frame in read_packets(path):
+            if ts is None:
+                ts = last_ts if last_ts is not None else time.time()
+            if first_ts is None:
+                first_ts = ts
+            if next_tick is None:
+                next_tick = ts
+            if speed > 0:
+                delay = (ts - first_ts) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            handler(ts, link, frame)
+            count += 1
+            last_ts = ts
+            if on_tick is not None and ts >= next_tick:
+                on_tick(ts)
+                next_tick = ts + 1.0
+    return count
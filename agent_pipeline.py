@@ -0,0 +1,195 @@
+# agent_pipeline.py
+"""
+Staged packet pipeline for the proxy agent: capture -> ring buffer -> workers -> sender.
+
+The capture thread's only job is to drain the kernel socket; if it also had
+to parse, build and encode events it would fall behind during bursts and the
+kernel would drop packets. With a Pipeline it only calls push(), which puts
+the raw item (e.g. (ts, link, frame)) into a bounded ring buffer and returns.
+A pool of worker threads pops items and runs process(*item) on them (parsing,
+flow/sampling, event building, JSON encoding in BatchSender.submit), and the
+sender thread batches and delivers what the workers submit.
+
+Every stage counts for itself: the ring its depth, high-water mark and the
+items dropped because it was full, each worker what it processed and what
+raised, and the sender (agent_sender.py) its own queue. Nothing blocks the
+capture thread: a full ring drops the newest item, like the kernel does, unless
+the pipeline is blocking (pcap replay, where the producer can simply wait).
+
+push() is meant to be called from a single producer thread.
+"""
+import sys
+import threading
+import time
+from collections import deque
+
+
+class RingBuffer:
+    """
+    Bounded single-producer / multi-consumer FIFO of items.
+
+    Args:
+        capacity (int): Items held at most; push() drops (or waits) beyond it.
+        block (bool): Wait for room instead of dropping.
+    """
+
+    def __init__(self, capacity=65536, block=False):
+        self.capacity = capacity
+        self.block = block
+        self._items = deque()
+        # set whenever items may be waiting; consumers clear it only when they find the ring empty
+        self._ready = threading.Event()
+        # blocking mode only: the producer waits on it while the ring is full, pop() notifies
+        self._not_full = threading.Condition()
+        self.stats = {"pushed": 0, "dropped": 0, "high_water": 0}
+
+    def __len__(self):
+        return len(self._items)
+
+    def push(self, item):
+        """Appends an item; returns False if the ring was full and the item was dropped."""
+        items = self._items
+        if len(items) >= self.capacity:
+            if not self.block:
+                self.stats["dropped"] += 1
+                return False
+            with self._not_full:
+                while len(items) >= self.capacity:
+                    self._not_full.wait()
+        items.append(item)
+        self.stats["pushed"] += 1
+        depth = len(items)
+        if depth > self.stats["high_water"]:
+            self.stats["high_water"] = depth
+        if not self._ready.is_set():
+            self._ready.set()
+        return True
+
+    def pop(self, timeout=0.1):
+        """Removes and returns the oldest item, or None if none arrived within timeout."""
+        try:
+            return self._taken(self._items.popleft())
+        except IndexError:
+            pass
+        self._ready.clear()
+        if self._items:     # pushed between the failed pop and the clear
+            self._ready.set()
+        self._ready.wait(timeout)
+        try:
+            return self._taken(self._items.popleft())
+        except IndexError:
+            return None
+
+    def _taken(self, item):
+        if self.block:
+            # the producer checks for room under the same lock, so this cannot miss its wait()
+            with self._not_full:
+                self._not_full.notify()
+        return item
+
+    def snapshot(self):
+        return dict(self.stats, depth=len(self._items), capacity=self.capacity)
+
+
+class Pipeline:
+    """
+    A ring buffer feeding a pool of worker threads.
+
+    Args:
+        process (callable): Run by a worker as process(*item) for every pushed item.
+        workers (int): Worker threads; 0 runs process() inline in push() (no staging).
+        ring_size (int): Capacity of the ring buffer.
+        block (bool): push() waits for room instead of dropping (pcap replay).
+        name (str): Thread name prefix.
+    """
+
+    def __init__(self, process, workers=2, ring_size=65536, block=False, name="fpm-worker"):
+        self.process = process
+        self.workers = workers
+        self.name = name
+        self.ring = RingBuffer(ring_size, block)
+        self._closed = threading.Event()
+        self._threads = []
+        # one counter dict per worker, summed by snapshot(): no shared counter to race on
+        self._worker_stats = [{"processed": 0, "errors": 0} for _ in range(max(1, workers))]
+        # drain() waits on it; workers only notify while someone is draining
+        self._idle = threading.Condition()
+        self._draining = False
+
+    def start(self):
+        """Starts the worker threads (idempotent)."""
+        if not self._threads:
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._work, args=(self._worker_stats[index],),
+                                          name=f"{self.name}-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def push(self, *item):
+        """Hands an item to the workers (dropped and counted if the ring is full)."""
+        if not self.workers:
+            self._run_one(item, self._worker_stats[0])
+        elif not self.ring.push(item):
+            dropped = self.ring.stats["dropped"]
+            if dropped & (dropped - 1) == 0:   # 1, 2, 4, 8, ...
+                print(f"[!] Capture ring buffer full, {dropped} packet(s) dropped so far.", file=sys.stderr)
+
+    def drain(self):
+        """
+        Waits until every item pushed so far has been processed (not just popped).
+
+        For a blocking producer (pcap replay) that must see the effect of its
+        earlier items before acting on their timestamps, e.g. expiring flows.
+        """
+        if not self.workers:
+            return
+        with self._idle:
+            self._draining = True
+            try:
+                while self._processed() < self.ring.stats["pushed"]:
+                    self._idle.wait(0.1)
+            finally:
+                self._draining = False
+
+    def _processed(self):
+        return sum(stats["processed"] for stats in self._worker_stats)
+
+    def close(self, timeout=None):
+        """Lets the workers finish what is in the ring (for up to timeout seconds), then stops them."""
+        self._closed.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+    def snapshot(self):
+        """Per-stage counters: the ring buffer and the worker pool."""
+        workers = {"threads": self.workers, "processed": 0, "errors": 0}
+        for stats in self._worker_stats:
+            workers["processed"] += stats["processed"]
+            workers["errors"] += stats["errors"]
+        return {"ring": self.ring.snapshot(), "workers": workers}
+
+    def _work(self, stats):
+        ring = self.ring
+        while True:
+            item = ring.pop()
+            if item is None:
+                if self._closed.is_set() and not len(ring):
+                    return
+                continue
+            self._run_one(item, stats)
+
+    def _run_one(self, item, stats):
+        try:
+            self.process(*item)
+        except Exception as e:
+            stats["errors"] += 1
+            errors = stats["errors"]
+            if errors & (errors - 1) == 0:
+                print(f"[!] Packet processing failed ({errors} so far in {threading.current_thread().name}): "
+                      f"{type(e).__name__}: {e}", file=sys.stderr)
+        stats["processed"] += 1
+        if self._draining:
+            with self._idle:
+                self._idle.notify_all()
@@ -0,0 +1,141 @@
+# agent_sampling.py
+"""
+Adaptive per-flow / per-destination packet sampling for the proxy agent.
+
+Bulk transfers and streams produce most packets but little forensic value per
+extra packet, so in packet mode each packet goes through Sampler.sample()
+before it becomes an event:
+
+    - the first first_packets packets of every flow, and every packet with
+      SYN, FIN or RST, are always kept;
+    - any other packet is kept only if both its flow's token bucket and its
+      destination's token bucket hold a token (flow_rate / destination_rate
+      tokens per second, bursts of twice that);
+    - once a second the bucket rates are scaled down (or back up, never past
+      1x) so that the kept packets track target_rate events per second.
+
+A kept packet is stamped with how many packets it stands for: itself plus
+the packets of the same flow dropped since the flow's previous kept packet.
+Summing "sample_rate" over events therefore re-weights counts back to the
+original packet volume (except for the packets a flow sends after its last
+kept one, which no event carries). Flows are keyed on the unordered pair of
+endpoints, so both directions of a connection share one bucket. Times are
+packet timestamps (seconds since the epoch). sample() is thread-safe, so
+several pipeline workers can share one Sampler.
+"""
+import threading
+from collections import OrderedDict
+
+FIN = 0x01
+SYN = 0x02
+RST = 0x04
+ALWAYS_KEEP_FLAGS = SYN | FIN | RST
+
+# the scale never drops below this, so every flow still gets some packets through
+MIN_SCALE = 0.001
+
+
+class Sampler:
+    """
+    Decides which packets become events and with what weight.
+
+    Args:
+        target_rate (float): Events per second the sampler steers toward.
+        first_packets (int): Packets always kept at the start of each flow.
+        flow_rate (float): Token refill rate per flow (packets/s kept beyond the first ones).
+        destination_rate (float): Token refill rate per destination address.
+        max_flows (int): Flows tracked; the least recently seen is forgotten beyond it.
+        max_destinations (int): Destinations tracked, likewise.
+    """
+
+    def __init__(self, target_rate=1000.0, first_packets=10, flow_rate=5.0, destination_rate=50.0,
+                 max_flows=65536, max_destinations=16384):
+        self.target_rate = target_rate
+        self.first_packets = first_packets
+        self.flow_rate = flow_rate
+        self.destination_rate = destination_rate
+        self.max_flows = max_flows
+        self.max_destinations = max_destinations
+        self.scale = 1.0
+        # flow key -> [tokens, last_ts, packets_seen, dropped_since_kept]
+        self._flows = OrderedDict()
+        # destination -> [tokens, last_ts]
+        self._destinations = OrderedDict()
+        self._window_start = None
+        self._window_kept = 0
+        self._lock = threading.Lock()
+        self.stats = {"seen": 0, "kept": 0, "dropped": 0, "forced": 0}
+
+    def sample(self, ts, src_ip, dst_ip, protocol, src_port=None, dst_port=None, tcp_flags=0):
+        """
+        Returns the sample rate to stamp on the packet's event, or 0 to drop the packet.
+        """
+        with self._lock:
+            return self._sample(ts, src_ip, dst_ip, protocol, src_port, dst_port, tcp_flags)
+
+    def _sample(self, ts, src_ip, dst_ip, protocol, src_port, dst_port, tcp_flags):
+        self.stats["seen"] += 1
+        self._adapt(ts)
+        a, b = (src_ip, src_port), (dst_ip, dst_port)
+        key = (protocol, a, b) if a <= b else (protocol, b, a)
+
+        flow = self._flows.get(key)
+        if flow is None:
+            flow = self._flows[key] = [2 * self.flow_rate, ts, 0, 0]
+            if len(self._flows) > self.max_flows:
+                self._flows.popitem(last=False)
+        else:
+            self._flows.move_to_end(key)
+        flow[2] += 1
+        destination = self._destinations.get(dst_ip)
+        if destination is None:
+            destination = self._destinations[dst_ip] = [2 * self.destination_rate, ts]
+            if len(self._destinations) > self.max_destinations:
+                self._destinations.popitem(last=False)
+        else:
+            self._destinations.move_to_end(dst_ip)
+
+        flow_tokens = self._refill(flow, ts, self.flow_rate)
+        destination_tokens = self._refill(destination, ts, self.destination_rate)
+        if flow[2] <= self.first_packets or tcp_flags & ALWAYS_KEEP_FLAGS:
+            self.stats["forced"] += 1
+            # forced packets still use up tokens (going negative is not allowed to pile up debt)
+            flow[0] = max(0.0, flow_tokens - 1)
+            destination[0] = max(0.0, destination_tokens - 1)
+        elif flow_tokens >= 1 and destination_tokens >= 1:
+            flow[0] = flow_tokens - 1
+            destination[0] = destination_tokens - 1
+        else:
+            flow[0] = flow_tokens
+            destination[0] = destination_tokens
+            flow[3] += 1
+            self.stats["dropped"] += 1
+            return 0
+        rate = flow[3] + 1
+        flow[3] = 0
+        self.stats["kept"] += 1
+        self._window_kept += 1
+        return rate
+
+    def _refill(self, bucket, ts, rate):
+        rate *= self.scale
+        elapsed = ts - bucket[1]
+        bucket[1] = ts
+        if elapsed <= 0:
+            return bucket[0]
+        return min(2 * rate if rate * 2 >= 1 else 1.0, bucket[0] + elapsed * rate)
+
+    def _adapt(self, ts):
+        if self._window_start is None:
+            self._window_start = ts
+            return
+        elapsed = ts - self._window_start
+        if elapsed < 1.0:
+            return
+        kept_rate = self._window_kept / elapsed
+        if kept_rate > self.target_rate:
+            self.scale = max(MIN_SCALE, self.scale * self.target_rate / kept_rate)
+        elif kept_rate < 0.8 * self.target_rate:
+            self.scale = min(1.0, self.scale * 1.25)
+        self._window_start = ts
+        self._window_kept = 0
@@ -0,0 +1,495 @@
+# agent_sender.py
+"""
+Batched sender for the proxy agent over one long-lived TLS connection.
+
+Capture only calls submit(), which encodes the event to its NDJSON line on the
+calling thread (a pipeline worker, see agent_pipeline.py), puts it on a
+bounded in-memory queue and returns immediately; if the queue is full the
+event is dropped and counted, so a slow or unreachable server never stalls
+the sniffer. A single background thread drains the queue into batches of
+those lines, flushed when
+batch_size events are waiting or flush_interval seconds after the first one,
+and POSTs them to /ingest/batch on a keep-alive connection.
+
+When the connection breaks it is re-established with exponential backoff
+(with jitter), presenting the previous TLS session so the reconnect is a
+resumed handshake, and the batch in flight is sent again. Every event carries
+an event_id, so a batch the server stored but could not acknowledge is
+dropped as a duplicate instead of being indexed twice.
+
+With a disk_queue (agent_disk_queue.DiskQueue), a batch that cannot be
+delivered is parked on disk instead, and so is every later batch until the
+backlog is gone: once the server answers again the sender drains the disk
+queue in large requests, oldest first, with live events appended behind it.
+
+Batch payloads are negotiated with the server: its batch responses list the
+content codings (Accept-Encoding) and batch formats (Accept-Post) it decodes,
+and from then on the sender compresses with zstd (when the zstandard package
+is installed) or gzip, and can send the columnar format, in which every field
+name appears once per batch instead of once per event. Until the server has
+answered once, batches go out as plain NDJSON.
+"""
+import itertools
+import json
+from collections import deque
+import os
+import queue
+import random
+import socket
+import sys
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, gzip is always available
+    zstandard = None
+
+BATCH_PATH = "/ingest/batch"
+MAX_RESPONSE_HEAD = 16 * 1024
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+COLUMNAR_CONTENT_TYPE = "application/x-fpm-columnar+json"
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# below this many bytes compression saves less than it costs
+MIN_COMPRESS_BYTES = 512
+
+# send latencies kept between two take_latencies() calls (the oldest are forgotten beyond it)
+LATENCY_SAMPLES = 4096
+
+# status codes for which re-sending the same batch can never succeed
+PERMANENT_STATUSES = {400, 404, 411, 413, 422}
+
+
+class SendError(Exception):
+    """A batch could not be delivered; retry_after is the server's hint (seconds) or None."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def to_columnar(events):
+    """Encodes events as a columnar batch: field names once, one value array per field."""
+    fields = {}
+    for event in events:
+        for name in event:
+            fields.setdefault(name, None)
+    names = list(fields)
+    columns = [[event.get(name) for event in events] for name in names]
+    return json.dumps({"fields": names, "columns": columns}, separators=(",", ":")).encode("utf-8")
+
+
+def compress(payload, encoding, zstd_compressor=None):
+    """Applies a content coding ("zstd", "gzip" or "identity") to a payload."""
+    if encoding == "zstd":
+        return (zstd_compressor or zstandard.ZstdCompressor(level=ZSTD_LEVEL)).compress(payload)
+    if encoding == "gzip":
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        return compressor.compress(payload) + compressor.flush()
+    return payload
+
+
+class BatchSender:
+    """
+    Queues agent events and ships them in batches over a persistent TLS connection.
+
+    Args:
+        host (str): FPM server address.
+        port (int): FPM server TLS port.
+        context (ssl.SSLContext): Client context (kept for the whole process so sessions resume).
+        batch_size (int): Send as soon as this many events are waiting.
+        flush_interval (float): Send at most this many seconds after the first event of a batch.
+        queue_size (int): Upper bound on queued events; submit() drops beyond it.
+        connect_timeout (float): Timeout for connect, handshake and each response.
+        backoff_initial (float): First reconnect delay in seconds, doubled on each failure.
+        backoff_max (float): Ceiling for the reconnect delay.
+        disk_queue (DiskQueue|None): Opened agent_disk_queue.DiskQueue that batches are parked in
+                                     while the server is unreachable; None retries in memory.
+        drain_events (int): Events per request when draining the disk queue.
+        drain_bytes (int): Body size cap per request when draining the disk queue.
+        compression (str): "auto" (best coding the server accepts), "zstd", "gzip" or "none".
+        batch_format (str): "auto" (columnar once the server accepts it), "columnar" or "ndjson".
+    """
+
+    def __init__(self, host, port, context, batch_size=500, flush_interval=1.0, queue_size=50000,
+                 connect_timeout=10.0, backoff_initial=0.5, backoff_max=30.0, disk_queue=None,
+                 drain_events=5000, drain_bytes=512 * 1024, compression="auto", batch_format="auto"):
+        self.host = host
+        self.port = port
+        self.context = context
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.connect_timeout = connect_timeout
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.disk_queue = disk_queue
+        self.drain_events = drain_events
+        self.drain_bytes = drain_bytes
+        self.compression = compression
+        self.batch_format = batch_format
+        # what the server said it accepts (None until its first response)
+        self._server_encodings = None
+        self._server_formats = None
+        self._zstd = zstandard.ZstdCompressor(level=ZSTD_LEVEL) if zstandard is not None else None
+        self._backoff = backoff_initial
+        self._next_attempt = 0.0
+        self._queue = queue.Queue(queue_size)
+        self._sock = None
+        self._session = None
+        self._closed = threading.Event()
+        self._thread = None
+        # event_id = <random per-process prefix>-<sequence>: unique without hashing every event
+        self._id_prefix = os.urandom(6).hex()
+        self._sequence = itertools.count()
+        # submit() is called from several pipeline workers
+        self._stats_lock = threading.Lock()
+        # seconds from sending a batch to reading the server's response, per delivered batch
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.stats = {
+            "queued": 0, "dropped": 0, "sent_events": 0, "sent_batches": 0,
+            "rejected_events": 0, "duplicates": 0, "failed_batches": 0,
+            "connects": 0, "resumed": 0, "send_errors": 0,
+            "raw_bytes": 0, "wire_bytes": 0,
+        }
+
+    def start(self):
+        """Starts the background sender thread (idempotent)."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="fpm-agent-sender", daemon=True)
+            self._thread.start()
+
+    def submit(self, event, block=False):
+        """
+        Queues an event for sending.
+
+        Args:
+            block (bool): Wait for room in the queue instead of dropping (pcap replay,
+                          where the input can be paced and nothing should be lost).
+
+        Returns:
+            bool: False if the queue was full and the event was dropped.
+        """
+        event.setdefault("event_id", f"{self._id_prefix}-{next(self._sequence)}")
+        line = json.dumps(event).encode("utf-8") + b"\n"
+        try:
+            self._queue.put((event, line), block)
+        except queue.Full:
+            with self._stats_lock:
+                self.stats["dropped"] += 1
+            return False
+        with self._stats_lock:
+            self.stats["queued"] += 1
+        return True
+
+    def pending(self):
+        """Number of events waiting in the queue."""
+        return self._queue.qsize()
+
+    def snapshot(self):
+        """The sender stage's counters plus its queue depth, for status lines and telemetry."""
+        return dict(self.stats, depth=self.pending(), capacity=self._queue.maxsize)
+
+    def take_latencies(self):
+        """Returns the send latencies (seconds) recorded since the previous call, and forgets them."""
+        latencies = []
+        try:
+            while True:
+                latencies.append(self._latencies.popleft())
+        except IndexError:
+            return latencies
+
+    def close(self, timeout=5.0):
+        """Sends what is queued (for up to timeout seconds, None = until done) and closes the connection."""
+        self._closed.set()
+        if self._thread is None:
+            self._shutdown()
+        else:
+            # the sender thread disconnects and closes the disk queue itself when it stops, so a join
+            # that times out mid-delivery does not close the queue under it
+            self._thread.join(timeout)
+
+    def _shutdown(self):
+        self._disconnect()
+        if self.disk_queue is not None:
+            self.disk_queue.close()
+
+    # ------------------------------------------------------------------ batching
+
+    def _next_batch(self):
+        """Blocks for the first event, then collects until batch_size or flush_interval."""
+        batch = []
+        while not batch:
+            try:
+                batch.append(self._queue.get(timeout=0.5))
+            except queue.Empty:
+                if self._closed.is_set():
+                    return batch
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _take_nowait(self, limit):
+        batch = []
+        try:
+            while len(batch) < limit:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    @staticmethod
+    def _encode(batch):
+        return b"".join(line for _, line in batch)
+
+    def _run(self):
+        try:
+            self._send_loop()
+        finally:
+            self._shutdown()
+
+    def _send_loop(self):
+        self._backoff = self.backoff_initial
+        self._next_attempt = 0.0
+        while True:
+            if self.disk_queue is not None and len(self.disk_queue):
+                if not self._backlog_step():
+                    return
+                continue
+            batch = self._next_batch()
+            if not batch:
+                return
+            body = self._encode(batch)
+            while True:
+                try:
+                    self._deliver(body, len(batch), [event for event, _ in batch])
+                    self._backoff = self.backoff_initial
+                    break
+                except SendError as e:
+                    delay = self._failed(e)
+                    if self.disk_queue is not None:
+                        # the server is down: park the batch on disk and keep capturing
+                        self.disk_queue.append(body, len(batch))
+                        break
+                    if self._closed.is_set():
+                        self.stats["failed_batches"] += 1
+                        print(f"[!] Dropping {len(batch)} event(s) on shutdown: {e}", file=sys.stderr)
+                        break
+                    self._closed.wait(delay)
+
+    def _backlog_step(self):
+        """One round of draining the disk queue; returns False once the sender should stop."""
+        # Live events queue up behind the backlog so the server receives them oldest first.
+        while True:
+            batch = self._take_nowait(self.batch_size)
+            if not batch:
+                break
+            self.disk_queue.append(self._encode(batch), len(batch))
+        if self._closed.is_set():
+            print(f"[*] {len(self.disk_queue)} event(s) left in the disk queue for the next run.", file=sys.stdout)
+            return False
+        wait = self._next_attempt - time.monotonic()
+        if wait > 0:
+            self._closed.wait(min(wait, self.flush_interval))
+            return True
+        item = self.disk_queue.read_batch(self.drain_events, self.drain_bytes)
+        if item is None:
+            return True
+        body, count, position = item
+        try:
+            self._deliver(body, count)
+        except SendError as e:
+            self._failed(e)
+            return True
+        self.disk_queue.commit(position)
+        self._backoff = self.backoff_initial
+        if not len(self.disk_queue):
+            print(f"[+] Disk queue drained ({self.disk_queue.stats['drained_events']} event(s) so far).",
+                  file=sys.stdout)
+        return True
+
+    def _failed(self, error):
+        """Books a failed delivery and schedules the next attempt; returns the delay in seconds."""
+        self.stats["send_errors"] += 1
+        self._disconnect()
+        if error.retry_after is not None:
+            delay = error.retry_after
+        else:
+            delay = self._backoff * random.uniform(0.5, 1.0)
+        self._backoff = min(self._backoff * 2, self.backoff_max)
+        self._next_attempt = time.monotonic() + delay
+        backlog = f", {len(self.disk_queue)} on disk" if self.disk_queue is not None else ""
+        print(f"[!] Send to {self.host}:{self.port} failed ({error}); retrying in {delay:.1f}s "
+              f"({self.pending()} queued{backlog}).", file=sys.stderr)
+        return delay
+
+    # ------------------------------------------------------------------ connection
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+        try:
+            # بدون TCP_NODELAY ينتظر الطلب بعد مصافحة TLS 1.2 المختصرة ACK مؤجلًا (~40ms)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock = self.context.wrap_socket(sock, server_hostname=self.host, session=self._session)
+        except BaseException:
+            sock.close()
+            raise
+        self.stats["connects"] += 1
+        if sock.session_reused:
+            self.stats["resumed"] += 1
+        self._sock = sock
+
+    def _disconnect(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    # ------------------------------------------------------------------ negotiation
+
+    def _choose_encoding(self):
+        if self.compression == "none":
+            return "identity"
+        offered = self._server_encodings
+        if self.compression == "auto":
+            candidates = ("zstd", "gzip") if offered is not None else ()
+        else:
+            candidates = (self.compression, "gzip")
+        for encoding in candidates:
+            if encoding == "zstd" and self._zstd is None:
+                continue
+            if offered is None or encoding in offered:
+                return encoding
+        return "identity"
+
+    def _choose_format(self):
+        if self.batch_format == "ndjson":
+            return "ndjson"
+        offered = self._server_formats
+        if offered is None:
+            return "columnar" if self.batch_format == "columnar" else "ndjson"
+        return "columnar" if COLUMNAR_CONTENT_TYPE in offered else "ndjson"
+
+    def _learn(self, headers):
+        """Records what the server advertised in Accept-Encoding / Accept-Post."""
+        if "accept-encoding" in headers:
+            self._server_encodings = {value.strip().lower() for value in headers["accept-encoding"].split(",")}
+        if "accept-post" in headers:
+            self._server_formats = {value.strip().lower() for value in headers["accept-post"].split(",")}
+
+    def _payload(self, body, events):
+        """Turns an NDJSON batch into (payload, content_type, encoding) as negotiated."""
+        if self._choose_format() == "columnar":
+            if events is None:
+                events = [json.loads(line) for line in body.splitlines() if line.strip()]
+            payload, content_type = to_columnar(events), COLUMNAR_CONTENT_TYPE
+        else:
+            payload, content_type = body, NDJSON_CONTENT_TYPE
+        encoding = self._choose_encoding() if len(payload) >= MIN_COMPRESS_BYTES else "identity"
+        return compress(payload, encoding, self._zstd), content_type, encoding
+
+    # ------------------------------------------------------------------ delivery
+
+    def _deliver(self, body, count, events=None):
+        payload, content_type, encoding = self._payload(body, events)
+        content_encoding = f"Content-Encoding: {encoding}\r\n" if encoding != "identity" else ""
+        request = (f"POST {BATCH_PATH} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+                   f"Content-Type: {content_type}\r\n{content_encoding}Content-Length: {len(payload)}\r\n"
+                   f"Connection: keep-alive\r\n\r\n").encode("ascii") + payload
+        # A keep-alive connection the server has already closed (idle timeout) fails on first
+        # use; that one attempt is repeated straight away on a fresh connection.
+        reused = self._sock is not None
+        try:
+            try:
+                if self._sock is None:
+                    self._connect()
+                started = time.perf_counter()
+                self._sock.sendall(request)
+                status, headers, response = self._read_response()
+            except (OSError, EOFError):
+                if not reused:
+                    raise
+                self._disconnect()
+                self._connect()
+                started = time.perf_counter()
+                self._sock.sendall(request)
+                status, headers, response = self._read_response()
+        except (OSError, EOFError, ValueError) as e:
+            raise SendError(str(e) or type(e).__name__)
+        self._latencies.append(time.perf_counter() - started)
+        # قراءة الرد تضمن أيضًا استلام تذكرة جلسة TLS 1.3 (تُرسل بعد المصافحة)
+        self._session = self._sock.session
+        if headers.get("connection", "").lower() == "close":
+            self._disconnect()
+        self._learn(headers)
+
+        if status == 415:
+            # the server cannot decode this coding/format: fall back to plain NDJSON and resend
+            if content_type == NDJSON_CONTENT_TYPE and encoding == "identity":
+                self.stats["failed_batches"] += 1
+                return
+            self._server_encodings = (self._server_encodings or {"identity"}) - {encoding} | {"identity"}
+            self._server_formats = (self._server_formats or set()) - {content_type} | {NDJSON_CONTENT_TYPE}
+            raise SendError(f"HTTP 415 for {content_type} / {encoding}", retry_after=0)
+        if status == 200:
+            self.stats["raw_bytes"] += len(body)
+            self.stats["wire_bytes"] += len(payload)
+            try:
+                result = json.loads(response or b"{}")
+            except ValueError:
+                result = None
+            if not isinstance(result, dict):
+                # the batch was delivered (200), e.g. through a proxy that rewrote the body: resending would duplicate it
+                print(f"[!] Batch of {count} event(s) accepted with an unreadable response: "
+                      f"{response[:200].decode('utf-8', 'replace')}", file=sys.stderr)
+                result = {}
+            self.stats["sent_batches"] += 1
+            self.stats["sent_events"] += result.get("accepted", count)
+            self.stats["duplicates"] += result.get("duplicates", 0)
+            if result.get("rejected"):
+                self.stats["rejected_events"] += result["rejected"]
+                print(f"[!] Server rejected {result['rejected']} event(s): "
+                      f"{result.get('errors', [])[:3]}", file=sys.stderr)
+            return
+        if status in PERMANENT_STATUSES:
+            self.stats["failed_batches"] += 1
+            print(f"[!] Server refused a batch of {count} event(s): {status} "
+                  f"{response[:200].decode('utf-8', 'replace')}", file=sys.stderr)
+            return
+        retry_after = headers.get("retry-after")
+        raise SendError(f"HTTP {status}", float(retry_after) if retry_after and retry_after.isdigit() else None)
+
+    def _read_response(self):
+        """Reads one HTTP response; returns (status, headers with lower-case names, body)."""
+        data = b""
+        while b"\r\n\r\n" not in data:
+            if len(data) > MAX_RESPONSE_HEAD:
+                raise ValueError("response head too large")
+            chunk = self._sock.recv(8192)
+            if not chunk:
+                raise EOFError("connection closed by server")
+            data += chunk
+        head, body = data.split(b"\r\n\r\n", 1)
+        lines = head.decode("latin-1").split("\r\n")
+        status = int(lines[0].split(" ", 2)[1])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", "0"))
+        while len(body) < length:
+            chunk = self._sock.recv(max(8192, length - len(body)))
+            if not chunk:
+                raise EOFError("connection closed mid-response")
+            body += chunk
+        return status, headers, body[:length]
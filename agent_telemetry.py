@@ -0,0 +1,170 @@
+# agent_telemetry.py
+"""
+Self-telemetry for the proxy agent: a periodic heartbeat document.
+
+Every interval seconds Heartbeat asks the agent for its per-stage counters
+(capture and kernel drops, ring buffer, workers, sender, disk queue, ...),
+adds identity, uptime, per-second rates over the interval and the send
+latency percentiles of the batches delivered during it, and POSTs the result
+to the server's /agent/heartbeat endpoint, which indexes it into
+fpm-agent-health so agent health can be charted across the fleet:
+
+    {"type": "agent_heartbeat", "host": "web-1", "agent_id": "3f0c...",
+     "timestamp": "...", "uptime_seconds": 3600.2, "interval_seconds": 60.0,
+     "capture": {"received": ..., "kernel_drops": ...}, "ring": {...},
+     "workers": {...}, "sender": {"queued": ..., "sent_events": ..., ...},
+     "send_latency_ms": {"count": 118, "p50": 3.1, "p90": 5.4, "p99": 12.7, "max": 20.3},
+     "rates": {"packets": 812.4, "events_sent": 810.9, "wire_bytes": 10211.0, ...}}
+
+Counters are cumulative since the agent started; rates are per second over
+the last interval. Heartbeats use their own short-lived connection, so they
+still arrive while the event connection is stuck behind a backlog.
+"""
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+HEARTBEAT_PATH = "/agent/heartbeat"
+LATENCY_PERCENTILES = (50, 90, 99)
+
+# rate name -> (stage, counter) in the collected document
+RATE_FIELDS = {
+    "packets": ("workers", "processed"),
+    "kernel_drops": ("capture", "kernel_drops"),
+    "ring_drops": ("ring", "dropped"),
+    "events_queued": ("sender", "queued"),
+    "events_dropped": ("sender", "dropped"),
+    "events_sent": ("sender", "sent_events"),
+    "wire_bytes": ("sender", "wire_bytes"),
+}
+
+
+def _isoformat(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+def latency_summary(latencies):
+    """Summarizes send latencies (seconds) as count, percentiles and max in milliseconds."""
+    values = sorted(latencies)
+    summary = {"count": len(values)}
+    if not values:
+        return summary
+    for pct in LATENCY_PERCENTILES:
+        index = min(len(values) - 1, max(0, int(round(pct / 100.0 * len(values))) - 1))
+        summary[f"p{pct}"] = round(values[index] * 1000, 3)
+    summary["max"] = round(values[-1] * 1000, 3)
+    return summary
+
+
+def post_json(host, port, context, path, document, timeout=10.0):
+    """POSTs a JSON document over TLS and returns the response status."""
+    connection = http.client.HTTPSConnection(host, port, context=context, timeout=timeout)
+    try:
+        connection.request("POST", path, body=json.dumps(document).encode("utf-8"),
+                           headers={"Content-Type": "application/json", "Connection": "close"})
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+class Heartbeat:
+    """
+    Builds and ships the agent's heartbeat document from a background thread.
+
+    Args:
+        collect (callable): Returns the per-stage counters, {stage: {counter: value}}.
+        send (callable): Delivers a finished document; returns the HTTP status.
+        host (str): Agent host name.
+        interval (float): Seconds between heartbeats.
+        latencies (callable|None): Returns (and forgets) the send latencies, in seconds,
+                                   recorded since the previous call.
+        extra (dict|None): Constant fields added to every document (e.g. the capture mode).
+    """
+
+    def __init__(self, collect, send, host, interval=60.0, latencies=None, extra=None):
+        self.collect = collect
+        self.send = send
+        self.host = host
+        self.interval = interval
+        self.latencies = latencies
+        self.extra = dict(extra or {})
+        self.agent_id = os.urandom(8).hex()
+        self.started = time.time()
+        self._previous = None       # (time, rate counters) of the last heartbeat
+        self._closed = threading.Event()
+        self._thread = None
+        self.stats = {"sent": 0, "failed": 0}
+
+    def start(self):
+        """Starts the heartbeat thread (idempotent)."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="fpm-heartbeat", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self, final=True):
+        """Stops the thread, sending one last heartbeat with the final counters if final is set."""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join(self.interval)
+        if final:
+            self.beat()
+
+    def document(self):
+        """Builds a heartbeat document as of now."""
+        now = time.time()
+        stages = self.collect()
+        counters = {}
+        for name, (stage, counter) in RATE_FIELDS.items():
+            value = stages.get(stage, {}).get(counter)
+            if value is not None:
+                counters[name] = value
+        document = {
+            "type": "agent_heartbeat",
+            "timestamp": _isoformat(now),
+            "host": self.host,
+            "agent_id": self.agent_id,
+            "started": _isoformat(self.started),
+            "uptime_seconds": round(now - self.started, 3),
+        }
+        document.update(self.extra)
+        document.update(stages)
+        if self.latencies is not None:
+            document["send_latency_ms"] = latency_summary(self.latencies())
+        if self._previous is not None:
+            then, previous = self._previous
+            elapsed = now - then
+            document["interval_seconds"] = round(elapsed, 3)
+            if elapsed > 0:
+                document["rates"] = {name: round((value - previous.get(name, 0)) / elapsed, 3)
+                                     for name, value in counters.items()}
+        self._previous = (now, counters)
+        return document
+
+    def beat(self):
+        """Builds and sends one heartbeat; returns True if the server accepted it."""
+        document = self.document()
+        try:
+            status = self.send(document)
+        except (OSError, http.client.HTTPException) as e:
+            status = f"{type(e).__name__}: {e}"
+        if status == 200:
+            self.stats["sent"] += 1
+            return True
+        self.stats["failed"] += 1
+        failed = self.stats["failed"]
+        if failed & (failed - 1) == 0:   # 1, 2, 4, 8, ...
+            print(f"[!] Heartbeat not delivered ({status}); {failed} failed so far.", file=sys.stderr)
+        return False
+
+    def _run(self):
+        # the first document only sets the baseline for rates; the first heartbeat goes out after one interval
+        self.document()
+        while not self._closed.wait(self.interval):
+            self.beat()
@@ -0,0 +1,216 @@
+# async_server.py
+"""
+asyncio ingestion engine for the FPM server (FPM_SERVER_MODE=async).
+
+Unlike the thread-per-connection loop in server.py, TLS handshakes run on the
+event loop without blocking other accepts, connections are kept alive across
+requests (HTTP/1.1), requests are framed by Content-Length or chunked
+transfer-encoding, and the number of concurrent connections is capped: once
+the cap is reached the accept loop stops pulling sockets off the listen queue
+until a slot frees up.
+"""
+import asyncio
+import socket
+import ssl
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import log
+import metrics
+import tls
+from http_protocol import (IDLE_TIMEOUT, MAX_BODY_BYTES, MAX_HEADER_BYTES, READ_TIMEOUT, HTTPError,
+                           build_response, check_request_line, chunk_size, content_length, is_chunked,
+                           parse_head, wants_keep_alive)
+
+HANDSHAKE_TIMEOUT = 10.0   # seconds allowed for a TLS handshake
+LISTEN_BACKLOG = 1024
+HANDLER_WORKERS = 16       # threads running the (blocking) request handler
+
+logger = log.get_logger("async_server")
+
+ACTIVE_CONNECTIONS = metrics.gauge(
+    "fpm_connections_active", "Connections currently open on the async listener")
+
+
+async def read_body(reader, headers, max_body=MAX_BODY_BYTES):
+    """Reads a request body framed by Content-Length or chunked transfer-encoding."""
+    if is_chunked(headers):
+        chunks = []
+        total = 0
+        while True:
+            size = chunk_size(await reader.readuntil(b"\r\n"))
+            if size == 0:
+                # Skip optional trailers up to the terminating blank line.
+                while (await reader.readuntil(b"\r\n")) != b"\r\n":
+                    pass
+                return b"".join(chunks)
+            total += size
+            if total > max_body:
+                raise HTTPError(413, f"Body exceeds {max_body} bytes")
+            chunks.append(await reader.readexactly(size))
+            if await reader.readexactly(2) != b"\r\n":
+                raise HTTPError(400, "Missing CRLF after chunk")
+
+    return await reader.readexactly(content_length(headers, max_body))
+
+
+class AsyncIngestServer:
+    """
+    Accepts TLS connections on an event loop and passes each framed request to a handler.
+
+    Args:
+        context (ssl.SSLContext): Server-side TLS context.
+        handler (callable): Blocking function called as handler(method, path, headers, body, addr)
+                            and returning (status, content_type, response_body, extra_headers); runs on a
+                            small thread pool so it never stalls the loop.
+        host (str): Address to bind.
+        port (int): Port to bind.
+        max_connections (int): Upper bound on concurrently open connections.
+        reuse_port (bool): Set SO_REUSEPORT so several worker processes can share the port.
+        paths (set|None): Paths served; others get 404 before their body is read (None = any).
+    """
+
+    def __init__(self, context, handler, host="0.0.0.0", port=8443, max_connections=1024, reuse_port=False,
+                 paths=None):
+        self.context = context
+        self.handler = handler
+        self.paths = paths
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.reuse_port = reuse_port
+        self.active_connections = 0
+        self._slots = None
+        self._sock = None
+        self._tasks = set()
+        self._executor = ThreadPoolExecutor(max_workers=HANDLER_WORKERS, thread_name_prefix="fpm-handler")
+        ACTIVE_CONNECTIONS.set_function(lambda: self.active_connections)
+
+    def _listen(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(LISTEN_BACKLOG)
+        sock.setblocking(False)
+        return sock
+
+    async def serve_forever(self):
+        loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.max_connections)
+        try:
+            self._sock = self._listen()
+        except OSError as e:
+            logger.critical("Failed to bind socket to %s:%s: %s", self.host, self.port, e)
+            sys.exit(1)
+        logger.info("Forensic Control Center (async) listening on %s:%s (max %d connections)...",
+                    self.host, self.port, self.max_connections)
+
+        while True:
+            # Waiting for a slot before accept() leaves excess clients in the
+            # kernel backlog instead of piling up coroutines and buffers.
+            await self._slots.acquire()
+            try:
+                client_sock, addr = await loop.sock_accept(self._sock)
+            except OSError as e:
+                self._slots.release()
+                logger.warning("accept() failed: %s", e)
+                continue
+            tls.CONNECTIONS_ACCEPTED.inc()
+            task = loop.create_task(self._serve_connection(client_sock, addr))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _serve_connection(self, client_sock, addr):
+        loop = asyncio.get_running_loop()
+        self.active_connections += 1
+        writer = None
+        try:
+            client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            reader = asyncio.StreamReader(limit=MAX_HEADER_BYTES)
+            protocol = asyncio.StreamReaderProtocol(reader)
+            started = time.perf_counter()
+            try:
+                transport, _ = await loop.connect_accepted_socket(
+                    lambda: protocol, client_sock,
+                    ssl=self.context, ssl_handshake_timeout=HANDSHAKE_TIMEOUT)
+            except (ssl.SSLError, OSError, asyncio.TimeoutError, ConnectionError) as e:
+                tls.record_failed_handshake()
+                logger.warning("SSL handshake failed with %s: %r", addr, e)
+                return
+            tls.record_handshake(transport.get_extra_info("ssl_object"), time.perf_counter() - started)
+            writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+            await self._serve_requests(reader, writer, addr)
+        except Exception as e:
+            logger.error("General error handling client %s: %r", addr, e)
+        finally:
+            if writer is not None:
+                writer.close()
+            else:
+                client_sock.close()
+            self.active_connections -= 1
+            self._slots.release()
+
+    async def _serve_requests(self, reader, writer, addr):
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), IDLE_TIMEOUT)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    logger.info("Connection from %s closed mid-request.", addr)
+                return
+            except asyncio.LimitOverrunError:
+                writer.write(build_response(431, "Request header too large", keep_alive=False))
+                await writer.drain()
+                return
+            except (asyncio.TimeoutError, ConnectionError, ssl.SSLError):
+                return
+
+            keep_alive = False
+            try:
+                method, path, version, headers = parse_head(head)
+                keep_alive = wants_keep_alive(version, headers)
+                # before the body: a GET without Content-Length is a 405, not a 411
+                check_request_line(method, path, paths=self.paths)
+                body = await asyncio.wait_for(read_body(reader, headers), READ_TIMEOUT)
+                status, content_type, payload, extra_headers = await self._dispatch(method, path, headers, body, addr)
+            except HTTPError as e:
+                # Framing errors leave the stream position unknown, so always close.
+                logger.warning("Rejected request from %s: %s %s", addr, e.status, e.message)
+                writer.write(build_response(e.status, e.message, keep_alive=False, extra_headers=e.headers))
+                await writer.drain()
+                return
+            except asyncio.TimeoutError:
+                writer.write(build_response(408, "Timed out reading body", keep_alive=False))
+                await writer.drain()
+                return
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                logger.info("Incomplete body received from %s.", addr)
+                return
+
+            writer.write(build_response(status, payload, content_type=content_type, keep_alive=keep_alive,
+                                        extra_headers=extra_headers))
+            await writer.drain()
+            if not keep_alive:
+                return
+
+    async def _dispatch(self, method, path, headers, body, addr):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor, self.handler, method, path, headers, body, addr)
+        except Exception as e:
+            logger.error("Failed to handle request from %s: %s", addr, e)
+            return 500, "text/plain", "Internal error", None
+
+
+def run_async_server(context, handler, host="0.0.0.0", port=8443, max_connections=1024, reuse_port=False,
+                     paths=None):
+    """Runs the asyncio ingestion server until interrupted."""
+    server = AsyncIngestServer(context, handler, host=host, port=port, max_connections=max_connections,
+                               reuse_port=reuse_port, paths=paths)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        logger.info("Async server stopped.")
@@ -0,0 +1,759 @@
+# benchmark.py
+"""
+Benchmarks for FPM components.
+
+Usage:
+    python benchmark.py server [--mode threaded|async|both] [--requests N]
+                               [--concurrency C] [--keep-alive] [--batch N] [--workers N]
+    python benchmark.py tls [--connections N] [--tls-version 1.2|1.3]
+    python benchmark.py parser [--iterations N] [--fuzz N] [--seed S]
+    python benchmark.py ingest [--events N]
+    python benchmark.py capture [--packets N]
+    python benchmark.py encoding [--events N] [--batch N]
+    python benchmark.py replay [--pcap FILE ...] [--packets N] [--mode packet|flow]
+    python benchmark.py correlate [--events N] [--pairwise N] [--burst N]
+
+The "server" benchmark starts server.py's ingestion loop in a child process
+with storage stubbed out (no Elasticsearch needed), drives it with concurrent
+TLS clients and reports throughput and request latency percentiles. The "tls"
+benchmark opens one short-lived connection after another against the same
+server, first with full handshakes and then resuming the previous session,
+and reports connections/s and handshake latency for both. The "parser"
+benchmark compares the old single-recv(8192) request parsing with
+http_protocol.RequestReader on in-memory sockets, then fuzzes RequestReader
+with mutated requests delivered in random fragment sizes. The "ingest"
+benchmark measures the per-event cost of NDJSON decoding with each JSON
+backend, with and without schema validation. The "capture" benchmark feeds
+synthetic Ethernet frames to the agent's packet handling, once through full
+scapy dissection and once through agent_capture's header-only parser, in
+packet and flow mode, and reports packets/s for each. The "encoding"
+benchmark compares agent batch payloads (NDJSON vs columnar, each plain,
+gzip and zstd): bytes per event on the wire, agent encoding CPU and server
+decoding + validation CPU per event. The "replay" benchmark runs
+proxy_agent.py --pcap end to end against a stubbed-storage server: capture
+file read, header parsing, batching and TLS delivery, with no live network.
+Without --pcap it writes a synthetic capture first. The "correlate"
+benchmark times correlation.py's sorted sliding window against the old
+pairwise loop (on a smaller sample, checking both find the same links) and
+then on the full number of events, and compares the size of the pairwise
+linked_alerts.jsonl with the incident records that replace it (events spread
+over a day, and a short burst capture).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_HOST = "127.0.0.1"
+BENCH_PORT = 18443
+CERTFILE = "server.crt"
+KEYFILE = "server.key"
+
+SAMPLE_EVENT = {
+    "timestamp": "2025-07-09T07:43:09.123456",
+    "host": "bench-agent",
+    "src_ip": "192.168.1.10",
+    "dst_ip": "8.8.8.8",
+    "protocol": 6,
+    "src_port": 51515,
+    "dst_port": 443,
+    "layer": "TCP",
+}
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def print_latency_report(label, elapsed, latencies, errors):
+    latencies.sort()
+    done = len(latencies)
+    print(f"{label:<24} {done / elapsed if elapsed else 0:>10.0f} req/s  "
+          f"p50 {percentile(latencies, 50) * 1000:7.2f} ms  "
+          f"p95 {percentile(latencies, 95) * 1000:7.2f} ms  "
+          f"p99 {percentile(latencies, 99) * 1000:7.2f} ms  "
+          f"errors {errors}")
+
+
+# --- server benchmark -------------------------------------------------------
+
+def _serve(mode, port, certfile, keyfile, workers=1):
+    """Child-process entry point: run server.py's loop with storage stubbed out."""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+
+    import log
+    import server
+
+    log.setup()
+
+    def discard(event):
+        return True
+
+    server.store_event = discard
+    server.store_heartbeat = discard
+    context = server.create_ssl_context(certfile, keyfile)
+    if workers > 1:
+        server.start_prefork(workers, mode, BENCH_HOST, port, context)
+    else:
+        server.run_server(mode, BENCH_HOST, port, context)
+
+
+def _wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((BENCH_HOST, port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+async def _read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    length = 0
+    close = False
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length":
+            length = int(value)
+        elif name == b"connection" and value.strip().lower() == b"close":
+            close = True
+    if length:
+        await reader.readexactly(length)
+    return status, close
+
+
+async def _client_worker(port, count, keep_alive, path, body, latencies, errors):
+    context = ssl._create_unverified_context()
+    request = (f"POST {path} HTTP/1.1\r\nHost: {BENCH_HOST}\r\n"
+               f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+               f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode() + body
+    reader = writer = None
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(BENCH_HOST, port, ssl=context)
+            writer.write(request)
+            await writer.drain()
+            status, close = await _read_response(reader)
+            if status != 200:
+                errors[0] += 1
+            if close or not keep_alive:
+                writer.close()
+                reader = writer = None
+        except (OSError, asyncio.IncompleteReadError, ssl.SSLError, ValueError):
+            errors[0] += 1
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            continue
+        latencies.append(time.perf_counter() - start)
+    if writer is not None:
+        writer.close()
+
+
+async def _drive(port, total, concurrency, keep_alive, batch=1):
+    if batch > 1:
+        path = "/ingest/batch"
+        body = b"".join(json.dumps(SAMPLE_EVENT).encode() + b"\n" for _ in range(batch))
+    else:
+        path = "/ingest"
+        body = json.dumps(SAMPLE_EVENT).encode()
+    latencies = []
+    errors = [0]
+    per_worker = max(1, total // concurrency)
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        _client_worker(port, per_worker, keep_alive, path, body, latencies, errors)
+        for _ in range(concurrency)
+    ))
+    return time.perf_counter() - start, latencies, errors[0]
+
+
+def bench_server(args):
+    modes = ["threaded", "async"] if args.mode == "both" else [args.mode]
+    print(f"# {args.requests} requests, concurrency {args.concurrency}, "
+          f"keep-alive {'on' if args.keep_alive else 'off'}, {args.batch} event(s) per request, "
+          f"{args.workers} worker process(es)")
+    spool_dir = tempfile.mkdtemp(prefix="fpm-bench-spool-")
+    for offset, mode in enumerate(modes):
+        port = args.port + offset
+        child = subprocess.Popen([sys.executable, __file__, "_serve", "--mode", mode,
+                                  "--port", str(port), "--cert", args.cert, "--key", args.key,
+                                  "--workers", str(args.workers)],
+                                 env=dict(os.environ, FPM_SPOOL_DIR=spool_dir))
+        try:
+            if not _wait_for_port(port):
+                state = f"exited with {child.poll()}" if child.poll() is not None else "is not listening"
+                print(f"{mode}: server {state} on port {port}", file=sys.stderr)
+                continue
+            elapsed, latencies, errors = asyncio.run(
+                _drive(port, args.requests, args.concurrency, args.keep_alive, args.batch))
+            print_latency_report(mode, elapsed, latencies, errors)
+            if args.batch > 1:
+                print(f"{'':<24} {len(latencies) * args.batch / elapsed:>10.0f} events/s")
+        finally:
+            child.terminate()
+            child.wait()
+
+
+# --- TLS handshake benchmark ------------------------------------------------
+
+def _one_connection(port, context, session, request):
+    """Connect, handshake, send one request, read the reply; returns (handshake seconds, session, reused)."""
+    with socket.create_connection((BENCH_HOST, port)) as sock:
+        # Without this, Nagle holds the request behind the abbreviated TLS 1.2
+        # handshake's final flight until the server's delayed ACK (~40 ms).
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        start = time.perf_counter()
+        ssock = context.wrap_socket(sock, server_hostname=BENCH_HOST, session=session)
+        handshake = time.perf_counter() - start
+        try:
+            ssock.sendall(request)
+            # Reading the reply also collects the TLS 1.3 session ticket.
+            while ssock.recv(65536):
+                pass
+            return handshake, ssock.session, ssock.session_reused
+        finally:
+            ssock.close()
+
+
+def _run_handshakes(port, count, tls_version, resume):
+    context = ssl._create_unverified_context()
+    context.maximum_version = context.minimum_version = tls_version
+    body = json.dumps(SAMPLE_EVENT).encode()
+    request = (f"POST /ingest HTTP/1.1\r\nHost: {BENCH_HOST}\r\nContent-Type: application/json\r\n"
+               f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode() + body
+    session = None
+    latencies = []
+    resumed = errors = 0
+    start = time.perf_counter()
+    for _ in range(count):
+        try:
+            handshake, session, reused = _one_connection(port, context, session if resume else None, request)
+        except (OSError, ssl.SSLError):
+            errors += 1
+            continue
+        latencies.append(handshake)
+        resumed += reused
+    return time.perf_counter() - start, latencies, resumed, errors
+
+
+def bench_tls(args):
+    tls_version = ssl.TLSVersion.TLSv1_3 if args.tls_version == "1.3" else ssl.TLSVersion.TLSv1_2
+    print(f"# {args.connections} sequential connections, TLS {args.tls_version}, one request each")
+    child = subprocess.Popen([sys.executable, __file__, "_serve", "--mode", "async",
+                              "--port", str(args.port), "--cert", args.cert, "--key", args.key],
+                             env=dict(os.environ, FPM_SPOOL_DIR=tempfile.mkdtemp(prefix="fpm-bench-spool-")))
+    try:
+        if not _wait_for_port(args.port):
+            print(f"tls: server is not listening on port {args.port}", file=sys.stderr)
+            return
+        for label, resume in (("full handshake", False), ("resumed session", True)):
+            elapsed, latencies, resumed, errors = _run_handshakes(args.port, args.connections, tls_version, resume)
+            latencies.sort()
+            print(f"{label:<24} {len(latencies) / elapsed if elapsed else 0:>10.0f} conn/s  "
+                  f"handshake p50 {percentile(latencies, 50) * 1000:7.2f} ms  "
+                  f"p99 {percentile(latencies, 99) * 1000:7.2f} ms  "
+                  f"resumed {resumed}  errors {errors}")
+    finally:
+        child.terminate()
+        child.wait()
+
+
+# --- request parser benchmark and fuzzer ------------------------------------
+
+class _FragmentSocket:
+    """In-memory stand-in for a connected socket that returns data in given fragment sizes."""
+
+    def __init__(self, data, sizes):
+        self._data = memoryview(data)
+        self._sizes = sizes
+        self._offset = 0
+        self._index = 0
+
+    def settimeout(self, timeout):
+        pass
+
+    def _next_size(self, limit):
+        size = self._sizes[self._index % len(self._sizes)]
+        self._index += 1
+        return min(size, limit, len(self._data) - self._offset)
+
+    def recv(self, bufsize):
+        size = self._next_size(bufsize)
+        chunk = self._data[self._offset:self._offset + size].tobytes()
+        self._offset += size
+        return chunk
+
+    def recv_into(self, buffer):
+        size = self._next_size(len(buffer))
+        buffer[:size] = self._data[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+
+def _request_bytes(body, chunked=False, chunk=4096):
+    head = f"POST /ingest/batch HTTP/1.1\r\nHost: {BENCH_HOST}\r\nContent-Type: application/x-ndjson\r\n"
+    if not chunked:
+        return (head + f"Content-Length: {len(body)}\r\n\r\n").encode() + body
+    parts = [(head + "Transfer-Encoding: chunked\r\n\r\n").encode()]
+    for start in range(0, len(body), chunk):
+        piece = body[start:start + chunk]
+        parts.append(f"{len(piece):x}\r\n".encode() + piece + b"\r\n")
+    parts.append(b"0\r\n\r\n")
+    return b"".join(parts)
+
+
+def _legacy_parse(sock):
+    """The parsing server.handle_client did before RequestReader: one recv(8192)."""
+    from http_protocol import parse_head
+
+    raw = sock.recv(8192)
+    end = raw.find(b"\r\n\r\n")
+    if end == -1:
+        return None
+    method, path, version, headers = parse_head(raw[:end + 4])
+    body = raw[end + 4:]
+    # Chunked framing was never decoded, and only the first read was looked at.
+    if "transfer-encoding" in headers or len(body) < int(headers.get("content-length", "0")):
+        return None
+    return body
+
+
+def _reader_parse(sock):
+    from http_protocol import RequestReader
+
+    return RequestReader(sock, max_body_bytes=64 * 1024 * 1024).read_request()[4]
+
+
+def bench_parser(args):
+    from http_protocol import HTTPError, RequestReader
+
+    # TLS delivers at most 16 KB of plaintext per record.
+    fragments = [16 * 1024]
+    line = json.dumps(SAMPLE_EVENT).encode() + b"\n"
+    cases = [("1 event", _request_bytes(line)),
+             ("50-event batch", _request_bytes(line * 50)),
+             ("1000-event batch", _request_bytes(line * 1000)),
+             ("1000-event chunked", _request_bytes(line * 1000, chunked=True))]
+    print(f"# {args.iterations} parses per case, {fragments[0]} byte reads")
+    for label, data in cases:
+        for name, parse in (("recv(8192)", _legacy_parse), ("RequestReader", _reader_parse)):
+            complete = 0
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                try:
+                    complete += parse(_FragmentSocket(data, fragments)) is not None
+                except (HTTPError, ValueError):
+                    pass
+            elapsed = time.perf_counter() - start
+            print(f"{label:<20} {name:<14} {args.iterations / elapsed:>10.0f} req/s  "
+                  f"{len(data) * args.iterations / elapsed / 1e6:>8.1f} MB/s  complete {complete}/{args.iterations}")
+
+    if not args.fuzz:
+        return
+    rng = random.Random(args.seed)
+    outcomes = {"parsed": 0, "closed": 0, "rejected": 0}
+    for iteration in range(args.fuzz):
+        body = bytes(rng.randrange(256) for _ in range(rng.randrange(0, 3000)))
+        data = bytearray(_request_bytes(body, chunked=rng.random() < 0.5, chunk=rng.randrange(1, 1024)))
+        mutated = rng.random() < 0.8
+        if mutated:
+            for _ in range(rng.randrange(1, 4)):
+                if not data:
+                    break
+                position = rng.randrange(len(data))
+                action = rng.randrange(3)
+                if action == 0:
+                    data[position] = rng.randrange(256)
+                elif action == 1:
+                    data.insert(position, rng.choice(b"\r\n:;0aZ- \x00\xff"))
+                else:
+                    del data[position:]
+        sizes = [rng.randrange(1, 64) for _ in range(8)]
+        reader = RequestReader(_FragmentSocket(bytes(data), sizes), max_body_bytes=2048)
+        try:
+            request = reader.read_request()
+        except HTTPError:
+            outcomes["rejected"] += 1
+            continue
+        except Exception as e:
+            print(f"[!] Fuzz case {iteration} (seed {args.seed}) raised {e!r}", file=sys.stderr)
+            sys.exit(1)
+        if request is None:
+            outcomes["closed"] += 1
+            continue
+        outcomes["parsed"] += 1
+        if not mutated and bytes(request[4]) != body:
+            print(f"[!] Fuzz case {iteration} (seed {args.seed}) returned a wrong body", file=sys.stderr)
+            sys.exit(1)
+    print(f"# fuzz: {args.fuzz} cases, " + ", ".join(f"{k} {v}" for k, v in outcomes.items()) +
+          ", no unexpected exceptions")
+
+
+# --- ingest decode/validation benchmark -------------------------------------
+
+def bench_ingest(args):
+    import ingest
+
+    line = json.dumps(SAMPLE_EVENT).encode() + b"\n"
+    body = line * args.events
+    backends = [("json", json.loads)]
+    if ingest.orjson is not None:
+        backends.append(("orjson", ingest.orjson.loads))
+    print(f"# NDJSON batch of {args.events} events ({len(body)} bytes), best of 5")
+    original = ingest.json_loads
+    try:
+        for name, loads in backends:
+            ingest.json_loads = loads
+            for validate in (False, True):
+                best = float("inf")
+                for _ in range(5):
+                    start = time.perf_counter()
+                    events, errors = ingest.parse_ndjson(body, validate=validate)
+                    best = min(best, time.perf_counter() - start)
+                assert len(events) == args.events and not errors
+                label = f"{name} + schema" if validate else name
+                print(f"{label:<24} {best / args.events * 1e6:>8.2f} us/event  "
+                      f"{args.events / best:>10.0f} events/s")
+    finally:
+        ingest.json_loads = original
+
+
+# --- agent capture parsing benchmark ------------------------------------------
+
+def _sample_frames(count, seed=1):
+    from scapy.all import IP, TCP, UDP, Ether, IPv6, Raw
+
+    rnd = random.Random(seed)
+    # explicit MACs: a bare Ether() resolves the destination with ARP
+    link = Ether(src="02:00:00:00:00:01", dst="02:00:00:00:00:02")
+    frames = []
+    for i in range(count):
+        client = f"192.168.1.{rnd.randint(2, 254)}"
+        server = f"10.0.{rnd.randint(0, 3)}.{rnd.randint(1, 254)}"
+        kind = rnd.random()
+        if kind < 0.75:
+            packet = link / IP(src=client, dst=server) / TCP(sport=rnd.randint(30000, 60000), dport=443,
+                                                                flags="PA") / Raw(b"x" * rnd.randint(0, 1400))
+        elif kind < 0.95:
+            packet = link / IP(src=client, dst="8.8.8.8") / UDP(sport=rnd.randint(30000, 60000), dport=53) / Raw(b"q" * 40)
+        else:
+            packet = link / IPv6(src="fe80::1", dst="fe80::2") / TCP(sport=50000, dport=22, flags="A")
+        frames.append(bytes(packet))
+    return frames
+
+
+def bench_capture(args):
+    from scapy.all import IP, TCP, UDP, Ether
+
+    from agent_capture import parse_frame
+    from agent_flows import FlowTable
+
+    frames = _sample_frames(args.packets)
+    print(f"# {len(frames)} synthetic frames (75% TCP, 20% UDP, 5% IPv6), no capture socket involved")
+
+    def scapy_fields(frame):
+        packet = Ether(frame)
+        if IP in packet:
+            ip = packet[IP]
+            if TCP in packet:
+                return ip.src, ip.dst, ip.proto, packet[TCP].sport, packet[TCP].dport, ip.len, int(packet[TCP].flags)
+            if UDP in packet:
+                return ip.src, ip.dst, ip.proto, packet[UDP].sport, packet[UDP].dport, ip.len, 0
+            return ip.src, ip.dst, ip.proto, None, None, ip.len, 0
+        return None
+
+    for parser_name, parse in (("scapy dissection", scapy_fields), ("header-only", parse_frame)):
+        for mode in ("packet", "flow"):
+            table = FlowTable(lambda record: None, max_flows=65536)
+            start = time.perf_counter()
+            for ts, frame in enumerate(frames):
+                fields = parse(frame)
+                if fields is not None and mode == "flow":
+                    table.add(ts * 1e-4, *fields)
+            elapsed = time.perf_counter() - start
+            print(f"{parser_name:<18} {mode:<7} {len(frames) / elapsed:>10.0f} packets/s  "
+                  f"{elapsed / len(frames) * 1e6:>7.2f} us/packet")
+
+
+# --- agent batch payload encoding benchmark ----------------------------------
+
+def _sample_events(count, seed=1):
+    rnd = random.Random(seed)
+    start = 1752046989.0
+    events = []
+    for i in range(count):
+        tcp = rnd.random() < 0.8
+        events.append({
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(start + i * 0.002)) + f".{i % 1000:03d}000",
+            "host": "bench-agent",
+            "src_ip": f"192.168.1.{rnd.randint(2, 40)}",
+            "dst_ip": rnd.choice(["8.8.8.8", "1.1.1.1"]) if not tcp else f"10.0.{rnd.randint(0, 3)}.{rnd.randint(1, 254)}",
+            "protocol": 6 if tcp else 17,
+            "src_port": rnd.randint(30000, 60000),
+            "dst_port": rnd.choice([443, 443, 80, 22]) if tcp else 53,
+            "layer": "TCP" if tcp else "UDP",
+            "event_id": f"5f1c0a9e3b7d-{i}",
+        })
+    return events
+
+
+def bench_encoding(args):
+    import ingest
+    from agent_sender import COLUMNAR_CONTENT_TYPE, NDJSON_CONTENT_TYPE, compress, to_columnar, zstandard
+
+    events = _sample_events(args.events)
+    batches = [events[i:i + args.batch] for i in range(0, len(events), args.batch)]
+    encodings = ["identity", "gzip"] + (["zstd"] if zstandard is not None and ingest.zstandard is not None else [])
+    print(f"# {len(events)} packet events in batches of {args.batch}, best of 3; "
+          f"server side = decompress + parse + schema")
+    print(f"{'format':<10} {'encoding':<9} {'bytes/event':>11} {'ratio':>6} {'agent us/ev':>12} {'server us/ev':>13}")
+    baseline = None
+    for batch_format, content_type in (("ndjson", NDJSON_CONTENT_TYPE), ("columnar", COLUMNAR_CONTENT_TYPE)):
+        for encoding in encodings:
+            agent_seconds = server_seconds = float("inf")
+            for _ in range(3):
+                started = time.perf_counter()
+                payloads = []
+                for batch in batches:
+                    if batch_format == "columnar":
+                        payload = to_columnar(batch)
+                    else:
+                        payload = b"".join(json.dumps(event).encode("utf-8") + b"\n" for event in batch)
+                    payloads.append(compress(payload, encoding))
+                agent_seconds = min(agent_seconds, time.perf_counter() - started)
+
+                started = time.perf_counter()
+                decoded = 0
+                for payload in payloads:
+                    data = ingest.decode_content(payload, encoding)
+                    batch_events, errors = ingest.parse_batch(data, content_type, encoding)
+                    decoded += len(batch_events)
+                server_seconds = min(server_seconds, time.perf_counter() - started)
+                assert decoded == len(events) and not errors
+
+            wire = sum(len(payload) for payload in payloads) / len(events)
+            baseline = baseline or wire
+            print(f"{batch_format:<10} {encoding:<9} {wire:>11.1f} {baseline / wire:>5.1f}x "
+                  f"{agent_seconds / len(events) * 1e6:>12.2f} {server_seconds / len(events) * 1e6:>13.2f}")
+
+
+# --- agent end-to-end pcap replay benchmark ------------------------------------
+
+def bench_replay(args):
+    files = args.pcap
+    if not files:
+        from scapy.all import Ether, wrpcap
+
+        path = os.path.join(tempfile.mkdtemp(prefix="fpm-bench-pcap-"), "synthetic.pcap")
+        packets = []
+        for i, frame in enumerate(_sample_frames(args.packets)):
+            packet = Ether(frame)
+            packet.time = 1752046989.0 + i * 1e-4
+            packets.append(packet)
+        wrpcap(path, packets)
+        files = [path]
+        print(f"# {args.packets} synthetic packets written to {path}")
+    child = subprocess.Popen([sys.executable, __file__, "_serve", "--mode", "async",
+                              "--port", str(args.port), "--cert", args.cert, "--key", args.key],
+                             env=dict(os.environ, FPM_SPOOL_DIR=tempfile.mkdtemp(prefix="fpm-bench-spool-")))
+    try:
+        if not _wait_for_port(args.port):
+            print(f"server is not listening on port {args.port}", file=sys.stderr)
+            return
+        env = dict(os.environ, SERVER_HOST=BENCH_HOST, SERVER_PORT=str(args.port), FPM_AGENT_MODE=args.mode,
+                   FPM_AGENT_DISK_QUEUE_DIR="")
+        agent = os.path.join(os.path.dirname(os.path.abspath(__file__)), "proxy_agent.py")
+        subprocess.run([sys.executable, agent, "--pcap", *files, "--speed", str(args.speed)], env=env, check=False)
+    finally:
+        child.terminate()
+        child.wait()
+
+
+# --- correlation engine benchmark --------------------------------------------
+
+def _correlation_events(count, seed=1):
+    rnd = random.Random(seed)
+    start = 1752046989.0
+    sources = max(1, count // 20)
+    events = []
+    for i in range(count):
+        ts = start + rnd.random() * 86400
+        events.append({
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ts)) + f".{int(ts % 1 * 1e6):06d}Z",
+            "src_ip": "10.{}.{}.{}".format(*rnd.randrange(sources).to_bytes(3, "big")),
+            "event_id": str(i),
+        })
+    return events
+
+
+def _burst_events(count, sources=5, seed=1):
+    """A short capture: count packets from a few sources within two minutes, shaped like agent events."""
+    rnd = random.Random(seed)
+    start = 1752046989.0
+    events = []
+    for i in range(count):
+        ts = start + i * 120.0 / count
+        events.append({
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ts)) + f".{int(ts % 1 * 1e6):06d}Z",
+            "src_ip": f"192.168.1.{rnd.randrange(sources) + 10}",
+            "dst_ip": f"10.0.0.{rnd.randrange(4) + 1}",
+            "dst_port": rnd.choice([80, 443, 8443]),
+            "protocol": "TCP",
+            "action": "allow",
+            "byte_count": rnd.randrange(60, 1500),
+            "flow_id": f"flow-{rnd.randrange(100)}",
+            "alerts": [],
+            "event_id": str(i),
+        })
+    return events
+
+
+def _pairwise_links(entries):
+    """The loop correlator.py and the dashboards used before correlation.py."""
+    from datetime import datetime, timedelta
+
+    links = []
+    for i, entry in enumerate(entries):
+        entry_timestamp = datetime.fromisoformat(entry["timestamp"].replace("Z", "+00:00"))
+        for j in range(i + 1, len(entries)):
+            other = entries[j]
+            other_timestamp = datetime.fromisoformat(other["timestamp"].replace("Z", "+00:00"))
+            if entry.get("src_ip") == other.get("src_ip") and abs(entry_timestamp - other_timestamp) <= timedelta(minutes=5):
+                links.append((entry, other))
+    return links
+
+
+def bench_correlate(args):
+    from correlation import cluster_incidents, correlate, parse_timestamp
+
+    sample = _correlation_events(args.pairwise)
+    print("# same src_ip within 5 minutes; events spread over 24h, ~20 per source")
+    started = time.perf_counter()
+    old = _pairwise_links(sample)
+    pairwise_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    new = correlate(sample)
+    engine_seconds = time.perf_counter() - started
+    same = sorted((a["event_id"], b["event_id"]) for a, b in old) == sorted((a["event_id"], b["event_id"]) for a, b in new)
+    print(f"{len(sample):>9} events  pairwise {pairwise_seconds:>8.3f}s  engine {engine_seconds:>7.3f}s  "
+          f"{len(new)} links ({'identical' if same else 'DIFFERENT'})")
+
+    # linked_alerts.jsonl: a line per pair with both documents vs a record per incident with member ids
+    for name, entries in (("spread", sample), ("burst", _burst_events(args.burst))):
+        pairs = correlate(entries)
+        pairwise_bytes = sum(len(json.dumps({"timestamp": a["timestamp"], "entry": a, "linked_with": b})) + 1
+                             for a, b in pairs)
+        hits = sorted(({"_id": event["event_id"], "_source": event} for event in entries),
+                      key=lambda hit: parse_timestamp(hit["_source"]["timestamp"]))
+        incidents = list(cluster_incidents(hits))
+        incident_bytes = sum(len(json.dumps(incident)) + 1 for incident in incidents)
+        print(f"{len(entries):>9} events  {name:<6} output: pairwise {len(pairs)} lines {pairwise_bytes / 1e6:.2f} MB, "
+              f"incidents {len(incidents)} lines {incident_bytes / 1e6:.3f} MB")
+
+    events = _correlation_events(args.events)
+    started = time.perf_counter()
+    links = correlate(events)
+    elapsed = time.perf_counter() - started
+    print(f"{len(events):>9} events  engine {elapsed:>7.3f}s  {len(links)} links  "
+          f"({len(events) / elapsed:.0f} events/s)")
+    hits = sorted(({"_id": event["event_id"], "_source": event} for event in events),
+                  key=lambda hit: hit["_source"]["timestamp"])
+    started = time.perf_counter()
+    incidents = sum(1 for _ in cluster_incidents(hits))
+    elapsed = time.perf_counter() - started
+    print(f"{len(events):>9} events  incidents {elapsed:>7.3f}s  {incidents} incidents  "
+          f"({len(events) / elapsed:.0f} events/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FPM benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("server", help="threaded vs asyncio ingestion throughput/latency")
+    p.add_argument("--mode", choices=["threaded", "async", "both"], default="both")
+    p.add_argument("--requests", type=int, default=5000)
+    p.add_argument("--concurrency", type=int, default=50)
+    p.add_argument("--keep-alive", action="store_true")
+    p.add_argument("--batch", type=int, default=1, help="events per request (NDJSON batch endpoint when > 1)")
+    p.add_argument("--workers", type=int, default=1, help="pre-fork worker processes (SO_REUSEPORT)")
+    p.add_argument("--port", type=int, default=BENCH_PORT)
+    p.add_argument("--cert", default=CERTFILE)
+    p.add_argument("--key", default=KEYFILE)
+    p.set_defaults(func=bench_server)
+
+    p = sub.add_parser("tls", help="full vs resumed TLS handshake cost")
+    p.add_argument("--connections", type=int, default=1000)
+    p.add_argument("--tls-version", choices=["1.2", "1.3"], default="1.3")
+    p.add_argument("--port", type=int, default=BENCH_PORT)
+    p.add_argument("--cert", default=CERTFILE)
+    p.add_argument("--key", default=KEYFILE)
+    p.set_defaults(func=bench_tls)
+
+    p = sub.add_parser("parser", help="streaming request reader vs single recv(); fuzzing")
+    p.add_argument("--iterations", type=int, default=2000)
+    p.add_argument("--fuzz", type=int, default=20000, help="fuzz cases to run after the benchmark (0 = skip)")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_parser)
+
+    p = sub.add_parser("ingest", help="per-event JSON decode and schema validation cost")
+    p.add_argument("--events", type=int, default=20000)
+    p.set_defaults(func=bench_ingest)
+
+    p = sub.add_parser("capture", help="agent packet parsing: scapy dissection vs header-only")
+    p.add_argument("--packets", type=int, default=20000)
+    p.set_defaults(func=bench_capture)
+
+    p = sub.add_parser("encoding", help="agent batch payloads: size and CPU per format/compression")
+    p.add_argument("--events", type=int, default=50000)
+    p.add_argument("--batch", type=int, default=500)
+    p.set_defaults(func=bench_encoding)
+
+    p = sub.add_parser("replay", help="agent end to end: pcap replay through parsing, batching and TLS delivery")
+    p.add_argument("--pcap", nargs="+", metavar="FILE", help="capture files (default: a synthetic capture)")
+    p.add_argument("--packets", type=int, default=50000, help="packets in the synthetic capture")
+    p.add_argument("--mode", choices=["packet", "flow"], default="packet")
+    p.add_argument("--speed", type=float, default=0.0, help="0 = as fast as possible, 1 = original timing")
+    p.add_argument("--port", type=int, default=BENCH_PORT)
+    p.add_argument("--cert", default=CERTFILE)
+    p.add_argument("--key", default=KEYFILE)
+    p.set_defaults(func=bench_replay)
+
+    p = sub.add_parser("correlate", help="correlation engine vs the old pairwise loop")
+    p.add_argument("--events", type=int, default=1000000)
+    p.add_argument("--pairwise", type=int, default=3000, help="events for the pairwise comparison")
+    p.add_argument("--burst", type=int, default=2000, help="events of the burst capture for the output size comparison")
+    p.set_defaults(func=bench_correlate)
+
+    p = sub.add_parser("_serve", help=argparse.SUPPRESS)
+    p.add_argument("--mode", required=True)
+    p.add_argument("--port", type=int, required=True)
+    p.add_argument("--cert", default=CERTFILE)
+    p.add_argument("--key", default=KEYFILE)
+    p.add_argument("--workers", type=int, default=1)
+    p.set_defaults(func=lambda a: _serve(a.mode, a.port, a.cert, a.key, a.workers))
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
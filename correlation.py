@@ -0,0 +1,601 @@
+# correlation.py
+"""
+Correlation engine: links events that share a key (by default the source IP)
+and happened within a time window of each other (by default 5 minutes).
+
+This replaces the pairwise loop that correlator.py and both dashboards used
+to run, which compared every event with every later one and re-parsed the
+inner event's timestamp on each comparison (O(n^2) parses). Here every
+timestamp is parsed once, the events are sorted by time, and each key keeps a
+sliding window of its recent events:
+
+    for each event in time order:
+        drop the events of its key older than ts - window
+        link the event with every event still in the key's window
+        add the event to the window
+
+which costs O(n log n) for the sort plus O(output) for the links. A batch
+(linked_pairs()) sorts each key's events and sweeps them with two indexes;
+SlidingWindowLinker keeps the same windows for events arriving over time, and
+stream_pairs() runs it over input that is already in time order (a sorted
+Elasticsearch scan), holding only the last window of events in memory.
+The links are the same pairs the pairwise loop found, with the same
+orientation: the event that came first in the input is the "entry", the
+other "linked_with".
+
+Links are pairwise: a burst of k events from one source makes k^2/2 of
+them. IncidentClusterer reports the same relation compactly, as one record
+per connected group of linked events (an "incident"): consecutive events of
+a key at most window apart belong to the same incident. A record carries the
+member event ids, the time span, counts and a summary of the members; the
+members themselves are fetched from the index only when someone expands the
+incident (es_scan.get_documents). An incident that reaches an hour or 10000
+events is written out and continued in a new record ("part" 2, 3, ... with
+"continued_from" naming the previous one), like the agent's flow records on
+their active timeout, so a source that never goes quiet is still reported.
+
+Timestamps are ISO 8601 strings; a trailing "Z" is accepted and timestamps
+without an offset are taken as UTC (the agent sends naive UTC times), so
+naive and aware timestamps can be compared instead of raising TypeError.
+Times are handled as integer microseconds, so the window edge is exact.
+"""
+import bisect
+import gc
+import hashlib
+import json
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from operator import itemgetter
+
+DEFAULT_WINDOW_SECONDS = 300.0
+DEFAULT_KEY_FIELDS = ("src_ip",)
+# incident summaries: the most common values of these fields, and at most this many of each / of the alerts
+SUMMARY_FIELDS = ("dst_ip", "dst_port", "protocol", "action")
+SUMMARY_TOP = 5
+SUMMARY_ALERTS = 20
+# an incident is closed and continued in a new record once it has this many events or spans this many seconds
+DEFAULT_MAX_INCIDENT_EVENTS = 10000
+DEFAULT_MAX_INCIDENT_SECONDS = 3600.0
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def parse_timestamp(value):
+    """
+    Converts an ISO 8601 timestamp to integer microseconds since the epoch.
+
+    Returns:
+        int|None: None if value is not a parseable timestamp string.
+    """
+    if not isinstance(value, str):
+        return None
+    try:
+        # "...Z" is UTC: parse it as a naive time (also works before Python 3.11, which rejects "Z")
+        parsed = datetime.fromisoformat(value[:-1] if value.endswith("Z") else value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.replace(tzinfo=None) - parsed.utcoffset()
+    return (parsed - _EPOCH) // _MICROSECOND
+
+
+def format_timestamp(micros):
+    """Formats microseconds since the epoch as an ISO 8601 UTC string ending in "Z" (inverse of parse_timestamp)."""
+    return (_EPOCH + micros * _MICROSECOND).isoformat(timespec="microseconds") + "Z"
+
+
+def correlation_key(entry, key_fields=DEFAULT_KEY_FIELDS):
+    """The value(s) two events must share to be linked (missing fields count as None, as before)."""
+    if len(key_fields) == 1:
+        return entry.get(key_fields[0])
+    return tuple(entry.get(field) for field in key_fields)
+
+
+class SlidingWindowLinker:
+    """
+    Per-key sliding windows over events arriving in time order.
+
+    push() links an event with every earlier event of the same key at most
+    window seconds older, then remembers it. Keys whose newest event has left
+    the window are forgotten, so memory is bounded by the events of the last
+    window, not by the whole input.
+
+    Events may also arrive up to lateness seconds behind the newest one: the
+    windows then keep window + lateness seconds of events, so a late event
+    still finds everything within window of it, on both sides.
+
+    Args:
+        window (float): Link distance in seconds (inclusive).
+        lateness (float): How far out of order (seconds) events may arrive.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW_SECONDS, lateness=0.0):
+        self.window = int(round(window * 1000000))
+        self.lateness = int(round(lateness * 1000000))
+        self._windows = {}          # key -> deque of (ts, item), oldest first
+        self._expiry = deque()      # (ts, key) in push order, to forget idle keys
+        self.stats = {"pushed": 0, "links": 0, "out_of_order": 0}
+
+    def __len__(self):
+        """Events currently held in the windows."""
+        return sum(len(items) for items in self._windows.values())
+
+    def push(self, key, ts, item):
+        """
+        Adds an event (ts in microseconds since the epoch) and returns the items it links with.
+
+        Events should arrive in non-decreasing ts order per key; a late event
+        is linked with the events within window of it and counted as
+        out_of_order (links with events older than window + lateness before
+        the newest one are lost).
+        """
+        self.stats["pushed"] += 1
+        self.expire(ts)
+        items = self._windows.get(key)
+        if items is None:
+            items = self._windows[key] = deque()
+        elif items[-1][0] > ts:
+            self.stats["out_of_order"] += 1
+            # late: keep the window sorted and skip the retained events that are too far on either side
+            linked = [other for other_ts, other in items if abs(other_ts - ts) <= self.window]
+            bisect.insort(items, (ts, item), key=itemgetter(0))
+            self._expiry.append((ts, key))
+            self.stats["links"] += len(linked)
+            return linked
+        horizon = ts - self.window
+        retained = horizon - self.lateness
+        while items and items[0][0] < retained:
+            items.popleft()
+        if self.lateness:
+            linked = [other for other_ts, other in items if other_ts >= horizon]
+        else:
+            linked = [other for _, other in items]
+        items.append((ts, item))
+        self._expiry.append((ts, key))
+        self.stats["links"] += len(linked)
+        return linked
+
+    def expire(self, now):
+        """Forgets the keys with no event within window + lateness of now (microseconds since the epoch)."""
+        horizon = now - self.window - self.lateness
+        expiry = self._expiry
+        while expiry and expiry[0][0] < horizon:
+            _, key = expiry.popleft()
+            items = self._windows.get(key)
+            if items is not None and items[-1][0] < horizon:
+                del self._windows[key]
+
+
+def linked_pairs(entries, window=DEFAULT_WINDOW_SECONDS, key_fields=DEFAULT_KEY_FIELDS, skipped=None):
+    """
+    Yields (entry, linked_with) for every two entries with the same key at most window seconds apart.
+
+    Args:
+        entries (iterable): Event dicts with a "timestamp".
+        window (float): Link distance in seconds (inclusive).
+        key_fields (tuple): Fields that must be equal.
+        skipped (list|None): Receives the entries whose timestamp could not be parsed
+                             (they are never linked, as before).
+    """
+    groups = {}
+    # Building millions of tuples would trigger a cyclic GC pass every few
+    # hundred allocations; this loop creates no cycles, so collection is paused.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for index, entry in enumerate(entries):
+            ts = parse_timestamp(entry.get("timestamp"))
+            if ts is None:
+                if skipped is not None:
+                    skipped.append(entry)
+                continue
+            key = correlation_key(entry, key_fields)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = []
+            group.append((ts, index, entry))
+    finally:
+        if gc_enabled:
+            gc.enable()
+    window = int(round(window * 1000000))
+    for group in groups.values():
+        # (ts, input position) is unique, so the entries themselves are never compared
+        group.sort()
+        start = 0
+        for position, (ts, index, entry) in enumerate(group):
+            horizon = ts - window
+            while group[start][0] < horizon:
+                start += 1
+            for other_ts, other_index, other in group[start:position]:
+                if other_index < index:
+                    yield other, entry
+                else:
+                    yield entry, other
+
+
+def stream_pairs(entries, window=DEFAULT_WINDOW_SECONDS, key_fields=DEFAULT_KEY_FIELDS, skipped=None,
+                 lateness=0.0):
+    """
+    linked_pairs() for entries that arrive in time order, with memory bounded by one window.
+
+    The event that arrived first is the "entry" of each pair. Entries up to
+    lateness seconds out of order are still linked correctly.
+
+    Args:
+        entries (iterable): Event dicts with a "timestamp", sorted by it.
+        window (float): Link distance in seconds (inclusive).
+        key_fields (tuple): Fields that must be equal.
+        skipped (list|None): Receives the entries whose timestamp could not be parsed.
+        lateness (float): How far out of order (seconds) entries may arrive.
+    """
+    linker = SlidingWindowLinker(window, lateness)
+    for entry in entries:
+        ts = parse_timestamp(entry.get("timestamp"))
+        if ts is None:
+            if skipped is not None:
+                skipped.append(entry)
+            continue
+        for other in linker.push(correlation_key(entry, key_fields), ts, entry):
+            yield other, entry
+
+
+def correlate(entries, window=DEFAULT_WINDOW_SECONDS, key_fields=DEFAULT_KEY_FIELDS, skipped=None):
+    """linked_pairs() as a list."""
+    return list(linked_pairs(entries, window, key_fields, skipped))
+
+
+class IncidentCluster:
+    """
+    A connected group of linked events of one key (see IncidentClusterer).
+
+    A cluster without members (the continuation of a capped incident, or one
+    reopened from a checkpoint) keeps first/last as an anchor that events
+    within window of it join; its first member replaces them.
+    """
+
+    __slots__ = ("key", "first", "last", "times", "ids", "counters", "bytes", "alerts", "_pending",
+                 "part", "continued_from", "after", "early_ids")
+
+    def __init__(self, key):
+        self.key = key
+        self.first = self.last = None
+        self.times = []
+        self.ids = []
+        self.counters = {}          # summary field -> Counter of its values
+        self.bytes = 0
+        self.alerts = set()
+        self._pending = None        # the first event, summarized only once a second one joins
+        self.part = 1               # 2, 3, ... for the continuations of a capped incident
+        self.continued_from = None  # cluster_id of the previous part
+        self.after = None           # last timestamp of the previous part
+        self.early_ids = []         # members older than that (late events), so a checkpoint can tell them apart
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, ts, event_id, entry):
+        if not self.ids:
+            self.first = self.last = ts
+        elif ts < self.first:
+            self.first = ts
+        elif ts > self.last:
+            self.last = ts
+        self.times.append(ts)
+        self.ids.append(event_id)
+        if self.after is not None and ts <= self.after:
+            self.early_ids.append(event_id)
+        # most events stay alone: summarizing is deferred until the group has two members
+        if len(self.ids) == 1:
+            self._pending = entry
+            return
+        if self._pending is not None:
+            self._summarize(self._pending)
+            self._pending = None
+        self._summarize(entry)
+
+    def _summarize(self, entry):
+        for field in SUMMARY_FIELDS:
+            value = entry.get(field)
+            if value is not None:
+                counter = self.counters.get(field)
+                if counter is None:
+                    counter = self.counters[field] = Counter()
+                counter[value] += 1
+        byte_count = entry.get("byte_count")
+        if isinstance(byte_count, (int, float)):
+            self.bytes += byte_count
+        alerts = entry.get("alerts", entry.get("alert_reason"))
+        if alerts and len(self.alerts) < SUMMARY_ALERTS:
+            if isinstance(alerts, str):
+                alerts = [alerts]
+            if isinstance(alerts, list):
+                self.alerts.update(alert for alert in alerts if isinstance(alert, str))
+
+    def _flush_pending(self):
+        if self._pending is not None:
+            self._summarize(self._pending)
+            self._pending = None
+
+    def merge(self, other):
+        """Absorbs other (an event bridged the two)."""
+        self._flush_pending()
+        other._flush_pending()
+        if other.ids:
+            if self.ids:
+                self.first = min(self.first, other.first)
+                self.last = max(self.last, other.last)
+            else:
+                self.first, self.last = other.first, other.last
+        self.times.extend(other.times)
+        self.ids.extend(other.ids)
+        for field, counter in other.counters.items():
+            self.counters.setdefault(field, Counter()).update(counter)
+        self.bytes += other.bytes
+        self.alerts.update(other.alerts)
+        if self.continued_from is None and other.continued_from is not None:
+            self.part, self.continued_from, self.after = other.part, other.continued_from, other.after
+        self.early_ids.extend(other.early_ids)
+
+    def record(self, key_fields=DEFAULT_KEY_FIELDS, window=DEFAULT_WINDOW_SECONDS, index=None, reason="end"):
+        """
+        The incident record written to linked_alerts.jsonl.
+
+        link_count is the number of pairs the pairwise output would have had
+        (members at most window apart); when an incident is capped, the pairs
+        across the split are not counted in either part.
+        """
+        self._flush_pending()
+        order = sorted(range(len(self.times)), key=self.times.__getitem__)
+        times = [self.times[position] for position in order]
+        member_ids = [self.ids[position] for position in order]
+        window = int(round(window * 1000000))
+        links = start = 0
+        for position, ts in enumerate(times):
+            while times[start] < ts - window:
+                start += 1
+            links += position - start
+        key = self.key if len(key_fields) > 1 else (self.key,)
+        record = {
+            "cluster_id": hashlib.sha1(json.dumps([key, member_ids[0]], default=str).encode()).hexdigest()[:16],
+            "type": "incident_cluster",
+            "alert_reason": "Correlated Incident",
+            "timestamp": format_timestamp(self.first),
+            "start": format_timestamp(self.first),
+            "end": format_timestamp(self.last),
+            "duration_seconds": (self.last - self.first) / 1000000,
+            "event_count": len(member_ids),
+            "link_count": links,
+            "end_reason": reason,
+            "part": self.part,
+            "continued_from": self.continued_from,
+        }
+        record.update(zip(key_fields, key))
+        top = {field: self.counters[field].most_common(SUMMARY_TOP) for field in SUMMARY_FIELDS if field in self.counters}
+        for field, values in top.items():
+            record[field] = values[0][0]     # the most common value, for table columns
+        record["top"] = top
+        record["byte_count"] = self.bytes
+        record["alerts"] = sorted(self.alerts)[:SUMMARY_ALERTS]
+        if index is not None:
+            record["index"] = index
+        record["member_ids"] = member_ids
+        return record
+
+    def state(self):
+        """
+        JSON-serializable state, for checkpoints: the span and continuation, not the members.
+
+        The members are the events of the key within [first, last], except
+        those at or before after (the previous part's) that are not in early_ids;
+        IncidentClusterer.restore() reads them back from the index.
+        """
+        return {"key": self.key, "first": self.first, "last": self.last, "count": len(self.ids), "part": self.part,
+                "continued_from": self.continued_from, "after": self.after, "early_ids": self.early_ids}
+
+    @classmethod
+    def from_state(cls, state):
+        """An empty cluster anchored at the span of a state(); restore() adds the members back."""
+        key = state["key"]
+        cluster = cls(tuple(key) if isinstance(key, list) else key)
+        cluster.first, cluster.last = state["first"], state["last"]
+        cluster.part, cluster.continued_from, cluster.after = state["part"], state["continued_from"], state["after"]
+        return cluster
+
+
+class IncidentClusterer:
+    """
+    Groups events arriving in time order into incidents and returns each one when it can no longer grow.
+
+    An event joins the open incident of its key it is within window of (and
+    merges incidents it bridges). An incident is closed
+
+        - once window + lateness seconds have passed since its last event   (end_reason "idle")
+        - when it reaches max_events events or spans max_duration seconds   ("max_events" / "max_duration")
+        - at the end of the input                                            ("end")
+
+    A capped incident goes on: the next events of its key within window
+    start a new record with part + 1 and continued_from set to the capped
+    record's cluster_id, so a source that never goes quiet is still reported
+    and no record (or checkpoint) grows without bound. Incidents of a single
+    event are not reported. Memory holds the open incidents only.
+
+    Args:
+        window (float): Link distance in seconds (inclusive).
+        lateness (float): How far out of order (seconds) events may arrive.
+        key_fields (tuple): Fields that must be equal.
+        index (str|None): Index the member ids refer to, recorded in every incident.
+        min_events (int): Smallest incident reported.
+        max_events (int): Members after which an incident is closed and continued.
+        max_duration (float): Seconds after which an incident is closed and continued.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW_SECONDS, lateness=0.0, key_fields=DEFAULT_KEY_FIELDS, index=None,
+                 min_events=2, max_events=DEFAULT_MAX_INCIDENT_EVENTS, max_duration=DEFAULT_MAX_INCIDENT_SECONDS):
+        self.window_seconds = window
+        self.window = int(round(window * 1000000))
+        self.lateness = int(round(lateness * 1000000))
+        self.key_fields = key_fields
+        self.index = index
+        self.min_events = min_events
+        self.max_events = max(2, max_events)
+        self.max_duration = int(round(max_duration * 1000000))
+        self._open = {}             # key -> open incidents
+        self._expiry = deque()      # (ts, key) in push order
+        self._restoring = {}        # key -> [(first, last, after, early ids, cluster)] while restore() reads members
+        self.stats = {"pushed": 0, "incidents": 0, "clustered": 0, "single": 0, "capped": 0}
+
+    def push(self, key, ts, event_id, entry):
+        """Adds an event (ts in microseconds since the epoch); returns the records of the incidents it closed."""
+        self.stats["pushed"] += 1
+        closed = self.expire(ts)
+        clusters = self._open.get(key)
+        if clusters is None:
+            clusters = self._open[key] = []
+        window = self.window
+        if len(clusters) == 1:
+            cluster = clusters[0]
+            touching = [cluster] if cluster.first - window <= ts <= cluster.last + window else []
+        else:
+            touching = [cluster for cluster in clusters if cluster.first - window <= ts <= cluster.last + window]
+        if touching:
+            target = touching[0]
+            for cluster in touching[1:]:
+                target.merge(cluster)
+                clusters.remove(cluster)
+        else:
+            target = IncidentCluster(key)
+            clusters.append(target)
+        target.add(ts, event_id, entry)
+        self._expiry.append((ts, key))
+        if len(target) >= self.max_events or target.last - target.first >= self.max_duration:
+            clusters.remove(target)
+            clusters.append(self._cap(target, closed))
+        return closed
+
+    def expire(self, now):
+        """Closes the incidents with no event within window + lateness of now; returns their records."""
+        horizon = now - self.window - self.lateness
+        closed = []
+        expiry = self._expiry
+        while expiry and expiry[0][0] < horizon:
+            _, key = expiry.popleft()
+            clusters = self._open.get(key)
+            if not clusters:
+                continue
+            if len(clusters) == 1:
+                if clusters[0].last < horizon:
+                    del self._open[key]
+                    self._close(clusters[0], closed, "idle")
+                continue
+            for cluster in [cluster for cluster in clusters if cluster.last < horizon]:
+                clusters.remove(cluster)
+                self._close(cluster, closed, "idle")
+            if not clusters:
+                del self._open[key]
+        return closed
+
+    def flush(self):
+        """Closes every open incident (end of input); returns their records in start order."""
+        closed = []
+        for clusters in self._open.values():
+            for cluster in clusters:
+                self._close(cluster, closed, "end")
+        self._open.clear()
+        self._expiry.clear()
+        closed.sort(key=lambda record: record["start"])
+        return closed
+
+    def open_events(self):
+        """Events held in open incidents."""
+        return sum(len(cluster) for clusters in self._open.values() for cluster in clusters)
+
+    def state(self):
+        """The open incidents as JSON-serializable state, for checkpoints (O(open incidents), see IncidentCluster.state)."""
+        return [cluster.state() for clusters in self._open.values() for cluster in clusters]
+
+    @staticmethod
+    def restore_span(state):
+        """(first, last) timestamps the members of a state() lie in, or None if it has none."""
+        spans = [(item["first"], item["last"]) for item in state if item["count"]]
+        if not spans:
+            return None
+        return min(first for first, _ in spans), max(last for _, last in spans)
+
+    def restore(self, state, hits=()):
+        """
+        Reopens the incidents of a state() (after a restart); returns the number of members read back.
+
+        Args:
+            state (list): From state().
+            hits (iterable): The documents ({"_id", "_source"}) of the span restore_span() returns,
+                             e.g. an index scan, without the events that were never pushed.
+        """
+        for item in state:
+            cluster = IncidentCluster.from_state(item)
+            self._open.setdefault(cluster.key, []).append(cluster)
+            self._expiry.append((cluster.last, cluster.key))
+            if item["count"]:
+                self._restoring.setdefault(cluster.key, []).append(
+                    (item["first"], item["last"], item["after"], set(item["early_ids"]), cluster))
+        self._expiry = deque(sorted(self._expiry, key=lambda item: item[0]))
+        restored = 0
+        for hit in hits:
+            entry = hit["_source"]
+            ts = parse_timestamp(entry.get("timestamp"))
+            if ts is not None and self._rebuild(correlation_key(entry, self.key_fields), ts, hit["_id"], entry):
+                restored += 1
+        self._restoring = {}
+        return restored
+
+    def _rebuild(self, key, ts, event_id, entry):
+        for first, last, after, early_ids, cluster in self._restoring.get(key, ()):
+            if first <= ts <= last and (after is None or ts > after or event_id in early_ids):
+                cluster.add(ts, event_id, entry)
+                return True
+        return False
+
+    def _cap(self, cluster, closed):
+        """Closes a cluster that reached max_events / max_duration; returns the empty cluster continuing it."""
+        self.stats["capped"] += 1
+        reason = "max_events" if len(cluster) >= self.max_events else "max_duration"
+        record = self._close(cluster, closed, reason)
+        successor = IncidentCluster(cluster.key)
+        successor.first = successor.last = successor.after = cluster.last
+        successor.part = cluster.part + 1
+        successor.continued_from = None if record is None else record["cluster_id"]
+        return successor
+
+    def _close(self, cluster, closed, reason):
+        # the continuation of a capped incident is reported however small, so the parts add up to the incident
+        if len(cluster) < (self.min_events if cluster.continued_from is None else 1):
+            self.stats["single"] += len(cluster)
+            return None
+        self.stats["incidents"] += 1
+        self.stats["clustered"] += len(cluster)
+        record = cluster.record(self.key_fields, self.window_seconds, self.index, reason)
+        closed.append(record)
+        return record
+
+
+def cluster_incidents(hits, window=DEFAULT_WINDOW_SECONDS, key_fields=DEFAULT_KEY_FIELDS, index=None, skipped=None,
+                      lateness=0.0, max_events=DEFAULT_MAX_INCIDENT_EVENTS, max_duration=DEFAULT_MAX_INCIDENT_SECONDS):
+    """
+    Yields incident records for Elasticsearch hits ({"_id", "_source"}) in time order.
+
+    Args:
+        hits (iterable): Hits sorted by timestamp.
+        skipped (list|None): Receives the sources whose timestamp could not be parsed.
+        max_events (int): Members after which an incident is closed and continued (see IncidentClusterer).
+        max_duration (float): Seconds after which an incident is closed and continued.
+    """
+    clusterer = IncidentClusterer(window, lateness, key_fields, index, max_events=max_events, max_duration=max_duration)
+    for hit in hits:
+        entry = hit["_source"]
+        ts = parse_timestamp(entry.get("timestamp"))
+        if ts is None:
+            if skipped is not None:
+                skipped.append(entry)
+            continue
+        yield from clusterer.push(correlation_key(entry, key_fields), ts, hit["_id"], entry)
+    yield from clusterer.flush()
@@ -1,47 +1,353 @@
 # correlator.py
+"""
+Groups events from the same source IP within 5 minutes into incidents (correlation.py).
+
+    python correlator.py              # one pass over the whole index, rewrites linked_alerts.jsonl
+    python correlator.py --last 86400 # ... over the last 24 hours (or --start/--end ISO timestamps)
+    python correlator.py --follow     # service: tails forensic-logs and appends each incident once
+
+linked_alerts.jsonl holds one record per incident, a connected group of
+linked events: its member event ids, time span, event and link counts and a
+summary (most common destinations, ports, protocols, bytes, alerts). The
+dashboards fetch the member documents only when an incident is expanded.
+
+A pass reads every document of the time range in timestamp order, with
+parallel slices of one point in time (es_scan.sliced_scan), and streams them
+through the incident clusterer, writing each incident as soon as it is
+closed, so memory holds the open incidents, not the whole range.
+
+In --follow mode the index is read with a point in time + search_after
+(es_scan.py) from a cursor on the event timestamp. Each new event joins the
+open incident of its source IP (or starts one); an incident is appended to
+the file once 5 minutes (+ lateness) have passed without a new event, or when
+it reaches an hour or 10000 events (it then goes on in a new record that
+names the previous one in "continued_from"). After every poll the cursor and
+the open incidents are checkpointed (logs/correlator_checkpoint.json), so a
+restart continues from the cursor with the same open incidents instead of
+rescanning the index. The checkpoint holds each incident's span, not its
+members; a restart reads them back from the index (at most one capped
+incident's span).
+
+Events indexed late (the agent delivers its disk-queue backlog after an
+outage) are still picked up if their timestamp is at most --lateness seconds
+behind the cursor: every poll re-reads that band and skips the documents it
+has already seen.
+"""
+import argparse
 import json
 import os
+import sys
+import time
+from collections import deque
+
 from elasticsearch import Elasticsearch
-from datetime import datetime, timedelta
 
-ES_HOST = "http://192.168.49.2:32304"
+from correlation import (DEFAULT_WINDOW_SECONDS, IncidentClusterer, cluster_incidents, correlation_key,
+                         parse_timestamp)
+from es_scan import (DEFAULT_PAGE_SIZE, DEFAULT_SLICES, SORT_RESOLUTION_SECONDS, scan, scan_pages, sliced_scan,
+                     time_range_query)
+
+ES_HOST = os.environ.get("FPM_ES_HOST", "http://192.168.49.2:32304")
 ES_INDEX = "forensic-logs"
 LINKED_ALERTS_FILE = "logs/linked_alerts.jsonl"
+CHECKPOINT_FILE = "logs/correlator_checkpoint.json"
+
+# وضع المتابعة: الفاصل بين الاستعلامات، والتأخر المسموح لأحداث تصل متأخرة (بالثواني)
+POLL_INTERVAL = float(os.environ.get("FPM_CORRELATOR_POLL_INTERVAL", "5"))
+LATENESS = float(os.environ.get("FPM_CORRELATOR_LATENESS", "60"))
+# حادث أطول من هذا (بالثواني أو بعدد الأحداث) يُكتب ويُكمل في سجل جديد
+MAX_INCIDENT_SECONDS = float(os.environ.get("FPM_CORRELATOR_MAX_INCIDENT_SECONDS", "3600"))
+MAX_INCIDENT_EVENTS = int(os.environ.get("FPM_CORRELATOR_MAX_INCIDENT_EVENTS", "10000"))
+# نقطة الحفظ: في نهاية كل استعلام، وكل هذا العدد من الثواني أثناء استعلام طويل
+CHECKPOINT_INTERVAL = float(os.environ.get("FPM_CORRELATOR_CHECKPOINT_INTERVAL", "30"))
+# سجل المعرفات المقروءة يُعاد كتابته فقط عندما يتجاوز ضعف المعرفات الحية بهذا العدد
+SEEN_JOURNAL_SLACK = 10000
+
+
+def connect():
+    es = Elasticsearch(ES_HOST)
+    if not es.ping():
+        print("❌ لا يمكن الاتصال بـ Elasticsearch")
+        sys.exit(1)
+    return es
+
+
+# تحليل لمرة واحدة على كل السجلات في المدى الزمني، وإعادة كتابة الملف
+def correlate_range(es, start=None, end=None, output=LINKED_ALERTS_FILE, slices=DEFAULT_SLICES):
+    """
+    Groups the events with start <= timestamp < end into incidents and rewrites output; returns the incidents.
+
+    Args:
+        start (int|None): Microseconds since the epoch; None = from the first event.
+        end (int|None): Microseconds since the epoch; None = up to the last event.
+        slices (int): Parallel PIT slices.
+    """
+    hits = sliced_scan(es, ES_INDEX, time_range_query(start, end), slices=slices)
+
+    # أنشئ المجلد إن لم يكن موجود
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+
+    # قم بالتحليل: نفس عنوان المصدر خلال 5 دقائق (correlation.py)، سجل واحد لكل حادث
+    incidents = 0
+    skipped = []
+    with open(output, "w") as f:
+        for record in cluster_incidents(hits, index=ES_INDEX, skipped=skipped, lateness=SORT_RESOLUTION_SECONDS,
+                                        max_events=MAX_INCIDENT_EVENTS, max_duration=MAX_INCIDENT_SECONDS):
+            f.write(json.dumps(record) + "\n")
+            incidents += 1
+    if skipped:
+        print(f"⚠️ {len(skipped)} سجل بدون timestamp صالح")
+
+    print(f"✅ تم حفظ {incidents} حادث مترابط في {output}")
+    return incidents
+
+
+class StreamingCorrelator:
+    """
+    Tails an index and appends an incident record for every incident that closes.
+
+    The checkpoint is written at the end of every poll (and every
+    checkpoint_interval seconds during a long one). It holds the cursor, the
+    open incidents' spans, the size of the output file and of the seen-id
+    journal: the ids pushed within lateness of the cursor are appended to the
+    journal once, as they arrive, instead of being rewritten with every
+    checkpoint, and the journal is rewritten only when most of it has fallen
+    out of the lateness band. A restart truncates the output and the journal
+    to the checkpointed sizes, so the records and ids written after it are
+    produced again, not twice.
+
+    Args:
+        es (Elasticsearch): Client.
+        index (str): Index to tail.
+        output (str): JSONL file incidents are appended to.
+        checkpoint (str): JSON file holding the cursor and the open incidents.
+        window (float): Link distance in seconds.
+        lateness (float): How far behind the cursor (seconds) newly indexed events are still picked up.
+        page_size (int): Hits per search request.
+        max_events (int): Events after which an incident is appended and continued in a new record.
+        max_duration (float): Seconds after which an incident is appended and continued in a new record.
+        checkpoint_interval (float): Seconds between checkpoints within one poll.
+    """
+
+    def __init__(self, es, index=ES_INDEX, output=LINKED_ALERTS_FILE, checkpoint=CHECKPOINT_FILE,
+                 window=DEFAULT_WINDOW_SECONDS, lateness=LATENESS, page_size=DEFAULT_PAGE_SIZE,
+                 max_events=MAX_INCIDENT_EVENTS, max_duration=MAX_INCIDENT_SECONDS,
+                 checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.es = es
+        self.index = index
+        self.output = output
+        self.checkpoint = checkpoint
+        self.lateness = int(round(min(lateness, window) * 1000000))
+        self.page_size = page_size
+        self.checkpoint_interval = checkpoint_interval
+        self.clusterer = IncidentClusterer(window, min(lateness, window), index=index, max_events=max_events,
+                                           max_duration=max_duration)
+        self.cursor = None          # newest event timestamp processed, microseconds since the epoch
+        self.seen = {}              # _id -> timestamp of the events processed within lateness of the cursor
+        self._seen_order = deque()  # (timestamp, _id) in push order, to prune seen
+        self._seen_new = []         # [_id, timestamp] pushed since the last checkpoint
+        self._journal = None        # file name of the seen-id journal (next to the checkpoint)
+        self._journal_entries = 0   # ids in the journal, pruned or not
+        self._checkpointed = time.monotonic()
+        self.stats = {"events": 0, "incidents": 0, "skipped": 0, "polls": 0, "checkpoints": 0}
+
+    def start(self, since=None):
+        """Loads the checkpoint (cursor and open incidents), or starts since seconds ago."""
+        state = self._load_checkpoint()
+        if state is not None:
+            self.cursor = state["cursor"]
+            self._truncate(self.output, state.get("output_size"))
+            self._load_seen(state)
+            self.clusterer.restore(state.get("open", []), self._pushed_hits(state.get("open", [])))
+            print(f"[*] Resuming from checkpoint {self.checkpoint} ({len(self.seen)} recent event(s) known, "
+                  f"{self.clusterer.open_events()} event(s) in open incidents)")
+        else:
+            since = DEFAULT_WINDOW_SECONDS if since is None else since
+            self.cursor = int((time.time() - since) * 1000000)
+            print(f"[*] No checkpoint, starting {since:g}s back")
+        return self
+
+    def poll(self, now=None):
+        """
+        Reads everything indexed since the last poll and appends the incidents that closed; returns the new events.
+
+        Args:
+            now (int|None): Current time in microseconds since the epoch; incidents idle for
+                            window + lateness before it are closed even if no new event arrives.
+        """
+        self.stats["polls"] += 1
+        new_events = 0
+        changed = False
+        query = time_range_query(self.cursor - self.lateness)
+        for hits in scan_pages(self.es, self.index, query, page_size=self.page_size):
+            records = []
+            for hit in hits:
+                if hit["_id"] in self.seen:
+                    continue
+                source = hit["_source"]
+                ts = parse_timestamp(source.get("timestamp"))
+                if ts is None:
+                    self.stats["skipped"] += 1
+                    continue
+                self._remember(hit["_id"], ts)
+                new_events += 1
+                records.extend(self.clusterer.push(correlation_key(source), ts, hit["_id"], source))
+                if ts > self.cursor:
+                    self.cursor = ts
+            self._append(records)
+            changed = changed or bool(records) or bool(self._seen_new)
+            if changed and time.monotonic() - self._checkpointed >= self.checkpoint_interval:
+                self._save_checkpoint()
+                changed = False
+        now = int(time.time() * 1000000) if now is None else now
+        records = self.clusterer.expire(max(now, self.cursor))
+        self._append(records)
+        if changed or records:
+            self._save_checkpoint()
+        self.stats["events"] += new_events
+        return new_events
+
+    def run(self, poll_interval=POLL_INTERVAL):
+        """Polls forever; Elasticsearch errors are reported and retried on the next poll."""
+        while True:
+            try:
+                new_events = self.poll()
+                if new_events:
+                    print(f"[+] {new_events} new event(s), {self.stats['incidents']} incident(s) so far, "
+                          f"{self.clusterer.open_events()} event(s) in open incidents")
+            except Exception as e:
+                print(f"[!] Correlation poll failed: {e}", file=sys.stderr)
+            time.sleep(poll_interval)
+
+    def _remember(self, event_id, ts):
+        self.seen[event_id] = ts
+        self._seen_order.append((ts, event_id))
+        self._seen_new.append([event_id, ts])
+
+    def _pushed_hits(self, open_state):
+        """The documents of the open incidents' span that were pushed before the checkpoint (for restore())."""
+        span = IncidentClusterer.restore_span(open_state)
+        if span is None:
+            return
+        horizon = self.cursor - self.lateness
+        for hit in scan(self.es, self.index, time_range_query(span[0], span[1] + 1), page_size=self.page_size):
+            # within the lateness band only the events already seen; the others are read by the next poll
+            if hit["_id"] in self.seen:
+                yield hit
+            else:
+                ts = parse_timestamp(hit["_source"].get("timestamp"))
+                if ts is not None and ts < horizon:
+                    yield hit
+
+    def _append(self, records):
+        if records:
+            with open(self.output, "a") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+            self.stats["incidents"] += len(records)
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _truncate(path, size):
+        """Drops what was written to path after the checkpoint that recorded its size."""
+        if size is not None and os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    def _load_seen(self, state):
+        self.seen, self._seen_order, self._seen_new = {}, deque(), []
+        self._journal, self._journal_entries = state.get("seen_file"), 0
+        if self._journal is None:
+            # a checkpoint written before the journal: the ids are in it
+            self.seen = dict(state.get("seen", {}))
+            self._seen_order = deque(sorted((ts, event_id) for event_id, ts in self.seen.items()))
+            return
+        path = os.path.join(os.path.dirname(self.checkpoint), self._journal)
+        self._truncate(path, state["seen_size"])
+        horizon = self.cursor - self.lateness
+        with open(path) as f:
+            for line in f:
+                for event_id, ts in json.loads(line):
+                    self._journal_entries += 1
+                    if ts >= horizon:
+                        self.seen[event_id] = ts
+        self._seen_order = deque(sorted((ts, event_id) for event_id, ts in self.seen.items()))
+
+    def _save_checkpoint(self):
+        horizon = self.cursor - self.lateness
+        order = self._seen_order
+        while order and order[0][0] < horizon:
+            self.seen.pop(order.popleft()[1], None)
+        directory = os.path.dirname(self.checkpoint)
+        os.makedirs(directory or ".", exist_ok=True)
+        # the journal holds each id once; it is rewritten (under a new name) only once it is mostly stale
+        previous = None
+        if self._journal is None or self._journal_entries > 2 * len(self.seen) + SEEN_JOURNAL_SLACK:
+            previous, self._journal = self._journal, f"{os.path.basename(self.checkpoint)}.seen.{time.time_ns()}"
+            entries, mode = [[event_id, ts] for event_id, ts in self.seen.items()], "w"
+            self._journal_entries = 0
+        else:
+            entries, mode = [entry for entry in self._seen_new if entry[1] >= horizon], "a"
+        path = os.path.join(directory, self._journal)
+        with open(path, mode) as f:
+            if entries:
+                f.write(json.dumps(entries) + "\n")
+            seen_size = f.tell()
+        self._journal_entries += len(entries)
+        self._seen_new = []
+        output_size = os.path.getsize(self.output) if os.path.exists(self.output) else 0
+        with open(self.checkpoint + ".tmp", "w") as f:
+            json.dump({"cursor": self.cursor, "open": self.clusterer.state(), "output_size": output_size,
+                       "seen_file": self._journal, "seen_size": seen_size}, f)
+        os.replace(self.checkpoint + ".tmp", self.checkpoint)
+        self.stats["checkpoints"] += 1
+        if previous is not None and previous != self._journal:
+            try:
+                os.remove(os.path.join(directory, previous))
+            except OSError:
+                pass
+        self._checkpointed = time.monotonic()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FPM incident correlator")
+    parser.add_argument("--follow", action="store_true", help="keep tailing the index and append new incidents")
+    parser.add_argument("--start", help="one pass: first timestamp (ISO 8601, UTC)")
+    parser.add_argument("--end", help="one pass: end timestamp, exclusive (ISO 8601, UTC)")
+    parser.add_argument("--last", type=float, help="one pass: the last LAST seconds (instead of --start)")
+    parser.add_argument("--slices", type=int, default=DEFAULT_SLICES, help="one pass: parallel PIT slices")
+    parser.add_argument("--since", type=float, default=None,
+                        help="without a checkpoint, start this many seconds back (default: one window)")
+    parser.add_argument("--lateness", type=float, default=LATENESS,
+                        help="seconds behind the cursor late-indexed events are still picked up (max one window)")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL)
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE)
+    parser.add_argument("--output", default=LINKED_ALERTS_FILE)
+    args = parser.parse_args()
+
+    bounds = []
+    for name in ("start", "end"):
+        value = getattr(args, name)
+        bounds.append(None if value is None else parse_timestamp(value))
+        if value is not None and bounds[-1] is None:
+            parser.error(f"--{name}: not an ISO 8601 timestamp: {value}")
+    if args.last is not None:
+        bounds[0] = int((time.time() - args.last) * 1000000)
 
-# اتصل بـ Elasticsearch
-es = Elasticsearch(ES_HOST)
-if not es.ping():
-    print("❌ لا يمكن الاتصال بـ Elasticsearch")
-    exit()
-
-# ابحث عن آخر 100 سجل
-res = es.search(index=ES_INDEX, body={"query": {"match_all": {}}}, size=100)
-
-# اجمع البيانات
-entries = [hit["_source"] for hit in res["hits"]["hits"]]
-
-# قم بالتحليل البسيط
-linked_alerts = []
-for i, entry in enumerate(entries):
-    for j in range(i + 1, len(entries)):
-        other = entries[j]
-        if (
-            entry["src_ip"] == other["src_ip"] and
-            abs(datetime.fromisoformat(entry["timestamp"]) - datetime.fromisoformat(other["timestamp"])) <= timedelta(minutes=5)
-        ):
-            linked_alert = {
-                "timestamp": entry["timestamp"],
-                "entry": entry,
-                "linked_with": other
-            }
-            linked_alerts.append(linked_alert)
-
-# أنشئ المجلد إن لم يكن موجود
-os.makedirs("logs", exist_ok=True)
-
-# احفظ النتائج
-with open(LINKED_ALERTS_FILE, "w") as f:
-    for alert in linked_alerts:
-        f.write(json.dumps(alert) + "\n")
-
-print(f"✅ تم حفظ {len(linked_alerts)} حادث مترابط في {LINKED_ALERTS_FILE}")
+    # اتصل بـ Elasticsearch
+    es = connect()
+    if args.follow:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        correlator = StreamingCorrelator(es, output=args.output, checkpoint=args.checkpoint, lateness=args.lateness)
+        try:
+            correlator.start(args.since).run(args.poll_interval)
+        except KeyboardInterrupt:
+            print(f"[*] Stopped: {correlator.stats}")
+    else:
+        correlate_range(es, *bounds, output=args.output, slices=args.slices)
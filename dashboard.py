@@ -3,17 +3,22 @@ from flask import Flask, render_template_string, redirect, url_for, request, sen
 from elasticsearch import Elasticsearch
 import json
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 import io
 import csv
 import sys
 
+from correlation import cluster_incidents
+from es_scan import SORT_RESOLUTION_SECONDS, get_documents, sliced_scan, time_range_query
+
 # Elasticsearch settings
 # عند التشغيل محليًا، يجب استخدام عنوان IP ومنفذ NodePort لـ Elasticsearch في Minikube.
 # قم بتغيير هذا العنوان بعد الحصول عليه من 'minikube service elasticsearch --url'
 ES_HOST = "http://192.168.49.2:30574" # <-- تم تحديث هذا السطر بالـ IP والمنفذ الصحيحين لديك
 ES_INDEX = "forensic-logs"
 LINKED_ALERTS_FILE = "logs/linked_alerts.jsonl"
+CORRELATION_HOURS = 24 # Default time range of "Correlate Incidents" (the form can override it)
+MAX_EXPANDED_MEMBERS = 1000 # Member events fetched when an incident is expanded
 
 # Initialize Elasticsearch client
 es = None
@@ -193,6 +198,7 @@ HTML_TEMPLATE = """
                 <button type="submit">⚙️ Generate Test Data</button>
             </form>
             <form method="post" action="/correlate">
+                <input type="text" name="hours" placeholder="Last hours ({{ correlation_hours }})" size="12">
                 <button type="submit">🔄 Correlate Incidents</button>
             </form>
         </div>
@@ -215,7 +221,7 @@ HTML_TEMPLATE = """
                         <td>{{ alert.src_ip }}</td>
                         <td>{{ alert.dst_ip }}</td>
                         <td>{{ alert.dst_port }}</td>
-                        <td>{{ alert.alert_reason }}</td>
+                        <td>{% if alert.link %}<a href="{{ alert.link }}">{{ alert.alert_reason }}</a>{% else %}{{ alert.alert_reason }}{% endif %}</td>
                     </tr>
                     {% endfor %}
                 {% else %}
@@ -451,33 +457,72 @@ def index():
     else:
         alerts_data = [{"timestamp": "Error", "src_ip": "", "dst_ip": "", "dst_port": "", "alert_reason": "Elasticsearch not available"}]
 
-    return render_template_string(HTML_TEMPLATE, alerts=alerts_data)
+    return render_template_string(HTML_TEMPLATE, alerts=alerts_data, correlation_hours=CORRELATION_HOURS)
 
-@app.route('/linked')
-def linked_incidents():
-    """Renders a dashboard page showing correlated incidents from a local JSONL file."""
-    linked_alerts = []
+def load_incidents():
+    """Reads the incident records (one per correlated group, see correlation.py) from the local JSONL file."""
+    incidents = []
     if os.path.exists(LINKED_ALERTS_FILE):
         with open(LINKED_ALERTS_FILE, 'r') as file:
             for line in file:
                 try:
-                    alert = json.loads(line.strip())
-                    entry = alert.get("entry", {})
-                    linked_alerts.append({
-                        "timestamp": alert.get("timestamp"),
-                        "src_ip": entry.get("src_ip"),
-                        "dst_ip": entry.get("dst_ip"),
-                        "dst_port": entry.get("dst_port"),
-                        "alert_reason": "🔗 Linked Incident" # Keep emoji for visual distinction
-                    })
+                    incidents.append(json.loads(line.strip()))
                 except Exception as e:
                     print(f"Error parsing linked alert: {e} - Line: {line.strip()}", file=sys.stderr)
                     continue
     else:
         print(f"Warning: {LINKED_ALERTS_FILE} not found.", file=sys.stderr)
+    return incidents
+
+@app.route('/linked')
+def linked_incidents():
+    """Renders a dashboard page with one row per correlated incident from a local JSONL file."""
+    linked_alerts = []
+    for incident in load_incidents():
+        linked_alerts.append({
+            "timestamp": incident.get("start"),
+            "src_ip": incident.get("src_ip"),
+            "dst_ip": incident.get("dst_ip"), # Most common destination of the incident
+            "dst_port": incident.get("dst_port"),
+            # Keep emoji for visual distinction; the link expands the incident into its events
+            "alert_reason": f"🔗 {incident.get('event_count')} events, {incident.get('link_count')} links over {incident.get('duration_seconds', 0):.0f}s"
+                            + (f" (part {incident['part']})" if incident.get("part", 1) > 1 else ""),
+            "link": url_for('incident_members', cluster_id=incident.get("cluster_id"))
+        })
 
     # Use the same HTML template for linked incidents
-    return render_template_string(HTML_TEMPLATE, alerts=linked_alerts)
+    return render_template_string(HTML_TEMPLATE, alerts=linked_alerts, correlation_hours=CORRELATION_HOURS)
+
+@app.route('/linked/<cluster_id>')
+def incident_members(cluster_id):
+    """Expands one incident: fetches its member events from Elasticsearch by id."""
+    incident = next((item for item in load_incidents() if item.get("cluster_id") == cluster_id), None)
+    if incident is None:
+        return redirect(url_for('linked_incidents'))
+
+    members = []
+    if es:
+        try:
+            ids = incident.get("member_ids", [])[:MAX_EXPANDED_MEMBERS]
+            for hit in get_documents(es, incident.get("index", ES_INDEX), ids):
+                doc = hit['_source']
+                alert_reason = "(Live Packet)"
+                if "alerts" in doc and doc["alerts"]:
+                    alert_reason = doc["alerts"][0]
+                members.append({
+                    "timestamp": doc.get("timestamp"),
+                    "src_ip": doc.get("src_ip"),
+                    "dst_ip": doc.get("dst_ip"),
+                    "dst_port": doc.get("dst_port"),
+                    "alert_reason": doc.get("alert_reason", alert_reason)
+                })
+        except Exception as e:
+            print(f"Failed to expand incident {cluster_id}: {e}", file=sys.stderr)
+            members = [{"timestamp": "Error", "src_ip": "", "dst_ip": "", "dst_port": "", "alert_reason": f"Data load failed: {e}"}]
+    else:
+        members = [{"timestamp": "Error", "src_ip": "", "dst_ip": "", "dst_port": "", "alert_reason": "Elasticsearch not available"}]
+
+    return render_template_string(HTML_TEMPLATE, alerts=members, correlation_hours=CORRELATION_HOURS)
 
 @app.route('/generate', methods=['POST'])
 def generate():
@@ -509,49 +554,26 @@ def correlate_incidents():
     """
     if es:
         try:
-            # Load latest 100 records from Elasticsearch
-            res = es.search(index=ES_INDEX, body={"query": {"match_all": {}}}, size=100)
-            entries = [hit["_source"] for hit in res["hits"]["hits"]]
-
-            linked_alerts = []
-            # Simple correlation logic: same source IP within 5 minutes
-            for i, entry in enumerate(entries):
-                try:
-                    entry_timestamp = datetime.fromisoformat(entry["timestamp"].replace('Z', '+00:00'))
-                except ValueError:
-                    print(f"Warning: Invalid timestamp format for entry: {entry.get('timestamp')}", file=sys.stderr)
-                    continue
+            hours = float(request.form.get("hours") or CORRELATION_HOURS)
+            start = int((datetime.now().timestamp() - hours * 3600) * 1000000) # Microseconds since the epoch
+            # Page through every record of the time range (parallel PIT slices, timestamp order)
+            hits = sliced_scan(es, ES_INDEX, time_range_query(start))
 
-                for j in range(i + 1, len(entries)):
-                    other = entries[j]
-                    try:
-                        other_timestamp = datetime.fromisoformat(other["timestamp"].replace('Z', '+00:00'))
-                    except ValueError:
-                        print(f"Warning: Invalid timestamp format for other entry: {other.get('timestamp')}", file=sys.stderr)
-                        continue
-
-                    # Correlation condition: same source IP and within 5 minutes
-                    if (
-                        entry.get("src_ip") == other.get("src_ip") and
-                        abs(entry_timestamp - other_timestamp) <= timedelta(minutes=5)
-                    ):
-                        linked_alert = {
-                            "timestamp": datetime.now().isoformat(timespec='microseconds') + "Z", # Timestamp of correlation event
-                            "entry": entry,
-                            "linked_with": other,
-                            "alert_reason": "Correlated Incident" # Add a reason for linked incidents
-                        }
-                        linked_alerts.append(linked_alert)
-            
             # Ensure the logs directory exists
             os.makedirs("logs", exist_ok=True)
 
-            # Save results to linked_alerts.jsonl
+            # Correlation: same source IP within 5 minutes, one record per incident (connected group of
+            # linked events, see correlation.py); incidents are written as they close
+            incidents = 0
+            skipped = []
             with open(LINKED_ALERTS_FILE, "w") as f:
-                for alert in linked_alerts:
-                    f.write(json.dumps(alert) + "\n")
-            
-            print(f"Successfully correlated {len(linked_alerts)} incidents and saved to {LINKED_ALERTS_FILE}", file=sys.stderr)
+                for incident in cluster_incidents(hits, index=ES_INDEX, skipped=skipped, lateness=SORT_RESOLUTION_SECONDS):
+                    f.write(json.dumps(incident) + "\n")
+                    incidents += 1
+            for entry in skipped:
+                print(f"Warning: Invalid timestamp format for entry: {entry.get('timestamp')}", file=sys.stderr)
+
+            print(f"Successfully correlated {incidents} incidents over the last {hours:g} hours and saved to {LINKED_ALERTS_FILE}", file=sys.stderr)
 
         except Exception as e:
             print(f"Failed to perform correlation: {e}", file=sys.stderr)
@@ -0,0 +1,141 @@
+# dedup.py
+"""
+Idempotent ingestion: event identity, duplicate suppression and document IDs.
+
+Every event is identified by its agent-supplied "event_id" (scoped by the
+sending host) or, when it has none, by a hash of its canonical JSON, which is
+then stored as its event_id. From that identity come:
+
+    - a 64-bit key remembered by Deduplicator for a sliding time window, so an
+      agent retry arriving at the same process is dropped before it is queued;
+    - a deterministic Elasticsearch _id (document_id()), so a retry that gets
+      past the window, reaches another pre-fork worker or is replayed from the
+      spool overwrites the original document instead of adding a copy.
+
+Deduplicator keeps exact keys (no false positives, so no unique event is ever
+dropped) in two generations of sets: keys live between one and two windows,
+and a generation that reaches half of max_keys is retired early to bound memory.
+"""
+import hashlib
+import threading
+import time
+
+import metrics
+from ingest import json_dumps
+
+DUPLICATES = metrics.counter(
+    "fpm_dedup_duplicates_total", "Events dropped because their event_id was seen within the window")
+EARLY_ROTATIONS = metrics.counter(
+    "fpm_dedup_early_rotations_total", "Dedup generations retired before the window elapsed (max_keys reached)")
+TRACKED_KEYS = metrics.gauge(
+    "fpm_dedup_tracked_keys", "Event keys currently remembered for deduplication")
+
+
+def content_id(event):
+    """Hash of the event's canonical (sorted-key) JSON, used when the agent sent no event_id."""
+    return hashlib.blake2b(json_dumps(event, sort_keys=True), digest_size=10).hexdigest()
+
+
+def assign_event_id(event):
+    """Gives an event without one a content-derived event_id; returns the event_id."""
+    event_id = event.get("event_id")
+    if event_id is None or event_id == "":
+        event_id = event["event_id"] = content_id(event)
+    return event_id
+
+
+def _digest(event):
+    host = event.get("host") or event.get("source") or ""
+    identity = f"{host}\x00{event.get('event_id')}".encode("utf-8", "surrogatepass")
+    return hashlib.blake2b(identity, digest_size=16).digest()
+
+
+def document_id(event):
+    """Deterministic Elasticsearch _id for an event (assigning its event_id first if needed)."""
+    assign_event_id(event)
+    return _digest(event).hex()
+
+
+class Deduplicator:
+    """
+    Remembers event keys for a sliding time window.
+
+    Args:
+        window (float): Seconds a key is guaranteed to be remembered; 0 only assigns event_ids.
+        max_keys (int): Upper bound on remembered keys (both generations together).
+    """
+
+    def __init__(self, window=600.0, max_keys=1_000_000):
+        self.window = window
+        self.max_keys = max_keys
+        self._current = set()
+        self._previous = set()
+        self._rotated = time.monotonic()
+        self._lock = threading.Lock()
+        TRACKED_KEYS.set_function(lambda: len(self._current) + len(self._previous))
+
+    def filter(self, events):
+        """
+        Drops events already seen in the window and remembers the rest.
+
+        Events without an event_id get a content-derived one (see assign_event_id).
+
+        Returns:
+            tuple: (fresh_events, keys) where keys can be handed to forget() if
+                   the fresh events end up not being accepted.
+        """
+        if self.window <= 0:
+            for event in events:
+                assign_event_id(event)
+            return events, []
+        fresh = []
+        keys = []
+        duplicates = 0
+        for event in events:
+            assign_event_id(event)
+            keys.append(int.from_bytes(_digest(event)[:8], "big"))
+        with self._lock:
+            self._maybe_rotate()
+            batch_keys = []
+            batch = set()
+            for event, key in zip(events, keys):
+                if key in self._current or key in self._previous or key in batch:
+                    duplicates += 1
+                    continue
+                batch.add(key)
+                fresh.append(event)
+                batch_keys.append(key)
+            # remembered only after the whole batch was checked, with the limit applied per key: one large
+            # batch must neither carry the generation past half of max_keys nor retire keys it still checks
+            limit = max(1, self.max_keys // 2)
+            for key in batch_keys:
+                self._current.add(key)
+                if len(self._current) >= limit:
+                    self._rotate_early()
+        if duplicates:
+            DUPLICATES.inc(duplicates)
+        return fresh, batch_keys
+
+    def forget(self, keys):
+        """Un-remembers keys of events that were rejected after filter(), so their retry is accepted."""
+        with self._lock:
+            for key in keys:
+                self._current.discard(key)
+                self._previous.discard(key)
+
+    def _maybe_rotate(self):
+        now = time.monotonic()
+        elapsed = now - self._rotated
+        if elapsed >= 2 * self.window:
+            self._previous, self._current = set(), set()
+            self._rotated = now
+        elif elapsed >= self.window:
+            self._previous, self._current = self._current, set()
+            self._rotated = now
+        elif len(self._current) >= self.max_keys // 2:
+            self._rotate_early()
+
+    def _rotate_early(self):
+        EARLY_ROTATIONS.inc()
+        self._previous, self._current = self._current, set()
+        self._rotated = time.monotonic()
@@ -0,0 +1,195 @@
+# es_bulk.py
+"""
+Background bulk indexer for Elasticsearch.
+
+Events are collected in a bounded in-memory buffer and written with the bulk
+API by a single background thread, either when max_batch events are waiting
+or when flush_interval seconds have passed since the last flush. Items that
+fail with a retryable status (429 / 5xx) are retried with exponential backoff;
+anything still failing after max_retries is counted and dropped (the local
+traffic log keeps a copy). No refresh is forced: documents become searchable
+on the index's normal refresh interval.
+"""
+import threading
+import time
+from collections import deque
+
+import log
+import metrics
+
+logger = log.get_logger("es_bulk")
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# every series is split by target index (forensic-logs events, fpm-agent-health heartbeats, ...)
+BULK_FLUSH_SECONDS = metrics.histogram(
+    "fpm_es_bulk_flush_seconds", "Wall time of one Elasticsearch bulk request", labelnames=("index",))
+BULK_BATCH_SIZE = metrics.histogram(
+    "fpm_es_bulk_batch_size", "Number of events per bulk flush", labelnames=("index",),
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000))
+BULK_INDEXED = metrics.counter(
+    "fpm_es_bulk_indexed_total", "Events successfully indexed through the bulk API", labelnames=("index",))
+BULK_RETRIED = metrics.counter(
+    "fpm_es_bulk_retried_total", "Events re-sent after a retryable bulk failure", labelnames=("index",))
+BULK_FAILED = metrics.counter(
+    "fpm_es_bulk_failed_total", "Events dropped after a permanent or exhausted bulk failure",
+    labelnames=("index",))
+BULK_BUFFERED = metrics.gauge(
+    "fpm_es_bulk_buffered_events", "Events waiting in the bulk indexer buffer", labelnames=("index",))
+
+class BulkIndexer:
+    """
+    Buffers documents and indexes them in batches from a background thread.
+
+    Args:
+        es (Elasticsearch): Client used for the bulk requests.
+        index (str): Target index name.
+        max_batch (int): Flush as soon as this many events are buffered.
+        flush_interval (float): Flush at least this often (seconds) when events are waiting.
+        max_buffer (int): Upper bound on buffered events; add() blocks when it is reached.
+        max_retries (int): Retry attempts for retryable item or request failures.
+        retry_backoff (float): Initial backoff in seconds, doubled on each retry.
+        id_func (callable|None): Returns the _id for a document (see dedup.document_id), so
+                                 re-sent documents overwrite instead of duplicating; None lets
+                                 Elasticsearch generate IDs.
+    """
+
+    def __init__(self, es, index="forensic-logs", max_batch=500, flush_interval=1.0,
+                 max_buffer=10000, max_retries=3, retry_backoff=0.5, id_func=None):
+        self.es = es
+        self.index = index
+        self.id_func = id_func
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._buffer = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = None
+        BULK_BUFFERED.set_function(lambda: len(self._buffer), index=index)
+
+    def start(self):
+        """Starts the background flush thread (idempotent)."""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="fpm-bulk-indexer", daemon=True)
+            self._thread.start()
+
+    def add(self, document, timeout=None):
+        """
+        Queues a document for indexing.
+
+        Blocks while the buffer is full so producers slow down instead of
+        growing memory without bound.
+
+        Returns:
+            bool: False if the buffer stayed full for `timeout` seconds or the
+                  indexer is closed, True otherwise.
+        """
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: self._closed or len(self._buffer) < self.max_buffer, timeout):
+                return False
+            if self._closed:
+                return False
+            self._buffer.append(document)
+            if len(self._buffer) >= self.max_batch:
+                self._cond.notify_all()
+            return True
+
+    def close(self, timeout=10.0):
+        """Stops the flush thread after writing out whatever is still buffered."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _take_batch(self):
+        with self._cond:
+            deadline = time.monotonic() + self.flush_interval
+            while not self._closed and len(self._buffer) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            count = min(len(self._buffer), self.max_batch)
+            batch = [self._buffer.popleft() for _ in range(count)]
+            # Room was freed: wake producers blocked in add().
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                self.flush(batch)
+            elif self._closed:
+                return
+
+    def flush(self, batch):
+        """
+        Indexes one batch with the bulk API, retrying retryable failures.
+
+        Returns:
+            int: Number of documents that were indexed.
+        """
+        pending = batch
+        indexed = 0
+        attempt = 0
+        BULK_BATCH_SIZE.observe(len(batch), index=self.index)
+        while pending:
+            operations = []
+            for document in pending:
+                if self.id_func is None:
+                    operations.append({"index": {"_index": self.index}})
+                else:
+                    operations.append({"index": {"_index": self.index, "_id": self.id_func(document)}})
+                operations.append(document)
+
+            start = time.perf_counter()
+            try:
+                response = self.es.bulk(operations=operations)
+            except Exception as e:
+                elapsed = time.perf_counter() - start
+                BULK_FLUSH_SECONDS.observe(elapsed, index=self.index)
+                retry = pending
+                logger.warning("Bulk request of %d events failed after %.1f ms: %s",
+                               len(pending), elapsed * 1000, e)
+            else:
+                elapsed = time.perf_counter() - start
+                BULK_FLUSH_SECONDS.observe(elapsed, index=self.index)
+                retry = []
+                permanent = 0
+                for document, item in zip(pending, response["items"]):
+                    status = item["index"].get("status", 500)
+                    if status < 300:
+                        indexed += 1
+                    elif status in RETRYABLE_STATUSES:
+                        retry.append(document)
+                    else:
+                        permanent += 1
+                        if permanent == 1:
+                            logger.warning("Elasticsearch rejected event (%s): %s",
+                                           status, item["index"].get("error"))
+                if permanent:
+                    BULK_FAILED.inc(permanent, index=self.index)
+                log.sampled_debug(logger, "Bulk indexed %d/%d events in %.1f ms.",
+                                  len(pending) - len(retry) - permanent, len(pending), elapsed * 1000)
+
+            if not retry:
+                break
+            attempt += 1
+            if attempt > self.max_retries:
+                BULK_FAILED.inc(len(retry), index=self.index)
+                logger.error("Dropping %d events after %d bulk retries.", len(retry), self.max_retries)
+                break
+            BULK_RETRIED.inc(len(retry), index=self.index)
+            time.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+            pending = retry
+
+        BULK_INDEXED.inc(indexed, index=self.index)
+        return indexed
@@ -0,0 +1,201 @@
+# es_scan.py
+"""
+Paging through an Elasticsearch index with a point in time and search_after.
+
+A point in time (PIT) freezes the view of the index for as long as it is kept
+alive, and search_after continues each page from the sort values of the last
+hit of the previous one. Together they read every matching document exactly
+once, in sort order, however many there are and while indexing goes on;
+from/size paging stops at 10000 hits and a plain size=100 search returns an
+arbitrary 100 documents.
+
+scan_pages() yields one list of hits per request, so callers can checkpoint
+between pages; scan() yields the hits one by one. The PIT is closed when the
+generator finishes or is closed early.
+
+get_documents() fetches documents by id, e.g. the members of an incident.
+
+sliced_scan() reads a large range faster: one PIT is split into slices that
+are paged in parallel threads, and the slices (each in sort order) are merged
+back into a single stream in sort order. At most a couple of pages per slice
+are buffered, so memory does not grow with the number of hits.
+"""
+import heapq
+import os
+import queue
+import threading
+from operator import itemgetter
+
+from correlation import format_timestamp
+
+DEFAULT_KEEP_ALIVE = "2m"
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_SLICES = int(os.environ.get("FPM_ES_SLICES", "4"))
+# pages buffered per slice in sliced_scan()
+SLICE_BUFFER_PAGES = 2
+# a "date" field sorts by milliseconds: hits within the same millisecond may be out of microsecond order
+SORT_RESOLUTION_SECONDS = 0.001
+# _shard_doc is the cheapest unique tiebreaker within a PIT
+TIMESTAMP_SORT = [{"timestamp": {"order": "asc"}}, {"_shard_doc": {"order": "asc"}}]
+
+
+def time_range_query(start=None, end=None, field="timestamp"):
+    """
+    A query for documents with start <= field < end.
+
+    Args:
+        start (int|None): Microseconds since the epoch; None = no lower bound.
+        end (int|None): Microseconds since the epoch; None = no upper bound.
+    """
+    bounds = {}
+    if start is not None:
+        bounds["gte"] = format_timestamp(start)
+    if end is not None:
+        bounds["lt"] = format_timestamp(end)
+    if not bounds:
+        return {"match_all": {}}
+    return {"range": {field: bounds}}
+
+
+def _close_pit(es, pit_id):
+    try:
+        es.close_point_in_time(id=pit_id)
+    except Exception:
+        pass    # it expires on its own after keep_alive
+
+
+def _pages(es, pit_id, query, sort, page_size, keep_alive, source, slice_=None):
+    # search_after loop over an open PIT; the last hit list is empty or short
+    search_after = None
+    while True:
+        request = {
+            "pit": {"id": pit_id, "keep_alive": keep_alive},
+            "query": query or {"match_all": {}},
+            "sort": sort or TIMESTAMP_SORT,
+            "size": page_size,
+            "track_total_hits": False,
+            "source": source,
+        }
+        if slice_ is not None:
+            request["slice"] = slice_
+        if search_after is not None:
+            request["search_after"] = search_after
+        response = es.search(**request)
+        # the PIT id may change between requests; always continue with the latest
+        pit_id = response.get("pit_id", pit_id)
+        hits = response["hits"]["hits"]
+        if hits:
+            yield hits
+        if len(hits) < page_size:
+            return
+        search_after = hits[-1]["sort"]
+
+
+def scan_pages(es, index, query=None, sort=None, page_size=DEFAULT_PAGE_SIZE, keep_alive=DEFAULT_KEEP_ALIVE,
+               source=True):
+    """
+    Yields the hits matching query, page by page, in sort order.
+
+    Args:
+        es (Elasticsearch): Client.
+        index (str): Index (or pattern) to read.
+        query (dict|None): Query DSL; None matches everything.
+        sort (list|None): Sort clauses; must end with a unique tiebreaker (default TIMESTAMP_SORT).
+        page_size (int): Hits per request.
+        keep_alive (str): How long the PIT survives between two requests.
+        source (bool|list): _source filtering passed to every request.
+    """
+    pit_id = es.open_point_in_time(index=index, keep_alive=keep_alive)["id"]
+    try:
+        yield from _pages(es, pit_id, query, sort, page_size, keep_alive, source)
+    finally:
+        _close_pit(es, pit_id)
+
+
+def scan(es, index, query=None, sort=None, page_size=DEFAULT_PAGE_SIZE, keep_alive=DEFAULT_KEEP_ALIVE, source=True):
+    """scan_pages() flattened into single hits."""
+    for hits in scan_pages(es, index, query, sort, page_size, keep_alive, source):
+        yield from hits
+
+
+def get_documents(es, index, ids, chunk=DEFAULT_PAGE_SIZE):
+    """
+    Yields the hits ({"_id", "_source"}) of the documents with the given ids, in that order.
+
+    Ids that no longer exist (deleted, index rolled over) are skipped.
+    """
+    for start in range(0, len(ids), chunk):
+        response = es.mget(index=index, ids=ids[start:start + chunk])
+        for doc in response["docs"]:
+            if doc.get("found"):
+                yield doc
+
+
+def sliced_scan(es, index, query=None, sort=None, slices=DEFAULT_SLICES, page_size=DEFAULT_PAGE_SIZE,
+                keep_alive=DEFAULT_KEEP_ALIVE, source=True):
+    """
+    Yields the hits matching query one by one, in sort order, paging slices of one PIT in parallel.
+
+    Args:
+        es (Elasticsearch): Client (thread-safe, shared by the slice threads).
+        index (str): Index (or pattern) to read.
+        query (dict|None): Query DSL; None matches everything.
+        sort (list|None): Sort clauses; must end with a unique tiebreaker, and the hits'
+                          sort values are compared to merge the slices (default TIMESTAMP_SORT).
+        slices (int): Parallel slices; 1 behaves like scan().
+        page_size (int): Hits per request.
+        keep_alive (str): How long the PIT survives between two requests.
+        source (bool|list): _source filtering passed to every request.
+
+    Raises:
+        Exception: Whatever a slice's search raised, re-raised in the caller.
+    """
+    if slices <= 1:
+        yield from scan(es, index, query, sort, page_size, keep_alive, source)
+        return
+    pit_id = es.open_point_in_time(index=index, keep_alive=keep_alive)["id"]
+    stop = threading.Event()
+    buffers = [queue.Queue(SLICE_BUFFER_PAGES) for _ in range(slices)]
+
+    def put(buffer, item):
+        # give up when the consumer went away instead of blocking on a full buffer forever
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_slice(slice_id):
+        buffer = buffers[slice_id]
+        try:
+            for hits in _pages(es, pit_id, query, sort, page_size, keep_alive, source,
+                               {"id": slice_id, "max": slices}):
+                if not put(buffer, hits):
+                    return
+            put(buffer, None)
+        except Exception as e:
+            put(buffer, e)
+
+    def drain(buffer):
+        while True:
+            item = buffer.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield from item
+
+    threads = [threading.Thread(target=read_slice, args=(slice_id,), name=f"fpm-scan-slice-{slice_id}", daemon=True)
+               for slice_id in range(slices)]
+    for thread in threads:
+        thread.start()
+    try:
+        # every slice is in sort order, so a k-way merge restores the global order
+        yield from heapq.merge(*(drain(buffer) for buffer in buffers), key=itemgetter("sort"))
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        _close_pit(es, pit_id)
@@ -2,9 +2,11 @@ import requests
 import json
 import time
 import random
+import sys
 from datetime import datetime
 
 SERVER_URL = "https://192.168.49.2:30000/log"  # عدّل إذا اختلف عندك
+BATCH_URL = "https://192.168.49.2:30000/ingest/batch"  # نقطة الدفعات (NDJSON)
 VERIFY_TLS = False  # اجعلها True إذا كنت تستخدم شهادة موثوقة
 
 SAMPLE_IPS = ["192.168.1.10", "10.0.0.5", "172.16.0.2", "192.168.100.11"]
@@ -37,9 +39,32 @@ def send_entry(entry):
     except Exception as e:
         print(f"[!] Error: {e}")
 
+def send_batch(entries):
+    """Sends several entries in one NDJSON request and prints per-line rejections."""
+    body = "".join(json.dumps(entry) + "\n" for entry in entries)
+    try:
+        response = requests.post(BATCH_URL,
+                                 headers={"Content-Type": "application/x-ndjson"},
+                                 data=body.encode("utf-8"),
+                                 verify=VERIFY_TLS)
+        if response.status_code == 200:
+            result = response.json()
+            print(f"[✓] Batch sent: {result['accepted']} accepted, {result['rejected']} rejected")
+            for error in result["errors"]:
+                print(f"    line {error['line']}: {error['error']}")
+        else:
+            print(f"[✗] Batch failed ({response.status_code}): {response.text}")
+    except Exception as e:
+        print(f"[!] Error: {e}")
+
 if __name__ == "__main__":
     print("🚀 Generating and sending fake logs...")
-    for _ in range(10):  # عدّد التكرارات حسب الرغبة
-        entry = generate_entry()
-        send_entry(entry)
-        time.sleep(0.5)  # انتظار نصف ثانية بين الطلبات
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        # python generate_fake_logs.py --batch [N]
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+        send_batch([generate_entry() for _ in range(count)])
+    else:
+        for _ in range(10):  # عدّد التكرارات حسب الرغبة
+            entry = generate_entry()
+            send_entry(entry)
+            time.sleep(0.5)  # انتظار نصف ثانية بين الطلبات
@@ -0,0 +1,275 @@
+# http_protocol.py
+"""
+HTTP/1.1 helpers shared by the threaded and asyncio ingestion servers:
+status reasons, request-head parsing, keep-alive rules, response building and
+RequestReader, the streaming request reader used by the threaded server.
+"""
+import time
+
+MAX_HEADER_BYTES = 16 * 1024
+MAX_BODY_BYTES = 1024 * 1024
+READ_TIMEOUT = 15.0        # seconds allowed to receive a whole request once it has started
+IDLE_TIMEOUT = 30.0        # seconds a keep-alive connection may sit between requests
+RECV_SIZE = 64 * 1024
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    408: "Request Timeout",
+    411: "Length Required",
+    413: "Payload Too Large",
+    415: "Unsupported Media Type",
+    422: "Unprocessable Entity",
+    429: "Too Many Requests",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class HTTPError(Exception):
+    """Raised while framing a request; carries the status code (and any headers) to answer with."""
+
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers
+
+
+def build_response(status, body=b"", content_type="text/plain", keep_alive=True, extra_headers=None):
+    """Serializes an HTTP/1.1 response."""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    lines = [
+        f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}",
+        f"Content-Type: {content_type}",
+        f"Content-Length: {len(body)}",
+        "Connection: keep-alive" if keep_alive else "Connection: close",
+    ]
+    for name, value in (extra_headers or {}).items():
+        lines.append(f"{name}: {value}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+
+def parse_head(head):
+    """
+    Parses the request line and headers of an HTTP request.
+
+    Args:
+        head (bytes|bytearray|memoryview): Everything up to the blank line (the
+                                           terminating CRLFs may be included).
+
+    Returns:
+        tuple: (method, path, version, headers) where header names are lower-cased.
+    """
+    # str() decodes straight from the buffer, so a memoryview is never copied to bytes first.
+    text = str(head, "latin-1")
+    lines = text.split("\r\n")
+    parts = lines[0].split(" ")
+    if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+        raise HTTPError(400, f"Malformed request line: {lines[0][:80]!r}")
+    method, path, version = parts
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(":")
+        if not sep:
+            raise HTTPError(400, f"Malformed header line: {line[:80]!r}")
+        headers[name.strip().lower()] = value.strip()
+    return method, path, version, headers
+
+
+def check_request_line(method, path, methods=("POST",), paths=None):
+    """
+    Answers 404 / 405 from the request line alone.
+
+    Called before the body is read, so e.g. a GET without Content-Length gets
+    405 rather than the 411 its framing would otherwise produce.
+
+    Args:
+        methods (tuple): Methods served; others get 405 with an Allow header.
+        paths (set|None): Paths served (without query string); None = any.
+    """
+    if paths is not None and path.split("?", 1)[0] not in paths:
+        raise HTTPError(404, f"Unknown path {path}")
+    if method not in methods:
+        raise HTTPError(405, f"Only {', '.join(methods)} is supported", {"Allow": ", ".join(methods)})
+
+
+def content_length(headers, max_body):
+    """Validates the Content-Length header against max_body and returns it."""
+    if "content-length" not in headers:
+        raise HTTPError(411, "Content-Length or chunked transfer-encoding required")
+    value = headers["content-length"]
+    # int() alone would also accept "+5", " 5" and "1_0".
+    if not (value.isascii() and value.isdigit()):
+        raise HTTPError(400, "Invalid Content-Length")
+    length = int(value)
+    if length > max_body:
+        raise HTTPError(413, f"Body exceeds {max_body} bytes")
+    return length
+
+
+def chunk_size(line):
+    """Parses a chunk-size line (extensions after ';' are ignored)."""
+    token = line.split(b";", 1)[0].strip()
+    if not token or token.strip(b"0123456789abcdefABCDEF"):
+        raise HTTPError(400, "Invalid chunk size")
+    return int(token, 16)
+
+
+def is_chunked(headers):
+    return "chunked" in headers.get("transfer-encoding", "").lower()
+
+
+def wants_keep_alive(version, headers):
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.0":
+        return connection == "keep-alive"
+    return connection != "close"
+
+
+class RequestReader:
+    """
+    Reads HTTP/1.1 requests from a blocking socket (plain or TLS) as the bytes arrive.
+
+    The request head is searched and parsed in place through a memoryview of
+    the receive buffer, the body is received until Content-Length or the last
+    chunk is satisfied, and bytes belonging to the next request stay buffered
+    for keep-alive connections.
+
+    Args:
+        sock (socket.socket): Connected socket; its timeout is managed by the reader.
+        max_header_bytes (int): Larger request heads are rejected with 431.
+        max_body_bytes (int): Larger bodies are rejected with 413.
+        read_timeout (float): Seconds allowed for a whole request once its first byte arrived (408).
+        idle_timeout (float): Seconds to wait for the first byte of the next request.
+        methods (tuple|None): Methods served, checked before the body is read (see check_request_line);
+                              None = any.
+        paths (set|None): Paths served, checked before the body is read; None = any.
+    """
+
+    def __init__(self, sock, max_header_bytes=MAX_HEADER_BYTES, max_body_bytes=MAX_BODY_BYTES,
+                 read_timeout=READ_TIMEOUT, idle_timeout=IDLE_TIMEOUT, methods=None, paths=None):
+        self.sock = sock
+        self.max_header_bytes = max_header_bytes
+        self.max_body_bytes = max_body_bytes
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.methods = methods
+        self.paths = paths
+        self._buf = bytearray()
+        self._deadline = None
+
+    def read_request(self):
+        """
+        Reads the next request.
+
+        Returns:
+            tuple|None: (method, path, version, headers, body), or None when the peer
+                        closed the connection (or stayed idle) between requests.
+                        body is a bytes-like object.
+
+        Raises:
+            HTTPError: The request is malformed, too large or too slow; the
+                       connection should be answered with e.status and closed.
+        """
+        self._deadline = None
+        if not self._buf and not self._recv(idle=True):
+            return None
+        self._deadline = time.monotonic() + self.read_timeout
+
+        end = self._find(b"\r\n\r\n", self.max_header_bytes, 431, "Request header too large")
+        with memoryview(self._buf) as view:
+            method, path, version, headers = parse_head(view[:end])
+        del self._buf[:end + 4]
+        if self.methods is not None or self.paths is not None:
+            check_request_line(method, path, self.methods or (method,), self.paths)
+        return method, path, version, headers, self._read_body(headers)
+
+    def _recv(self, idle=False):
+        """Appends the next chunk from the socket to the buffer; returns its size (0 at EOF)."""
+        if idle:
+            timeout = self.idle_timeout
+        else:
+            timeout = self._deadline - time.monotonic()
+            if timeout <= 0:
+                raise HTTPError(408, "Timed out reading request")
+        self.sock.settimeout(timeout)
+        try:
+            chunk = self.sock.recv(RECV_SIZE)
+        except TimeoutError:
+            if idle:
+                return 0
+            raise HTTPError(408, "Timed out reading request")
+        self._buf += chunk
+        return len(chunk)
+
+    def _find(self, delimiter, limit, status, message):
+        """Receives until delimiter is buffered; returns its offset."""
+        scanned = 0
+        while True:
+            index = self._buf.find(delimiter, scanned)
+            if index != -1:
+                return index
+            # Only rescan the tail that could hold a delimiter split across reads.
+            scanned = max(0, len(self._buf) - len(delimiter) + 1)
+            if len(self._buf) > limit:
+                raise HTTPError(status, message)
+            if not self._recv():
+                raise HTTPError(400, "Connection closed mid-request")
+
+    def _read_exact(self, size):
+        """Returns exactly size bytes, receiving straight into the result for large bodies."""
+        if len(self._buf) >= size:
+            data = bytes(self._buf[:size])
+            del self._buf[:size]
+            return data
+        data = bytearray(size)
+        have = len(self._buf)
+        data[:have] = self._buf
+        self._buf.clear()
+        with memoryview(data) as view:
+            while have < size:
+                timeout = self._deadline - time.monotonic()
+                if timeout <= 0:
+                    raise HTTPError(408, "Timed out reading request")
+                self.sock.settimeout(timeout)
+                try:
+                    received = self.sock.recv_into(view[have:])
+                except TimeoutError:
+                    raise HTTPError(408, "Timed out reading request")
+                if not received:
+                    raise HTTPError(400, "Connection closed mid-body")
+                have += received
+        return data
+
+    def _read_line(self):
+        end = self._find(b"\r\n", MAX_HEADER_BYTES, 400, "Chunk header line too long")
+        line = bytes(self._buf[:end])
+        del self._buf[:end + 2]
+        return line
+
+    def _read_body(self, headers):
+        if is_chunked(headers):
+            return self._read_chunked()
+        return self._read_exact(content_length(headers, self.max_body_bytes))
+
+    def _read_chunked(self):
+        body = bytearray()
+        while True:
+            size = chunk_size(self._read_line())
+            if size == 0:
+                # Skip optional trailers up to the terminating blank line.
+                while self._read_line():
+                    pass
+                return body
+            if len(body) + size > self.max_body_bytes:
+                raise HTTPError(413, f"Body exceeds {self.max_body_bytes} bytes")
+            body += self._read_exact(size)
+            if self._read_exact(2) != b"\r\n":
+                raise HTTPError(400, "Missing CRLF after chunk")
@@ -0,0 +1,287 @@
+# ingest.py
+"""
+Request payload decoding for the FPM ingestion endpoints.
+
+    POST /ingest/batch   newline-delimited JSON (one event object per line), or the
+                         columnar batch format below when sent with
+                         "Content-Type: application/x-fpm-columnar+json";
+                         either optionally with "Content-Encoding: gzip" or "zstd".
+    POST /ingest, /log, / a single JSON event object (original format).
+
+Every event is checked against the compiled agent-event schema (schema.py)
+before it is accepted. Batch responses are JSON and report every rejected
+line individually:
+
+    {"accepted": 498, "rejected": 2,
+     "errors": [{"line": 17, "error": "Invalid JSON: ..."},
+                {"line": 40, "error": "dst_port: 70000 out of range 0-65535"}]}
+
+The columnar format names every field once and carries one array per field,
+with null where an event does not have the field:
+
+    {"fields": ["timestamp", "src_ip", "dst_ip", "dst_port"],
+     "columns": [["2025-01-01T00:00:00", ...], ["10.0.0.5", ...], ["10.0.0.1", ...], [443, null, ...]]}
+
+Batch responses carry "Accept-Encoding" (RFC 7694) and "Accept-Post" headers
+listing the content codings and batch formats this server decodes, which is
+how agents negotiate compression and the batch format.
+
+JSON is decoded with orjson when it is installed (several times faster than
+the json module on agent events) and with the standard library otherwise.
+"""
+import json
+import os
+import zlib
+
+import metrics
+import schema
+
+try:
+    import zstandard
+except ImportError:  # zstd support is optional
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:  # the fast JSON backend is optional
+    orjson = None
+
+BATCH_PATH = "/ingest/batch"
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+COLUMNAR_CONTENT_TYPE = "application/x-fpm-columnar+json"
+SINGLE_EVENT_PATHS = {"/", "/log", "/ingest"}
+HEARTBEAT_PATH = "/agent/heartbeat"
+PATHS = SINGLE_EVENT_PATHS | {BATCH_PATH, HEARTBEAT_PATH}
+MAX_DECODED_BYTES = 16 * 1024 * 1024
+MAX_REPORTED_ERRORS = 100
+MAX_EVENT_BYTES = 64 * 1024
+EVENT_TOO_LARGE = f"Event exceeds {MAX_EVENT_BYTES} bytes"
+# "0" turns schema validation off (events are then stored as sent, like before).
+VALIDATE_EVENTS = os.environ.get("FPM_VALIDATE_EVENTS", "1") == "1"
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+json_loads = orjson.loads if orjson is not None else json.loads
+# orjson.JSONDecodeError subclasses json.JSONDecodeError.
+JSON_ERRORS = (UnicodeDecodeError, json.JSONDecodeError)
+
+JSON_DECODE_FAILURES = metrics.counter(
+    "fpm_json_decode_failures_total", "Events rejected because they were not valid JSON objects",
+    labelnames=("reason",))
+BATCH_PAYLOADS = metrics.counter(
+    "fpm_batch_payloads_total", "Batch requests by batch format and content encoding",
+    labelnames=("format", "encoding"))
+SCHEMA_REJECTIONS = metrics.counter(
+    "fpm_schema_rejections_total", "Events rejected by the agent-event schema, by offending field",
+    labelnames=("field",))
+
+
+class PayloadError(Exception):
+    """Raised when a request body cannot be decoded; carries the HTTP status to answer with."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def supported_encodings():
+    """Content encodings this server can decode, in preference order."""
+    return (["zstd"] if zstandard is not None else []) + ["gzip", "identity"]
+
+
+def negotiation_headers():
+    """Response headers advertising the content codings and batch formats the batch endpoint accepts."""
+    return {
+        "Accept-Encoding": ", ".join(supported_encodings()),
+        "Accept-Post": f"{NDJSON_CONTENT_TYPE}, {COLUMNAR_CONTENT_TYPE}",
+    }
+
+
+def decode_content(body, content_encoding, max_size=MAX_DECODED_BYTES):
+    """
+    Undoes the Content-Encoding of a request body.
+
+    Args:
+        body (bytes): Raw request body.
+        content_encoding (str): Value of the Content-Encoding header ("" for none).
+        max_size (int): Reject bodies that expand beyond this many bytes.
+
+    Returns:
+        bytes: The decoded body.
+    """
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding == "identity":
+        return body
+    if encoding in ("gzip", "x-gzip"):
+        decompressor = zlib.decompressobj(wbits=31)
+        try:
+            data = decompressor.decompress(body, max_size)
+        except zlib.error as e:
+            raise PayloadError(400, f"Invalid gzip body: {e}")
+        if decompressor.unconsumed_tail:
+            raise PayloadError(413, f"Decompressed body exceeds {max_size} bytes")
+        if not decompressor.eof:
+            raise PayloadError(400, "Truncated gzip body")
+        return data
+    if encoding == "zstd":
+        if zstandard is None:
+            raise PayloadError(415, "zstd is not available on this server")
+        try:
+            # Frames that declare their size are decoded in one call into an exact-size buffer;
+            # stream only the ones that do not (read(max_size + 1) would allocate max_size up front).
+            declared = zstandard.frame_content_size(body)
+            if declared > max_size:
+                raise PayloadError(413, f"Decompressed body exceeds {max_size} bytes")
+            if declared >= 0:
+                data = zstandard.ZstdDecompressor().decompress(body)
+            else:
+                with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+                    chunks = []
+                    size = 0
+                    while size <= max_size:
+                        chunk = reader.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        chunks.append(chunk)
+                        size += len(chunk)
+                data = b"".join(chunks)
+        except zstandard.ZstdError as e:
+            raise PayloadError(400, f"Invalid zstd body: {e}")
+        if len(data) > max_size:
+            raise PayloadError(413, f"Decompressed body exceeds {max_size} bytes")
+        return data
+    raise PayloadError(415, f"Unsupported Content-Encoding: {content_encoding}")
+
+
+def json_dumps(value, sort_keys=False):
+    """Serializes value to compact JSON bytes with the active backend."""
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(value, separators=(",", ":"), sort_keys=sort_keys).encode("utf-8")
+
+
+def parse_event(data, validate=VALIDATE_EVENTS):
+    """Parses a single JSON event object and checks it against the event schema."""
+    if len(data) > MAX_EVENT_BYTES:
+        raise PayloadError(413, EVENT_TOO_LARGE)
+    try:
+        event = json_loads(data)
+    except JSON_ERRORS as e:
+        JSON_DECODE_FAILURES.inc(reason="syntax")
+        raise PayloadError(400, f"Invalid JSON: {e}")
+    if not isinstance(event, dict):
+        JSON_DECODE_FAILURES.inc(reason="not_object")
+        raise PayloadError(400, "Event must be a JSON object")
+    if validate:
+        try:
+            schema.validate(event)
+        except schema.SchemaError as e:
+            SCHEMA_REJECTIONS.inc(field=e.field)
+            raise PayloadError(422, str(e))
+    return event
+
+
+def parse_heartbeat(data):
+    """
+    Parses an agent heartbeat document (agent_telemetry.py).
+
+    Heartbeats are not packet events, so the event schema does not apply; they only
+    need to say which agent sent them and when.
+    """
+    heartbeat = parse_event(data, validate=False)
+    for field in ("host", "timestamp"):
+        if not isinstance(heartbeat.get(field), str) or not heartbeat[field]:
+            raise PayloadError(422, f"{field}: required string missing from heartbeat")
+    heartbeat["type"] = "agent_heartbeat"
+    return heartbeat
+
+
+def parse_ndjson(data, validate=VALIDATE_EVENTS):
+    """
+    Splits an NDJSON body into events, collecting a per-line error for every bad line.
+
+    Returns:
+        tuple: (events, errors) where events is a list of dicts and errors a
+               list of {"line": n, "error": message} (1-based line numbers).
+    """
+    events = []
+    errors = []
+    for number, line in enumerate(data.split(b"\n"), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            events.append(parse_event(line, validate))
+        except PayloadError as e:
+            errors.append({"line": number, "error": e.message})
+    return events, errors
+
+
+def parse_columnar(data, validate=VALIDATE_EVENTS):
+    """
+    Decodes a columnar batch (see the module docstring) into events.
+
+    Returns:
+        tuple: (events, errors) like parse_ndjson(), with "line" being the 1-based row number.
+    """
+    try:
+        batch = json_loads(data)
+    except JSON_ERRORS as e:
+        JSON_DECODE_FAILURES.inc(reason="syntax")
+        raise PayloadError(400, f"Invalid JSON: {e}")
+    fields = batch.get("fields") if isinstance(batch, dict) else None
+    columns = batch.get("columns") if isinstance(batch, dict) else None
+    if (not isinstance(fields, list) or not isinstance(columns, list) or len(fields) != len(columns)
+            or not all(isinstance(name, str) for name in fields)
+            or not all(isinstance(column, list) for column in columns)):
+        raise PayloadError(400, "Columnar batch needs equally long 'fields' and 'columns' lists")
+    if len(fields) > schema.MAX_FIELDS:
+        raise PayloadError(400, f"Columnar batch has more than {schema.MAX_FIELDS} fields")
+    if columns and any(len(column) != len(columns[0]) for column in columns):
+        raise PayloadError(400, "Columnar batch columns differ in length")
+
+    events = []
+    errors = []
+    # no row can encode larger than the whole body, so rows are only measured in bodies above the cap
+    measure = len(data) > MAX_EVENT_BYTES
+    for number, values in enumerate(zip(*columns), 1):
+        event = {name: value for name, value in zip(fields, values) if value is not None}
+        if measure and len(json_dumps(event)) > MAX_EVENT_BYTES:
+            errors.append({"line": number, "error": EVENT_TOO_LARGE})
+            continue
+        if validate:
+            try:
+                schema.validate(event)
+            except schema.SchemaError as e:
+                SCHEMA_REJECTIONS.inc(field=e.field)
+                errors.append({"line": number, "error": str(e)})
+                continue
+        events.append(event)
+    return events, errors
+
+
+def parse_batch(data, content_type="", content_encoding="", validate=VALIDATE_EVENTS):
+    """Decodes a batch request body in whichever format its Content-Type names."""
+    media_type = (content_type or "").split(";", 1)[0].strip().lower()
+    batch_format = "columnar" if media_type == COLUMNAR_CONTENT_TYPE else "ndjson"
+    BATCH_PAYLOADS.inc(format=batch_format, encoding=(content_encoding or "identity").strip().lower())
+    if batch_format == "columnar":
+        return parse_columnar(data, validate)
+    return parse_ndjson(data, validate)
+
+
+def batch_response(accepted, errors, duplicates=0):
+    """
+    Builds the JSON body returned by the batch endpoint.
+
+    Args:
+        accepted (int): Valid events, including duplicates of already-stored events.
+        errors (list): Per-line errors from parse_ndjson().
+        duplicates (int): How many of the accepted events were already stored.
+    """
+    return json.dumps({
+        "accepted": accepted,
+        "rejected": len(errors),
+        "duplicates": duplicates,
+        "errors": errors[:MAX_REPORTED_ERRORS],
+    })
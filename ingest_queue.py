@@ -0,0 +1,241 @@
+# ingest_queue.py
+"""
+Bounded queue between request parsing and storage, with load shedding.
+
+Request handlers offer() parsed events and return immediately; a worker
+thread drains the queue into the (blocking) storage sink. When storage falls
+behind and the queue is full, the configured policy decides what happens:
+
+    reject  refuse the whole request; the server answers 429 with Retry-After
+    drop    keep the highest-priority events, evicting the oldest event of the
+            lowest priority present (or the incoming one if it ranks lowest)
+    spill   append the overflow to an on-disk spool and feed it back into the
+            queue once there is room again
+
+Queue depth and shed counts are exported through metrics.py.
+"""
+import os
+import threading
+from collections import deque
+
+import log
+import metrics
+from spool import SpoolReader, SpoolWriter
+
+logger = log.get_logger("ingest_queue")
+
+POLICIES = ("reject", "drop", "spill")
+MAX_PRIORITY = 9
+DEFAULT_PRIORITY = 1
+ALERT_PRIORITY = 2
+
+QUEUE_DEPTH = metrics.gauge(
+    "fpm_ingest_queue_depth", "Events waiting between request parsing and storage")
+QUEUE_CAPACITY = metrics.gauge(
+    "fpm_ingest_queue_capacity", "Configured maximum ingest queue depth")
+SHED_EVENTS = metrics.counter(
+    "fpm_ingest_shed_events_total", "Events not queued because the ingest queue was full",
+    labelnames=("action", "priority"))
+SPILL_BACKLOG = metrics.gauge(
+    "fpm_ingest_spill_backlog_events", "Events spilled to disk and not yet fed back into the queue")
+
+
+class QueueFull(Exception):
+    """Raised by offer() under the reject policy; retry_after is a hint in seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"ingest queue full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class QueueClosed(QueueFull):
+    """Raised by offer() once the queue is shutting down."""
+
+
+def event_priority(event):
+    """
+    Ranks an event for the drop policy (higher is kept longer).
+
+    An integer "priority" field (0-9) set by the agent wins; otherwise events
+    that already carry alerts outrank plain packet events.
+    """
+    priority = event.get("priority")
+    if isinstance(priority, int) and not isinstance(priority, bool):
+        return max(0, min(MAX_PRIORITY, priority))
+    if event.get("alerts") or event.get("alert_reason"):
+        return ALERT_PRIORITY
+    return DEFAULT_PRIORITY
+
+
+class IngestQueue:
+    """
+    Priority-aware bounded queue drained by a background worker.
+
+    Args:
+        sink (callable): Blocking function storing one event (server.store_event).
+        maxsize (int): Maximum number of queued events.
+        policy (str): "reject", "drop" or "spill" (see module docstring).
+        retry_after (int): Retry-After hint, in seconds, for rejected requests.
+        spill_dir (str): Spool directory for the spill policy.
+        spill_segment_seconds (float): How long a spill segment stays open before it
+                                       can be fed back into the queue.
+    """
+
+    def __init__(self, sink, maxsize=50000, policy="reject", retry_after=2,
+                 spill_dir="logs/overflow", spill_segment_seconds=5.0):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown shed policy {policy!r}, expected one of {POLICIES}")
+        self.sink = sink
+        self.maxsize = maxsize
+        self.policy = policy
+        self.retry_after = retry_after
+        self._levels = [deque() for _ in range(MAX_PRIORITY + 1)]
+        self._size = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._threads = []
+
+        self._spill = None
+        self._spilled = 0
+        if policy == "spill":
+            self._spill_reader = SpoolReader(spill_dir)
+            # segments left by a previous run are fed back too, so they count towards the backlog
+            self._spilled = self._spill_reader.count_records()
+            if self._spilled:
+                logger.info("%d spilled event(s) from a previous run waiting in %s.", self._spilled, spill_dir)
+            self._spill = SpoolWriter(spill_dir, fsync_interval=None, compress=False,
+                                      max_segment_age=spill_segment_seconds, max_segments=None)
+
+        QUEUE_DEPTH.set_function(lambda: self._size)
+        QUEUE_CAPACITY.set(maxsize)
+        SPILL_BACKLOG.set_function(lambda: self._spilled)
+
+    def __len__(self):
+        return self._size
+
+    def start(self):
+        """Starts the drain worker (and the spill feeder for the spill policy)."""
+        with self._cond:
+            if self._threads:
+                return
+            self._threads.append(threading.Thread(target=self._drain, name="fpm-ingest-queue", daemon=True))
+            if self._spill is not None:
+                self._spill.start()
+                self._threads.append(threading.Thread(target=self._feed_spill, name="fpm-spill-feeder", daemon=True))
+            for thread in self._threads:
+                thread.start()
+
+    def offer(self, events):
+        """
+        Admits a list of parsed events without blocking.
+
+        Under the reject policy the request is admitted whole or not at all,
+        so a client retrying after QueueFull never duplicates part of a batch.
+
+        Returns:
+            int: Number of events queued (the rest were dropped or spilled).
+        """
+        overflow = []
+        queued = 0
+        with self._cond:
+            if self._closed:
+                raise QueueClosed(self.retry_after)
+            # An empty queue admits any batch, so one larger than maxsize is not refused forever.
+            if self.policy == "reject" and self._size and self._size + len(events) > self.maxsize:
+                SHED_EVENTS.inc(len(events), action="rejected", priority="all")
+                raise QueueFull(self.retry_after)
+            for event in events:
+                priority = event_priority(event)
+                if self._size < self.maxsize:
+                    self._push(priority, event)
+                    queued += 1
+                elif self.policy == "drop":
+                    victim = self._lowest_level()
+                    if victim < priority:
+                        self._levels[victim].popleft()
+                        self._levels[priority].append(event)
+                        queued += 1
+                        SHED_EVENTS.inc(action="dropped", priority=str(victim))
+                    else:
+                        SHED_EVENTS.inc(action="dropped", priority=str(priority))
+                else:
+                    overflow.append(event)
+                    SHED_EVENTS.inc(action="spilled", priority=str(priority))
+            if queued:
+                self._cond.notify_all()
+            self._spilled += len(overflow)
+        for event in overflow:
+            self._spill.append(event)
+        return queued
+
+    def close(self, timeout=10.0):
+        """Stops accepting events and waits for the queue to drain into the sink."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        if self._spill is not None:
+            self._spill.close()
+
+    def _push(self, priority, event):
+        self._levels[priority].append(event)
+        self._size += 1
+
+    def _lowest_level(self):
+        for priority, level in enumerate(self._levels):
+            if level:
+                return priority
+        return MAX_PRIORITY + 1
+
+    def _pop(self):
+        for level in reversed(self._levels):
+            if level:
+                self._size -= 1
+                return level.popleft()
+        return None
+
+    def _drain(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._size or self._closed)
+                event = self._pop()
+                if event is None:
+                    return
+                self._cond.notify_all()
+            try:
+                self.sink(event)
+            except Exception as e:
+                logger.error("Failed to store queued event: %s", e)
+
+    def _feed_spill(self):
+        """Moves closed spill segments back into the queue once it has drained below half."""
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or self._size < self.maxsize // 2)
+                if self._closed:
+                    return
+            if not self._feed_closed_segments():
+                with self._cond:
+                    # Nothing to feed yet: the active segment closes after spill_segment_seconds.
+                    if self._cond.wait_for(lambda: self._closed, 1.0):
+                        return
+
+    def _feed_closed_segments(self):
+        fed = False
+        active = self._spill.active_sequence
+        for sequence, path in self._spill_reader.segments():
+            if sequence >= active:
+                continue
+            for record in self._spill_reader.read_segment(path):
+                with self._cond:
+                    self._cond.wait_for(lambda: self._closed or self._size < self.maxsize)
+                    if self._closed:
+                        return fed
+                    self._push(event_priority(record), record)
+                    self._spilled = max(0, self._spilled - 1)
+                    self._cond.notify_all()
+            # At-least-once: a crash before this point replays the segment on restart.
+            os.remove(path)
+            fed = True
+        return fed
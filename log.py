@@ -0,0 +1,119 @@
+# log.py
+"""
+Leveled, structured logging for the FPM server with an asynchronous handler.
+
+Modules get a logger with get_logger("<module>") and log with %-style arguments,
+so nothing is formatted unless the level is enabled. setup() routes every
+"fpm.*" logger through a bounded in-memory queue to one listener thread that
+formats and writes to stderr; the request path only pays for an enqueue, and
+if stderr stalls, records are dropped (and counted) instead of blocking it.
+
+Per-event debug lines go through sampled_debug(), which keeps one line in
+FPM_LOG_SAMPLE_EVERY and stamps the kept record with the sampling rate.
+
+    FPM_LOG_LEVEL=DEBUG FPM_LOG_FORMAT=json python server.py
+"""
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+import metrics
+
+LOG_LEVEL = os.environ.get("FPM_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("FPM_LOG_FORMAT", "text")        # "text" or "json"
+LOG_SAMPLE_EVERY = max(1, int(os.environ.get("FPM_LOG_SAMPLE_EVERY", "100")))
+LOG_QUEUE_SIZE = int(os.environ.get("FPM_LOG_QUEUE_SIZE", "10000"))
+
+ROOT = "fpm"
+TEXT_FORMAT = "%(asctime)s %(levelname)-7s [%(process)d] %(name)s: %(message)s"
+
+DROPPED_RECORDS = metrics.counter(
+    "fpm_log_dropped_total", "Log records dropped because the log queue was full")
+
+# Attributes every LogRecord has; anything else was passed through extra= and is emitted as a field.
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+_sample_counter = itertools.count()
+_listener = None
+_handler = None
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, pid, logger, msg plus any extra= fields."""
+
+    def format(self, record):
+        document = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "pid": record.process,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                document[key] = value
+        if record.exc_info:
+            document["exc"] = self.formatException(record.exc_info)
+        return json.dumps(document, default=str)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks the caller and leaves formatting to the listener."""
+
+    def prepare(self, record):
+        # Merge the arguments now (they may change after this call returns), but
+        # leave timestamps, JSON encoding and tracebacks to the listener thread.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED_RECORDS.inc()
+
+
+def get_logger(name):
+    """Returns the logger for a module, under the "fpm" hierarchy."""
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+def sampled_debug(logger, msg, *args):
+    """Logs a per-event debug line, keeping only one in LOG_SAMPLE_EVERY."""
+    if logger.isEnabledFor(logging.DEBUG) and next(_sample_counter) % LOG_SAMPLE_EVERY == 0:
+        logger.debug(msg, *args, extra={"sample_rate": LOG_SAMPLE_EVERY})
+
+
+def _start_listener():
+    global _listener
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JSONFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+    _handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(_handler.queue, stream)
+    _listener.start()
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+def setup(level=LOG_LEVEL):
+    """Installs the queue handler on the "fpm" logger (idempotent)."""
+    global _handler
+    root = logging.getLogger(ROOT)
+    root.setLevel(level)
+    if _handler is not None:
+        return
+    _handler = _DroppingQueueHandler(None)
+    root.addHandler(_handler)
+    root.propagate = False
+    _start_listener()
+    atexit.register(_stop_listener)
+    # The listener thread does not survive fork(); pre-fork workers start their own.
+    os.register_at_fork(after_in_child=_start_listener)
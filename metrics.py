@@ -0,0 +1,222 @@
+# metrics.py
+"""
+Minimal in-process metrics registry (counters, gauges, histograms).
+
+Metrics are created once at module level with counter()/gauge()/histogram()
+and updated from any thread. render() produces the Prometheus text exposition
+format, and start_http_server() serves it on a plain-HTTP /metrics endpoint
+next to the TLS listener so Prometheus can scrape it.
+"""
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# log.py depends on this module, so the "fpm.metrics" logger is named directly.
+logger = logging.getLogger("fpm.metrics")
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_registry = {}
+
+
+def _label_key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError(f"Expected labels {labelnames}, got {tuple(labels)}")
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = list(zip(labelnames, key))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """Monotonically increasing value, optionally split by labels."""
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Gauge(Counter):
+    """Value that can go up and down, or be computed on demand by a callback."""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._functions = {}        # label key -> callback
+
+    def set(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        """Reports function() at read time for these labels instead of a stored value."""
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._functions[key] = function
+
+    def value(self, **labels):
+        key = _label_key(self.labelnames, labels)
+        function = self._functions.get(key)
+        if function is not None:
+            return function()
+        return self._values.get(key, 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+            functions = list(self._functions.items())
+        for key, value in items:
+            if key not in self._functions:
+                yield self.name, _format_labels(self.labelnames, key), value
+        for key, function in functions:
+            yield self.name, _format_labels(self.labelnames, key), function()
+
+
+class Histogram:
+    """Distribution of observed values over fixed cumulative buckets."""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels):
+        series = self._series.get(_label_key(self.labelnames, labels))
+        return series[2] if series else 0
+
+    def total(self, **labels):
+        series = self._series.get(_label_key(self.labelnames, labels))
+        return series[1] if series else 0.0
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(s[0]), s[1], s[2])) for key, s in self._series.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield (self.name + "_bucket",
+                       _format_labels(self.labelnames, key, ("le", repr(float(bound)))), cumulative)
+            yield self.name + "_bucket", _format_labels(self.labelnames, key, ("le", "+Inf")), count
+            yield self.name + "_sum", _format_labels(self.labelnames, key), total
+            yield self.name + "_count", _format_labels(self.labelnames, key), count
+
+
+def _get_or_create(cls, name, *args, **kwargs):
+    with _lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, *args, **kwargs)
+        elif type(metric) is not cls:
+            raise ValueError(f"Metric {name} already registered as {metric.kind}")
+        return metric
+
+
+def counter(name, documentation, labelnames=()):
+    return _get_or_create(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return _get_or_create(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+def render():
+    """Returns all registered metrics in the Prometheus text exposition format."""
+    with _lock:
+        metrics = sorted(_registry.values(), key=lambda m: m.name)
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404, "Only /metrics is served here")
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown the server log.
+        pass
+
+
+def start_http_server(port, host="0.0.0.0"):
+    """
+    Serves render() on http://host:port/metrics from a daemon thread.
+
+    Returns:
+        ThreadingHTTPServer|None: The running server, or None if the port could not be bound.
+    """
+    try:
+        httpd = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.warning("Metrics endpoint disabled, cannot bind %s:%s: %s", host, port, e)
+        return None
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="fpm-metrics-http", daemon=True).start()
+    logger.info("Metrics available on http://%s:%s/metrics", host, port)
+    return httpd
@@ -0,0 +1,125 @@
+# prefork.py
+"""
+Pre-fork supervisor for the FPM server (FPM_WORKERS > 1).
+
+The supervisor forks N worker processes that each bind the listening port
+with SO_REUSEPORT, so the kernel spreads incoming connections across them and
+JSON/TLS work runs on N cores instead of one GIL. Workers that exit are
+restarted; a worker that keeps dying right after start is restarted with an
+increasing delay so a broken configuration does not spin the CPU.
+SIGTERM/SIGINT are forwarded to the workers, which flush their buffers on exit.
+"""
+import atexit
+import os
+import signal
+import sys
+import time
+
+import log
+
+logger = log.get_logger("prefork")
+
+MIN_UPTIME = 5.0       # seconds a worker must live for its exit not to count as a crash loop
+MAX_RESTART_DELAY = 30.0
+
+
+class Supervisor:
+    """
+    Forks and babysits worker processes.
+
+    Args:
+        worker_main (callable): Called in the child as worker_main(worker_id); the
+                                worker process exits when it returns.
+        workers (int): Number of worker processes to keep running.
+    """
+
+    def __init__(self, worker_main, workers):
+        self.worker_main = worker_main
+        self.workers = workers
+        self._children = {}      # pid -> (worker_id, start time)
+        self._delays = {}        # worker_id -> current restart delay
+        self._stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        logger.info("Supervisor %d starting %d workers (SO_REUSEPORT)...", os.getpid(), self.workers)
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            worker_id, started = self._children.pop(pid, (None, 0.0))
+            if worker_id is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if self._stopping:
+                continue
+            uptime = time.monotonic() - started
+            if uptime < MIN_UPTIME:
+                delay = min(MAX_RESTART_DELAY, max(1.0, self._delays.get(worker_id, 0.5) * 2))
+            else:
+                delay = 0.0
+            self._delays[worker_id] = delay
+            logger.warning("Worker %d (pid %d) exited with %s after %.1fs; restarting in %.1fs.",
+                           worker_id, pid, code, uptime, delay)
+            time.sleep(delay)
+            if not self._stopping:
+                self._spawn(worker_id)
+        logger.info("Supervisor stopped.")
+
+    def _spawn(self, worker_id):
+        pid = os.fork()
+        if pid == 0:
+            # Child: never return into the supervisor loop, whatever happens.
+            code = 1
+            try:
+                code = _run_worker(self.worker_main, worker_id)
+            finally:
+                os._exit(code)
+        self._children[pid] = (worker_id, time.monotonic())
+        logger.info("Worker %d started (pid %d).", worker_id, pid)
+
+    def _stop(self, signum, frame):
+        if self._stopping:
+            return
+        self._stopping = True
+        logger.info("Supervisor received signal %d, stopping workers...", signum)
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+def _exit_on_signal(signum, frame):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise SystemExit(0)
+
+
+def _run_worker(worker_main, worker_id):
+    """Runs one worker in the forked child and returns its exit code."""
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+    code = 0
+    try:
+        worker_main(worker_id)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException as e:
+        logger.critical("Worker %d crashed: %r", worker_id, e)
+        code = 1
+    # os._exit() skips atexit, so flush the queue/bulk/spool handlers explicitly,
+    # ignoring further SIGTERMs while they drain.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    try:
+        atexit._run_exitfuncs()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return code
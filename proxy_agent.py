@@ -1,79 +1,285 @@
 # agents/proxy_agent.py
 
+import argparse
+import os
 import ssl
-import socket
-import json
 import platform
+import sys
+import threading
+import time
 from scapy.all import sniff, IP, TCP, UDP
-from datetime import datetime
+from datetime import datetime, timezone
+
+from agent_capture import Capture, build_filter, parse_frame, server_endpoints
+from agent_disk_queue import DiskQueue
+from agent_flows import LAYERS, FlowTable
+from agent_pcap import replay
+from agent_pipeline import Pipeline
+from agent_sampling import Sampler
+from agent_sender import BatchSender
+from agent_telemetry import HEARTBEAT_PATH, Heartbeat, post_json
 
 # إعدادات مركز التحكم
 # قم بتحديث هذه القيم بناءً على مخرجاتك من 'minikube ip' و 'kubectl get svc fpm-server'
-SERVER_HOST = "192.168.49.2"  # ضع هنا IP الخاص بـ Minikube
-SERVER_PORT = 30000          # ضع هنا NodePort الخاص بـ FPM Server
+SERVER_HOST = os.environ.get("SERVER_HOST", "192.168.49.2")  # ضع هنا IP الخاص بـ Minikube
+SERVER_PORT = int(os.environ.get("SERVER_PORT", "30000"))    # ضع هنا NodePort الخاص بـ FPM Server
 
 # اسم الجهاز الحالي (لتمييز المصدر)
 HOSTNAME = platform.node()
 
-# تعريف الدالة التي تلتقط الترافيك
+# الإرسال على دفعات عبر اتصال TLS واحد دائم: تُرسل الدفعة عند اكتمال العدد أو مرور الوقت
+BATCH_SIZE = int(os.environ.get("FPM_AGENT_BATCH_SIZE", "500"))
+FLUSH_INTERVAL = float(os.environ.get("FPM_AGENT_FLUSH_INTERVAL", "1.0"))
+# طابور الذاكرة بين الالتقاط والإرسال؛ عند امتلائه تُسقط الأحداث الجديدة بدل إيقاف الالتقاط
+QUEUE_SIZE = int(os.environ.get("FPM_AGENT_QUEUE_SIZE", "50000"))
+BACKOFF_MAX = float(os.environ.get("FPM_AGENT_BACKOFF_MAX", "30"))
+# ضغط الدفعات وصيغتها يُتفاوض عليهما مع الخادم: "auto" يختار zstd/gzip والصيغة العمودية إن أعلنها الخادم
+COMPRESSION = os.environ.get("FPM_AGENT_COMPRESSION", "auto")       # auto | zstd | gzip | none
+BATCH_FORMAT = os.environ.get("FPM_AGENT_BATCH_FORMAT", "auto")     # auto | columnar | ndjson
+# طابور على القرص أثناء انقطاع الخادم ("" = تعطيل)؛ عند تجاوز الحد تُحذف أقدم المقاطع أولًا
+DISK_QUEUE_DIR = os.environ.get("FPM_AGENT_DISK_QUEUE_DIR", "logs/agent-queue")
+DISK_QUEUE_MAX_BYTES = int(os.environ.get("FPM_AGENT_DISK_QUEUE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# سياق TLS واحد لكل العملية: جلسات TLS (session tickets) لا تُستأنف إلا من نفس السياق.
+# استخدام _create_unverified_context لتجاهل التحقق من الشهادة (لبيئة التطوير فقط)
+# في بيئة الإنتاج، يجب استخدام شهادة موثوقة والتحقق منها.
+TLS_CONTEXT = ssl._create_unverified_context()
+
+# وضع الالتقاط: "packet" حدث لكل حزمة (السلوك الأصلي)، "flow" سجل واحد لكل تدفق (5-tuple)
+AGENT_MODE = os.environ.get("FPM_AGENT_MODE", "packet")
+FLOW_IDLE_TIMEOUT = float(os.environ.get("FPM_FLOW_IDLE_TIMEOUT", "15"))
+FLOW_ACTIVE_TIMEOUT = float(os.environ.get("FPM_FLOW_ACTIVE_TIMEOUT", "120"))
+FLOW_MAX_FLOWS = int(os.environ.get("FPM_FLOW_MAX_FLOWS", "65536"))
+
+# الالتقاط: فلتر BPF يُنفَّذ داخل النواة، مع استثناء اتصال الوكيل نفسه بالخادم تلقائيًا
+CAPTURE_IFACE = os.environ.get("FPM_CAPTURE_IFACE") or None
+CAPTURE_FILTER = os.environ.get("FPM_CAPTURE_FILTER", "")
+# "light" يقرأ الترويسات فقط من الإطار الخام؛ "scapy" يحلل الحزمة كاملة (الطريقة الأصلية)
+CAPTURE_PARSER = os.environ.get("FPM_CAPTURE_PARSER", "light")
+CAPTURE_BUFFER = int(os.environ.get("FPM_CAPTURE_BUFFER", str(4 * 1024 * 1024)))
+# خط المعالجة: خيط الالتقاط يضع الإطارات الخام في حلقة محدودة، وعمّال يحللونها ويرمّزونها (0 = بدون مراحل)
+PIPELINE_WORKERS = int(os.environ.get("FPM_AGENT_WORKERS", "2"))
+RING_SIZE = int(os.environ.get("FPM_AGENT_RING_SIZE", "65536"))
+
+disk_queue = DiskQueue(DISK_QUEUE_DIR, max_bytes=DISK_QUEUE_MAX_BYTES) if DISK_QUEUE_DIR else None
+
+# أخذ العينات في وضع الحزم: ميزانية أحداث/ثانية (0 = تعطيل)، مع الاحتفاظ دائمًا بأول الحزم و SYN/FIN/RST
+SAMPLING_TARGET_RATE = float(os.environ.get("FPM_SAMPLING_TARGET_RATE", "0"))
+SAMPLING_FIRST_PACKETS = int(os.environ.get("FPM_SAMPLING_FIRST_PACKETS", "10"))
+SAMPLING_FLOW_RATE = float(os.environ.get("FPM_SAMPLING_FLOW_RATE", "5"))
+SAMPLING_DESTINATION_RATE = float(os.environ.get("FPM_SAMPLING_DESTINATION_RATE", "50"))
+
+sender = BatchSender(SERVER_HOST, SERVER_PORT, TLS_CONTEXT, batch_size=BATCH_SIZE,
+                     flush_interval=FLUSH_INTERVAL, queue_size=QUEUE_SIZE, backoff_max=BACKOFF_MAX,
+                     disk_queue=disk_queue, compression=COMPRESSION, batch_format=BATCH_FORMAT)
+
+flow_table = None
+if AGENT_MODE == "flow":
+    flow_table = FlowTable(lambda record: send_data_to_server(record), host=HOSTNAME,
+                           idle_timeout=FLOW_IDLE_TIMEOUT, active_timeout=FLOW_ACTIVE_TIMEOUT,
+                           max_flows=FLOW_MAX_FLOWS)
+
+sampler = None
+if SAMPLING_TARGET_RATE > 0 and flow_table is None:
+    sampler = Sampler(target_rate=SAMPLING_TARGET_RATE, first_packets=SAMPLING_FIRST_PACKETS,
+                      flow_rate=SAMPLING_FLOW_RATE, destination_rate=SAMPLING_DESTINATION_RATE)
+
+# نبضة صحة الوكيل: عدادات كل المراحل وزمن الإرسال تُرسل دوريًا إلى /agent/heartbeat (0 = تعطيل)
+HEARTBEAT_INTERVAL = float(os.environ.get("FPM_AGENT_HEARTBEAT_INTERVAL", "60"))
+
+heartbeat = None
+if HEARTBEAT_INTERVAL > 0:
+    heartbeat = Heartbeat(lambda: stage_stats(),
+                          lambda document: post_json(SERVER_HOST, SERVER_PORT, TLS_CONTEXT, HEARTBEAT_PATH,
+                                                     document, timeout=5.0),
+                          host=HOSTNAME, interval=HEARTBEAT_INTERVAL, latencies=sender.take_latencies,
+                          extra={"mode": AGENT_MODE, "parser": CAPTURE_PARSER})
+
+# مراحل الالتقاط الحالية (تُنشأ في start_agent)
+capture = None
+pipeline = None
+
+# معالجة حزمة واحدة (من المحلل الخفيف أو من scapy): حدث مستقل أو إضافة إلى جدول التدفقات
+def handle_packet(ts, src_ip, dst_ip, protocol, src_port, dst_port, length, tcp_flags):
+    if flow_table is not None:
+        flow_table.add(ts, src_ip, dst_ip, protocol, src_port, dst_port, length, tcp_flags)
+        return
+    if sampler is not None:
+        sample_rate = sampler.sample(ts, src_ip, dst_ip, protocol, src_port, dst_port, tcp_flags)
+        if not sample_rate:
+            return
+    data = {
+        "timestamp": datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None).isoformat(),
+        "host": HOSTNAME,
+        "src_ip": src_ip,
+        "dst_ip": dst_ip,
+        "protocol": protocol,
+    }
+    if src_port is not None:
+        data["src_port"] = src_port
+        data["dst_port"] = dst_port
+    data["layer"] = LAYERS.get(protocol, "Other")
+    if sampler is not None:
+        # عدد الحزم التي يمثلها هذا الحدث، لإعادة الوزن عند العدّ
+        data["sample_rate"] = sample_rate
+    send_data_to_server(data)
+
+# تعريف الدالة التي تلتقط الترافيك (مسار scapy الكامل، FPM_CAPTURE_PARSER=scapy)
 def packet_callback(packet):
     if IP in packet:
-        data = {
-            "timestamp": datetime.utcnow().isoformat(),
-            "host": HOSTNAME,
-            "src_ip": packet[IP].src,
-            "dst_ip": packet[IP].dst,
-            "protocol": packet[IP].proto,
-        }
-
+        ip = packet[IP]
         if TCP in packet:
-            data["src_port"] = packet[TCP].sport
-            data["dst_port"] = packet[TCP].dport
-            data["layer"] = "TCP"
+            tcp = packet[TCP]
+            handle_packet(float(packet.time), ip.src, ip.dst, ip.proto, tcp.sport, tcp.dport, ip.len, int(tcp.flags))
         elif UDP in packet:
-            data["src_port"] = packet[UDP].sport
-            data["dst_port"] = packet[UDP].dport
-            data["layer"] = "UDP"
+            udp = packet[UDP]
+            handle_packet(float(packet.time), ip.src, ip.dst, ip.proto, udp.sport, udp.dport, ip.len, 0)
         else:
-            data["layer"] = "Other"
+            handle_packet(float(packet.time), ip.src, ip.dst, ip.proto, None, None, ip.len, 0)
 
-        send_data_to_server(data)
+# انتهاء مهلة الخمول يُفحص كل ثانية حتى عندما لا تصل حزم
+def expire_flows_forever():
+    while True:
+        time.sleep(1.0)
+        flow_table.expire(time.time())
 
-# إرسال البيانات إلى مركز التحكم باستخدام TLS
-def send_data_to_server(data):
-    # استخدام _create_unverified_context لتجاهل التحقق من الشهادة (لبيئة التطوير فقط)
-    # في بيئة الإنتاج، يجب استخدام شهادة موثوقة والتحقق منها.
-    context = ssl._create_unverified_context()
+# وضع إعادة التشغيل من ملف pcap: الطابور ينتظر بدل الإسقاط، فلا يضيع أي حدث
+_replaying = False
 
-    try:
-        # إنشاء اتصال TCP عادي
-        with socket.create_connection((SERVER_HOST, SERVER_PORT)) as sock:
-            # تغليف الـ socket باتصال SSL/TLS
-            with context.wrap_socket(sock, server_hostname=SERVER_HOST) as ssock:
-                # إرسال البيانات بعد تحويلها إلى JSON ثم إلى بايتات
-                ssock.sendall(json.dumps(data).encode('utf-8'))
-                print(f"[+] Data sent successfully from {HOSTNAME}.", file=sys.stdout)
-    except ConnectionRefusedError:
-        print(f"[!] Connection refused to {SERVER_HOST}:{SERVER_PORT}. Is the FPM Server running?", file=sys.stderr)
-    except Exception as e:
-        print(f"[!] Error sending data from {HOSTNAME}: {e}", file=sys.stderr)
+def replay_frame(ts, link, frame):
+    fields = parse_frame(frame, link)
+    if fields is not None:
+        handle_packet(ts, *fields)
+
+# إرسال البيانات إلى مركز التحكم: وضعها في الطابور فقط، والإرسال يتم في خيط منفصل (agent_sender.py)
+def send_data_to_server(data):
+    if not sender.submit(data, block=_replaying):
+        dropped = sender.stats["dropped"]
+        if dropped & (dropped - 1) == 0:   # 1, 2, 4, 8, ... حتى لا تُغرق الرسائل السجل
+            print(f"[!] Send queue full, {dropped} event(s) dropped so far.", file=sys.stderr)
 
 # نقطة التشغيل
-def start_agent():
+def start_agent(pcap_files=None, speed=0.0):
+    """
+    Captures live traffic, or replays pcap/pcapng files, and sends the events to the FPM server.
+
+    Args:
+        pcap_files (list|None): Capture files to replay instead of sniffing an interface.
+        speed (float): Replay pacing: 0 = as fast as possible, 1 = original timing, N = N times faster.
+    """
     print(f"[*] Starting proxy agent on {HOSTNAME}...", file=sys.stdout)
-    print(f"[*] Sending captured data to FPM Server at: {SERVER_HOST}:{SERVER_PORT}", file=sys.stdout)
+    print(f"[*] Sending captured data to FPM Server at: {SERVER_HOST}:{SERVER_PORT} "
+          f"(batches of {BATCH_SIZE}, every {FLUSH_INTERVAL}s)", file=sys.stdout)
+    if disk_queue is not None:
+        disk_queue.open()
+        backlog = disk_queue.snapshot()
+        print(f"[*] Disk queue {DISK_QUEUE_DIR}: {backlog['backlog_events']} event(s) "
+              f"({backlog['backlog_bytes']} bytes) waiting from a previous run", file=sys.stdout)
+    sender.start()
+    if heartbeat is not None:
+        print(f"[*] Heartbeat every {HEARTBEAT_INTERVAL:g}s to {HEARTBEAT_PATH}", file=sys.stdout)
+        heartbeat.start()
+    if flow_table is not None:
+        print(f"[*] Flow mode: idle timeout {FLOW_IDLE_TIMEOUT}s, active timeout {FLOW_ACTIVE_TIMEOUT}s, "
+              f"up to {FLOW_MAX_FLOWS} flows", file=sys.stdout)
+        if not pcap_files:
+            threading.Thread(target=expire_flows_forever, name="fpm-flow-expiry", daemon=True).start()
+    if sampler is not None:
+        print(f"[*] Sampling toward {SAMPLING_TARGET_RATE:g} events/s (first {SAMPLING_FIRST_PACKETS} packets "
+              f"and SYN/FIN/RST always kept)", file=sys.stdout)
+    if pcap_files:
+        _replay(pcap_files, speed)
+        return
+    global capture, pipeline
+    exclude = server_endpoints(SERVER_HOST, SERVER_PORT)
+    print(f"[*] Pipeline: ring of {RING_SIZE} packets, {PIPELINE_WORKERS} worker(s)", file=sys.stdout)
     try:
         # بدء التقاط حركة المرور
-        sniff(prn=packet_callback, store=False)
+        if CAPTURE_PARSER == "scapy":
+            bpf = build_filter(CAPTURE_FILTER, exclude)
+            print(f"[*] Capturing with scapy dissection, filter: {bpf or 'none'}", file=sys.stdout)
+            pipeline = Pipeline(packet_callback, workers=PIPELINE_WORKERS, ring_size=RING_SIZE).start()
+            sniff(prn=pipeline.push, store=False, iface=CAPTURE_IFACE, filter=bpf or None)
+        else:
+            capture = Capture(handle_packet, iface=CAPTURE_IFACE, user_filter=CAPTURE_FILTER,
+                              exclude=exclude, buffer_bytes=CAPTURE_BUFFER).open()
+            print(f"[*] Capturing with filter: {capture.bpf or 'none'} "
+                  f"({'kernel' if capture.kernel_filter else 'user space'})", file=sys.stdout)
+            pipeline = Pipeline(capture.process, workers=PIPELINE_WORKERS, ring_size=RING_SIZE).start()
+            capture.run(pipeline.push)
     except PermissionError:
         print("[!] Permission denied. You might need to run this script with administrator/root privileges (e.g., sudo python3 proxy_agent.py).", file=sys.stderr)
     except Exception as e:
         print(f"[!] An error occurred during sniffing: {e}", file=sys.stderr)
+    finally:
+        stop_agent()
+
+# عدادات كل مرحلة: الالتقاط (مع إسقاطات النواة)، الحلقة، العمّال، التدفقات/العينات، المرسل، طابور القرص
+def stage_stats():
+    stages = {}
+    if capture is not None:
+        stages["capture"] = dict(capture.kernel_stats())
+    if pipeline is not None:
+        stages.update(pipeline.snapshot())
+    if flow_table is not None:
+        stages["flows"] = dict(flow_table.stats, active=len(flow_table))
+    if sampler is not None:
+        stages["sampling"] = dict(sampler.stats, scale=round(sampler.scale, 4))
+    stages["sender"] = sender.snapshot()
+    if disk_queue is not None:
+        stages["disk_queue"] = disk_queue.snapshot()
+    return stages
+
+# إيقاف الوكيل: إنهاء ما في الحلقة، تفريغ التدفقات المفتوحة وإرسال ما تبقى في الطابور
+def stop_agent(timeout=5.0):
+    if pipeline is not None:
+        pipeline.close(timeout)
+    if flow_table is not None:
+        flow_table.flush()
+    sender.close(timeout)
+    if heartbeat is not None:
+        heartbeat.close()
+    for stage, stats in stage_stats().items():
+        print(f"[*] {stage}: {stats}", file=sys.stdout)
+
+# إعادة تشغيل ملفات pcap عبر نفس مسار المعالجة والإرسال، مع تقرير الإنتاجية من البداية حتى تأكيد الخادم
+def _replay(pcap_files, speed):
+    global _replaying, pipeline
+    _replaying = True
+    # blocking ring: the file can wait for the workers, nothing is dropped
+    pipeline = Pipeline(replay_frame, workers=PIPELINE_WORKERS, ring_size=RING_SIZE, block=True).start()
+    pacing = "as fast as possible" if speed <= 0 else f"at {speed:g}x original timing"
+    print(f"[*] Replaying {', '.join(pcap_files)} {pacing}", file=sys.stdout)
+    started = time.perf_counter()
+
+    def expire_flows(ts):
+        # expire on capture time only once the workers have processed every packet before it, or a flow
+        # whose next packets are still in the ring would be cut in two
+        pipeline.drain()
+        flow_table.expire(ts)
+
+    on_tick = expire_flows if flow_table is not None else None
+    try:
+        packets = replay(pcap_files, pipeline.push, speed=speed, on_tick=on_tick)
+    except KeyboardInterrupt:
+        packets = None
+    captured = time.perf_counter() - started
+    stop_agent(timeout=None)
+    elapsed = time.perf_counter() - started
+    if packets:
+        print(f"[*] Replay: {packets} packets in {captured:.2f}s ({packets / captured:.0f} packets/s read); "
+              f"{sender.stats['sent_events']} events acknowledged by the server after {elapsed:.2f}s "
+              f"({packets / elapsed:.0f} packets/s, {sender.stats['sent_events'] / elapsed:.0f} events/s end to end)",
+              file=sys.stdout)
 
 if __name__ == "__main__":
     # تأكد من أن مخرجات stdout و stderr غير مخزنة مؤقتًا
-    import sys
-    import os
     sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', buffering=1)
     sys.stderr = os.fdopen(sys.stderr.fileno(), 'w', buffering=1)
-    start_agent()
+    parser = argparse.ArgumentParser(description="FPM proxy agent")
+    parser.add_argument("--pcap", nargs="+", metavar="FILE",
+                        help="replay pcap/pcapng files (optionally .gz) instead of sniffing")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="replay pacing: 0 = as fast as possible (default), 1 = original timing, N = N times faster")
+    args = parser.parse_args()
+    start_agent(args.pcap, args.speed)
@@ -0,0 +1,182 @@
+# schema.py
+"""
+Compiled schema for agent events, applied at ingest before anything is stored.
+
+The declarative FIELDS table is compiled once into a list of per-field
+checker functions; validate() then walks an event in a single pass, coercing
+values to the types the Elasticsearch mapping expects (ports and protocol as
+integers, addresses in canonical form, the layer name from a fixed set) and
+raising SchemaError with the field name and the reason for the first problem.
+
+    timestamp   required, ISO-8601 string (a trailing "Z" is accepted) or epoch seconds
+    src_ip      required, IPv4 or IPv6 address
+    dst_ip      required, IPv4 or IPv6 address
+    host        optional, non-empty string (agent host name)
+    protocol    optional, IP protocol number 0-255 or a name such as "TCP"
+    src_port    optional, integer 0-65535
+    dst_port    optional, integer 0-65535
+    layer       optional, "TCP", "UDP" or "Other" (derived from protocol when absent)
+
+Other fields pass through unchanged, within MAX_FIELDS / MAX_STRING_LENGTH.
+"""
+import socket
+from datetime import datetime, timezone
+
+MAX_FIELDS = 64
+MAX_STRING_LENGTH = 4096
+MAX_HOST_LENGTH = 255
+
+PROTOCOL_NUMBERS = {"ICMP": 1, "TCP": 6, "UDP": 17, "ICMPV6": 58}
+LAYERS = {"TCP": "TCP", "UDP": "UDP", "OTHER": "Other"}
+LAYER_BY_PROTOCOL = {6: "TCP", 17: "UDP"}
+_CANONICAL_LAYERS = frozenset(LAYERS.values())
+
+
+class SchemaError(ValueError):
+    """Raised for an event that does not match the schema; names the offending field."""
+
+    def __init__(self, field, reason):
+        super().__init__(f"{field}: {reason}")
+        self.field = field
+        self.reason = reason
+
+
+def _integer(low, high):
+    def check(value):
+        if type(value) is int and low <= value <= high:
+            return value
+        if isinstance(value, bool):
+            raise ValueError(f"expected an integer, got {value!r}")
+        if isinstance(value, str) and value.isascii() and value.isdigit():
+            value = int(value)
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)
+        elif not isinstance(value, int):
+            raise ValueError(f"expected an integer, got {type(value).__name__}")
+        if not low <= value <= high:
+            raise ValueError(f"{value} out of range {low}-{high}")
+        return value
+    return check
+
+
+def _string(max_length):
+    def check(value):
+        if not isinstance(value, str):
+            raise ValueError(f"expected a string, got {type(value).__name__}")
+        if not value:
+            raise ValueError("must not be empty")
+        if len(value) > max_length:
+            raise ValueError(f"longer than {max_length} characters")
+        return value
+    return check
+
+
+def _ip_address(value):
+    if not isinstance(value, str):
+        raise ValueError(f"expected an IP address string, got {type(value).__name__}")
+    # inet_pton is a C call; ipaddress.ip_address() costs several times more per event.
+    try:
+        socket.inet_pton(socket.AF_INET, value)
+        return value
+    except OSError:
+        pass
+    try:
+        return socket.inet_ntop(socket.AF_INET6, socket.inet_pton(socket.AF_INET6, value))
+    except (OSError, ValueError):
+        raise ValueError(f"{value[:64]!r} is not an IPv4/IPv6 address")
+
+
+def _timestamp(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        try:
+            return datetime.fromtimestamp(value, timezone.utc).isoformat()
+        except (OverflowError, OSError, ValueError):
+            raise ValueError(f"epoch {value!r} out of range")
+    if not isinstance(value, str):
+        raise ValueError(f"expected an ISO-8601 string, got {type(value).__name__}")
+    text = value[:-1] + "+00:00" if value.endswith("Z") else value
+    try:
+        datetime.fromisoformat(text)
+    except ValueError:
+        raise ValueError(f"{value[:64]!r} is not an ISO-8601 timestamp")
+    # Stored as sent, so existing consumers see the same format as before.
+    return value
+
+
+_protocol_number = _integer(0, 255)
+
+
+def _protocol(value):
+    if type(value) is int and 0 <= value <= 255:
+        return value
+    if isinstance(value, str) and not value.isdigit():
+        number = PROTOCOL_NUMBERS.get(value.upper())
+        if number is None:
+            raise ValueError(f"unknown protocol name {value[:32]!r}")
+        return number
+    return _protocol_number(value)
+
+
+def _layer(value):
+    if type(value) is str and value in _CANONICAL_LAYERS:
+        return value
+    if not isinstance(value, str) or value.upper() not in LAYERS:
+        raise ValueError(f"expected one of {sorted(LAYERS.values())}, got {str(value)[:32]!r}")
+    return LAYERS[value.upper()]
+
+
+# (name, required, checker)
+FIELDS = (
+    ("timestamp", True, _timestamp),
+    ("src_ip", True, _ip_address),
+    ("dst_ip", True, _ip_address),
+    ("host", False, _string(MAX_HOST_LENGTH)),
+    ("protocol", False, _protocol),
+    ("src_port", False, _integer(0, 65535)),
+    ("dst_port", False, _integer(0, 65535)),
+    ("layer", False, _layer),
+)
+
+
+def compile_schema(fields=FIELDS):
+    """Turns a field table into the validate(event) function."""
+    compiled = tuple((name, check) for name, _, check in fields)
+    required = tuple(name for name, is_required, _ in fields if is_required)
+    known = frozenset(name for name, _, _ in fields)
+
+    def validate(event):
+        """
+        Validates and normalizes an event in place.
+
+        Returns:
+            dict: The same event, with known fields coerced to their canonical types.
+
+        Raises:
+            SchemaError: For the first field that is missing or invalid.
+        """
+        if len(event) > MAX_FIELDS:
+            raise SchemaError("event", f"more than {MAX_FIELDS} fields")
+        for name in required:
+            if event.get(name) is None:
+                raise SchemaError(name, "missing required field")
+        for name, check in compiled:
+            value = event.get(name)
+            if value is None:
+                continue
+            try:
+                event[name] = check(value)
+            except ValueError as e:
+                raise SchemaError(name, str(e))
+        # Known fields are bounded by their checkers; only pass-through strings need the length cap.
+        if len(event) > len(known):
+            for name, value in event.items():
+                if name not in known and type(value) is str and len(value) > MAX_STRING_LENGTH:
+                    raise SchemaError(name, f"longer than {MAX_STRING_LENGTH} characters")
+        if "layer" not in event and "protocol" in event:
+            event["layer"] = LAYER_BY_PROTOCOL.get(event["protocol"], "Other")
+        return event
+
+    return validate
+
+
+validate = compile_schema()
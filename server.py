@@ -2,15 +2,27 @@
 import ssl
 import socket
 import threading
-import json
 import os
+import atexit
 from datetime import datetime
 from elasticsearch import Elasticsearch
 import sys
 import io
+import time
+from collections import Counter
+
+from es_bulk import BulkIndexer
+from dedup import Deduplicator, document_id
+from spool import SpoolWriter
+from http_protocol import HTTPError, RequestReader, build_response, wants_keep_alive
+from ingest_queue import IngestQueue, QueueClosed, QueueFull
+import ingest
+import log
+import metrics
+import tls
 
 # إعدادات Elasticsearch
-es = Elasticsearch("http://elasticsearch:9200")
+ES_HOST = "http://elasticsearch:9200"
 
 # إعدادات TLS
 CERTFILE = 'certs/server.crt'
@@ -18,140 +30,395 @@ KEYFILE = 'certs/server.key'
 HOST = '0.0.0.0'
 PORT = 8443
 
-LOG_FILE = 'logs/traffic_log.jsonl'
+# وضع التشغيل: "threaded" (خيط لكل اتصال) أو "async" (محرك asyncio في async_server.py)
+SERVER_MODE = os.environ.get("FPM_SERVER_MODE", "threaded")
+# الحد الأقصى للاتصالات المتزامنة في وضع async
+MAX_CONNECTIONS = int(os.environ.get("FPM_MAX_CONNECTIONS", "1024"))
+# عدد العمليات (workers) التي تتشارك المنفذ عبر SO_REUSEPORT؛ 1 = عملية واحدة بدون مشرف
+WORKERS = int(os.environ.get("FPM_WORKERS", "1"))
+
+# إعدادات الفهرسة المجمّعة (bulk) في Elasticsearch
+BULK_MAX_BATCH = int(os.environ.get("FPM_BULK_MAX_BATCH", "500"))
+BULK_FLUSH_INTERVAL = float(os.environ.get("FPM_BULK_FLUSH_INTERVAL", "1.0"))
+BULK_MAX_BUFFER = int(os.environ.get("FPM_BULK_MAX_BUFFER", "10000"))
+
+# سجل الأحداث المحلي (spool): ملفات مقسّمة بدل logs/traffic_log.jsonl الوحيد
+SPOOL_DIR = os.environ.get("FPM_SPOOL_DIR", "logs/spool")
+# "never" = بدون fsync، 0 = بعد كل دفعة، N = كل N ثانية على الأكثر
+_fsync = os.environ.get("FPM_SPOOL_FSYNC_INTERVAL", "1.0")
+SPOOL_FSYNC_INTERVAL = None if _fsync == "never" else float(_fsync)
+SPOOL_SEGMENT_MB = int(os.environ.get("FPM_SPOOL_SEGMENT_MB", "64"))
+SPOOL_SEGMENT_SECONDS = float(os.environ.get("FPM_SPOOL_SEGMENT_SECONDS", "3600"))
+SPOOL_MAX_SEGMENTS = int(os.environ.get("FPM_SPOOL_MAX_SEGMENTS", "48"))
+SPOOL_COMPRESS = os.environ.get("FPM_SPOOL_COMPRESS", "1") == "1"
+
+# طابور الاستقبال المحدود بين تحليل الطلبات والتخزين، وسياسة التعامل مع الامتلاء:
+# "reject" = رد 429 مع Retry-After، "drop" = حذف الأحداث الأقل أولوية، "spill" = تفريغ إلى القرص
+INGEST_QUEUE_SIZE = int(os.environ.get("FPM_INGEST_QUEUE_SIZE", "50000"))
+SHED_POLICY = os.environ.get("FPM_SHED_POLICY", "reject")
+RETRY_AFTER_SECONDS = int(os.environ.get("FPM_RETRY_AFTER", "2"))
+SPILL_DIR = os.environ.get("FPM_SPILL_DIR", "logs/overflow")
+
+# إزالة التكرار: نافذة تذكّر event_id بالثواني (0 = بدون ذاكرة، مع بقاء _id الحتمي في Elasticsearch)
+DEDUP_WINDOW = float(os.environ.get("FPM_DEDUP_WINDOW", "600"))
+DEDUP_MAX_KEYS = int(os.environ.get("FPM_DEDUP_MAX_KEYS", "1000000"))
+
+# فهرس نبضات صحة الوكلاء (/agent/heartbeat)، منفصل عن أحداث الحزم
+HEALTH_INDEX = os.environ.get("FPM_AGENT_HEALTH_INDEX", "fpm-agent-health")
+
+# منفذ HTTP عادي لـ /metrics (Prometheus)؛ في وضع pre-fork يستخدم كل worker المنفذ + رقمه، و0 = تعطيل
+METRICS_PORT = int(os.environ.get("FPM_METRICS_PORT", "9100"))
+# أقصى عدد من الأجهزة المصدر بعداد مستقل؛ ما يزيد يُجمع تحت host="other"
+METRICS_MAX_HOSTS = int(os.environ.get("FPM_METRICS_MAX_HOSTS", "1000"))
+
 os.makedirs('logs', exist_ok=True)
 
-# تحليل وتسجيل البيانات
+logger = log.get_logger("server")
+
+REQUESTS = metrics.counter(
+    "fpm_requests_total", "Ingestion requests by endpoint and response status",
+    labelnames=("endpoint", "status"))
+RECEIVED_BYTES = metrics.counter(
+    "fpm_received_bytes_total", "Request body bytes received, before decompression",
+    labelnames=("endpoint",))
+PARSE_SECONDS = metrics.histogram(
+    "fpm_request_parse_seconds", "Time to decompress and parse a request body",
+    labelnames=("endpoint",),
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+EVENTS_BY_HOST = metrics.counter(
+    "fpm_events_received_total", "Events accepted per source host (the event's \"host\" field)",
+    labelnames=("host",))
+_seen_hosts = set()
+NOT_INDEXED = metrics.counter(
+    "fpm_events_not_indexed_total",
+    "Queued events the bulk indexer refused because it was closing (kept in the spool for spool.py replay)")
+
+AGENT_HEARTBEATS = metrics.counter(
+    "fpm_agent_heartbeats_total", "Heartbeats received per agent host", labelnames=("host",))
+AGENT_KERNEL_DROPS = metrics.gauge(
+    "fpm_agent_kernel_drops", "Packets the agent's kernel socket dropped since the agent started",
+    labelnames=("host",))
+AGENT_RING_DROPS = metrics.gauge(
+    "fpm_agent_ring_drops", "Packets dropped by the agent's full ring buffer since it started",
+    labelnames=("host",))
+AGENT_SEND_QUEUE_DEPTH = metrics.gauge(
+    "fpm_agent_send_queue_depth", "Events waiting in the agent's send queue at its last heartbeat",
+    labelnames=("host",))
+AGENT_SEND_LATENCY_P99 = metrics.gauge(
+    "fpm_agent_send_latency_p99_seconds", "99th percentile batch send latency over the agent's last interval",
+    labelnames=("host",))
+
+# مراحل التخزين؛ تُنشأ في init_pipeline() داخل كل عملية (وليس عند الاستيراد)
+es = None
+bulk_indexer = None
+health_indexer = None
+spool = None
+ingest_queue = None
+deduplicator = None
+
+# تخزين حدث واحد (مشترك بين الوضعين)
+def store_event(decoded):
+    """
+    Appends a decoded event to the local spool and queues it for bulk indexing.
+
+    Returns:
+        bool: False if the bulk indexer is already closed (shutdown); the event
+              is then only in the spool and reaches Elasticsearch through spool.py replay.
+    """
+    spool.append(decoded)
+    if bulk_indexer.add(decoded):
+        return True
+    # الـ agent استلم 200 مسبقًا: الحدث محفوظ في الـ spool فقط، لذا نعدّه ونبلّغ عنه
+    NOT_INDEXED.inc()
+    dropped = NOT_INDEXED.value()
+    if dropped & (dropped - 1) == 0:   # 1, 2, 4, 8, ...
+        logger.warning("Bulk indexer closed: %d event(s) kept only in the spool %s (replay with spool.py replay).",
+                       dropped, spool.directory)
+    return False
+
+# تخزين نبضة صحة وكيل في فهرسها الخاص (بدون spool: ليست دليلًا جنائيًا)
+def store_heartbeat(heartbeat):
+    """Queues an agent heartbeat for bulk indexing into the health index; False once the indexer is closed."""
+    return health_indexer.add(heartbeat)
+
+# إنشاء عميل Elasticsearch وخيوط الكتابة (queue + spool + bulk) وتفريغ ما تبقى عند الإغلاق
+def init_pipeline(worker_id=None):
+    """
+    Creates this process's Elasticsearch client, bulk indexer, spool, ingest queue and deduplicator.
+
+    Args:
+        worker_id (int|None): In pre-fork mode each worker gets its own client and
+                              buffers, and its own spool/spill subdirectory.
+    """
+    global es, bulk_indexer, health_indexer, spool, ingest_queue, deduplicator
+    if ingest_queue is not None:
+        return
+    spool_dir, spill_dir = SPOOL_DIR, SPILL_DIR
+    if worker_id is not None:
+        spool_dir = os.path.join(SPOOL_DIR, f"worker-{worker_id}")
+        spill_dir = os.path.join(SPILL_DIR, f"worker-{worker_id}")
+
+    es = Elasticsearch(ES_HOST)
+    bulk_indexer = BulkIndexer(es, index="forensic-logs", max_batch=BULK_MAX_BATCH,
+                               flush_interval=BULK_FLUSH_INTERVAL, max_buffer=BULK_MAX_BUFFER,
+                               id_func=document_id)
+    health_indexer = BulkIndexer(es, index=HEALTH_INDEX, max_batch=BULK_MAX_BATCH,
+                                 flush_interval=BULK_FLUSH_INTERVAL, max_buffer=BULK_MAX_BUFFER)
+    spool = SpoolWriter(spool_dir, fsync_interval=SPOOL_FSYNC_INTERVAL,
+                        max_segment_bytes=SPOOL_SEGMENT_MB * 1024 * 1024,
+                        max_segment_age=SPOOL_SEGMENT_SECONDS, compress=SPOOL_COMPRESS,
+                        max_segments=SPOOL_MAX_SEGMENTS)
+    # store_event يُستدعى عبر lambda (global lookup حتى يمكن استبداله في benchmark.py)
+    ingest_queue = IngestQueue(lambda event: store_event(event), maxsize=INGEST_QUEUE_SIZE,
+                               policy=SHED_POLICY, retry_after=RETRY_AFTER_SECONDS, spill_dir=spill_dir)
+    deduplicator = Deduplicator(window=DEDUP_WINDOW, max_keys=DEDUP_MAX_KEYS)
+
+    spool.start()
+    bulk_indexer.start()
+    health_indexer.start()
+    ingest_queue.start()
+    # atexit runs in reverse order: drain the queue first, then the writers behind it.
+    atexit.register(spool.close)
+    atexit.register(bulk_indexer.close)
+    atexit.register(health_indexer.close)
+    atexit.register(ingest_queue.close)
+
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_PORT + (worker_id or 0))
+
+# تسمية host في المقاييس مع حد أقصى لعدد السلاسل (cardinality)
+def _host_label(host):
+    if host not in _seen_hosts:
+        if len(_seen_hosts) >= METRICS_MAX_HOSTS:
+            return "other"
+        _seen_hosts.add(host)
+    return host
+
+# عدّ الأحداث حسب الجهاز المصدر
+def count_events_by_host(events):
+    for host, count in Counter(str(event.get("host", "unknown")) for event in events).items():
+        EVENTS_BY_HOST.inc(count, host=_host_label(host))
+
+# نبضة صحة الوكيل: تُفهرس كما هي، وأهم قيمها تُعرض أيضًا في /metrics
+def record_heartbeat(heartbeat):
+    host = _host_label(heartbeat["host"])
+    AGENT_HEARTBEATS.inc(host=host)
+    if host == "other":
+        return
+    for gauge, stage, field in ((AGENT_KERNEL_DROPS, "capture", "kernel_drops"),
+                                (AGENT_RING_DROPS, "ring", "dropped"),
+                                (AGENT_SEND_QUEUE_DEPTH, "sender", "depth")):
+        value = (heartbeat.get(stage) or {}).get(field)
+        if isinstance(value, (int, float)):
+            gauge.set(value, host=host)
+    p99 = (heartbeat.get("send_latency_ms") or {}).get("p99")
+    if isinstance(p99, (int, float)):
+        AGENT_SEND_LATENCY_P99.set(p99 / 1000.0, host=host)
+
+# توجيه الطلب حسب المسار (مشترك بين الوضعين)
+def process_request(method, path, headers, body, addr):
+    """
+    Decodes a request body and stores the event(s) it carries.
+
+    Returns:
+        tuple: (status, content_type, response_body, extra_headers)
+    """
+    path = path.split("?", 1)[0]
+    if path == ingest.BATCH_PATH:
+        endpoint = "batch"
+    elif path in ingest.SINGLE_EVENT_PATHS:
+        endpoint = "single"
+    elif path == ingest.HEARTBEAT_PATH:
+        endpoint = "heartbeat"
+    else:
+        endpoint = "unknown"
+    response = _process_request(endpoint, path, headers, body, addr)
+    REQUESTS.inc(endpoint=endpoint, status=str(response[0]))
+    return response
+
+def _process_request(endpoint, path, headers, body, addr):
+    if endpoint == "unknown":
+        return 404, "text/plain", f"Unknown path {path}", None
+    RECEIVED_BYTES.inc(len(body), endpoint=endpoint)
+    started = time.perf_counter()
+    content_encoding = headers.get("content-encoding", "")
+    try:
+        data = ingest.decode_content(body, content_encoding)
+        if endpoint == "heartbeat":
+            heartbeat = ingest.parse_heartbeat(data)
+        elif endpoint == "batch":
+            events, errors = ingest.parse_batch(data, headers.get("content-type", ""), content_encoding)
+        else:
+            events, errors = [ingest.parse_event(data)], []
+    except ingest.PayloadError as e:
+        logger.warning("Rejected payload from %s: %s %s", addr, e.status, e.message)
+        # 415: تخبر الوكيل بما يمكن فكه حتى يعيد الإرسال بترميز مدعوم
+        return e.status, "text/plain", e.message, ingest.negotiation_headers() if e.status == 415 else None
+    finally:
+        PARSE_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+
+    if endpoint == "heartbeat":
+        record_heartbeat(heartbeat)
+        if not store_heartbeat(heartbeat):
+            return 503, "text/plain", "shutting down", {"Retry-After": str(RETRY_AFTER_SECONDS)}
+        log.sampled_debug(logger, "Heartbeat from %s (%s)", heartbeat["host"], addr)
+        return 200, "text/plain", "OK", None
+
+    # إعادة الإرسال من الوكيل (retry) تُقبل بصمت دون تخزين نسخة ثانية
+    fresh, keys = deduplicator.filter(events)
+    try:
+        if fresh:
+            ingest_queue.offer(fresh)
+    except QueueFull as e:
+        # لم تُخزَّن، لذا يجب ألا تُعتبر مكررة عند إعادة المحاولة
+        deduplicator.forget(keys)
+        status = 503 if isinstance(e, QueueClosed) else 429
+        logger.warning("Shedding %d event(s) from %s: %s", len(fresh), addr, e)
+        return status, "text/plain", str(e), {"Retry-After": str(e.retry_after)}
+    count_events_by_host(fresh)
+
+    if endpoint == "batch":
+        if errors:
+            logger.info("Batch from %s: %d invalid line(s) rejected.", addr, len(errors))
+        log.sampled_debug(logger, "Received batch of %d events from %s", len(events), addr)
+        return (200, "application/json", ingest.batch_response(len(events), errors, len(events) - len(fresh)),
+                ingest.negotiation_headers())
+    log.sampled_debug(logger, "Received from %s: %r", addr, events[0])
+    return 200, "text/plain", "OK", None
+
+# تحليل وتسجيل البيانات: قراءة متدفقة حتى اكتمال الجسم (Content-Length أو chunked) مع دعم keep-alive
 def handle_client(connstream, addr):
-    json_payload_str = "" # تهيئة المتغير خارج كتلة try
+    reader = RequestReader(connstream, methods=("POST",), paths=ingest.PATHS)
     try:
-        print(f"[DEBUG] handle_client started for {addr}", file=sys.stderr)
-        raw_data = connstream.recv(8192)
-        if not raw_data:
-            print(f"[!] No data received from {addr} after SSL handshake. Client likely closed connection.", file=sys.stderr)
-            return
-
-        print(f"[DEBUG] Raw data received from {addr}: {raw_data!r}", file=sys.stderr)
-
-        # البحث عن نهاية الرؤوس (سطر فارغ)
-        header_end_index = raw_data.find(b'\r\n\r\n')
-        
-        # Add debug print for header_end_index
-        print(f"[DEBUG] header_end_index: {header_end_index}", file=sys.stderr)
-
-        if header_end_index == -1:
-            print(f"[!] Invalid HTTP request format from {addr}: No end of headers found.", file=sys.stderr)
-            return
-
-        # استخراج الجزء الخاص بالرؤوس والجزء الخاص بالجسم
-        headers_part = raw_data[:header_end_index].decode('utf-8')
-        json_bytes_payload = raw_data[header_end_index + 4:] # +4 for \r\n\r\n
-
-        # Add debug print for headers_part
-        print(f"[DEBUG] Headers part: {headers_part!r}", file=sys.stderr)
-
-        # البحث عن Content-Length في الرؤوس (للتصحيح والتحقق)
-        content_length = 0
-        for line in headers_part.split('\r\n'):
-            if line.lower().startswith('content-length:'):
-                try:
-                    content_length = int(line.split(':')[1].strip())
-                    break
-                except ValueError:
-                    pass
-
-        print(f"[DEBUG] Content-Length header: {content_length}", file=sys.stderr)
-        print(f"[DEBUG] Length of received body part: {len(json_bytes_payload)}", file=sys.stderr)
-        print(f"[DEBUG] JSON payload bytes (first 20): {json_bytes_payload[:20]!r}", file=sys.stderr)
-
-
-        # التأكد من أننا قرأنا كل الجسم (إذا كان Content-Length أكبر من 0)
-        if content_length > 0 and len(json_bytes_payload) < content_length:
-            # في سيناريو حقيقي، قد تحتاج إلى قراءة المزيد من connstream
-            # ولكن لـ curl، عادة ما يرسل كل شيء مرة واحدة
-            print(f"[!] Incomplete body received from {addr}. Expected {content_length}, got {len(json_bytes_payload)}.", file=sys.stderr)
-            return
-
-        if not json_bytes_payload:
-            print(f"[!] No JSON payload found after headers from {addr}.", file=sys.stderr)
-            return
-
-        # فك تشفير حمولة JSON وإزالة أي مسافات بيضاء زائدة
-        json_payload_str = json_bytes_payload.decode('utf8').strip()
-        print(f"[DEBUG] Extracted JSON payload string for parsing (stripped): {json_payload_str!r}", file=sys.stderr)
-        print(f"[DEBUG] Length of extracted JSON payload string (stripped): {len(json_payload_str)}", file=sys.stderr)
-
-
-        # محاولة تحليل JSON
-        decoded = json.loads(json_payload_str)
-
-        print(f"[+] Received from {addr}: {decoded}")
-
-        with open(LOG_FILE, 'a') as f:
-            f.write(json.dumps(decoded) + '\n')
-
-        es.index(
-            index="forensic-logs",
-            document=decoded,
-            refresh=True
-        )
-        print("[✓] Stored entry in Elasticsearch.")
-        client_sock.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\nOK")
-
-    except json.JSONDecodeError as e:
-        print(f"[!] JSON decoding error from {addr}: {e} - Payload: {json_payload_str!r}", file=sys.stderr)
+        while True:
+            try:
+                request = reader.read_request()
+                if request is None:
+                    return
+                method, path, version, headers, body = request
+                log.sampled_debug(logger, "Request from %s: %s %s %s, %d body bytes",
+                                  addr, method, path, version, len(body))
+            except HTTPError as e:
+                # بعد خطأ في التأطير لا نعرف موضع الطلب التالي، لذا نغلق الاتصال دائمًا
+                logger.warning("Invalid HTTP request from %s: %s %s", addr, e.status, e.message)
+                connstream.sendall(build_response(e.status, e.message, keep_alive=False, extra_headers=e.headers))
+                return
+
+            keep_alive = wants_keep_alive(version, headers)
+            # فك الترميز وتحليل JSON وتخزين الحدث/الدفعة
+            status, content_type, response_body, extra_headers = process_request(method, path, headers, body, addr)
+            connstream.sendall(build_response(status, response_body, content_type=content_type,
+                                              keep_alive=keep_alive, extra_headers=extra_headers))
+            if not keep_alive:
+                return
+
     except ssl.SSLError as e:
-        print(f"[!] SSL error during client handling for {addr}: {e}", file=sys.stderr)
+        logger.warning("SSL error during client handling for %s: %s", addr, e)
     except Exception as e:
-        print(f"[!] General error handling client {addr}: {e}", file=sys.stderr)
+        logger.error("General error handling client %s: %s", addr, e)
     finally:
-        if connstream:
-            connstream.close()
-
-# بدء الخادم
-def start_server():
-    sys.stdout.reconfigure(line_buffering=True)
-    sys.stderr.reconfigure(line_buffering=True)
+        connstream.close()
 
+# تجهيز سياق TLS (مشترك بين الوضعين)
+def create_ssl_context(certfile=CERTFILE, keyfile=KEYFILE):
     context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     try:
-        context.load_cert_chain(certfile=CERTFILE, keyfile=KEYFILE)
-        print(f"[DEBUG] Certificates loaded: {CERTFILE}, {KEYFILE}", file=sys.stderr)
+        context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+        logger.debug("Certificates loaded: %s, %s", certfile, keyfile)
     except FileNotFoundError:
-        print(f"[FATAL] Certificate file not found: {CERTFILE} or {KEYFILE}", file=sys.stderr)
+        logger.critical("Certificate file not found: %s or %s", certfile, keyfile)
         sys.exit(1)
     except ssl.SSLError as e:
-        print(f"[FATAL] SSL Certificate or Key error: {e}", file=sys.stderr)
+        logger.critical("SSL Certificate or Key error: %s", e)
         sys.exit(1)
     except Exception as e:
-        print(f"[FATAL] Unexpected error loading certificates: {e}", file=sys.stderr)
+        logger.critical("Unexpected error loading certificates: %s", e)
+        sys.exit(1)
+    # تذاكر الجلسات + خوارزميات ECDHE/AEAD فقط (tls.py)؛ يُبنى السياق قبل fork لتتشارك العمليات مفاتيح التذاكر
+    try:
+        tls.tune_server_context(context)
+    except (ssl.SSLError, ValueError, AttributeError) as e:
+        logger.critical("Invalid TLS settings: %s", e)
         sys.exit(1)
+    return context
+
+# بدء الخادم (خيط لكل اتصال)
+def start_server(host=HOST, port=PORT, context=None, reuse_port=False):
+    if context is None:
+        context = create_ssl_context()
+    init_pipeline()
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0) as sock:
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         try:
-            sock.bind((HOST, PORT))
-            print(f"[DEBUG] Socket bound to {HOST}:{PORT}", file=sys.stderr)
+            sock.bind((host, port))
+            logger.debug("Socket bound to %s:%s", host, port)
         except OSError as e:
-            print(f"[FATAL] Failed to bind socket to {HOST}:{PORT}: {e}", file=sys.stderr)
+            logger.critical("Failed to bind socket to %s:%s: %s", host, port, e)
             sys.exit(1)
 
         sock.listen(5)
-        print(f"[*] Forensic Control Center listening on {HOST}:{PORT}...")
+        logger.info("Forensic Control Center listening on %s:%s...", host, port)
 
         while True:
             client_sock, addr = sock.accept()
-            print(f"[DEBUG] Accepted connection from {addr}", file=sys.stderr)
+            tls.CONNECTIONS_ACCEPTED.inc()
             connstream = None
             try:
+                started = time.perf_counter()
                 connstream = context.wrap_socket(client_sock, server_side=True)
-                print(f"[DEBUG] SSL handshake successful with {addr}", file=sys.stderr)
+                tls.record_handshake(connstream, time.perf_counter() - started)
+                log.sampled_debug(logger, "SSL handshake successful with %s (resumed=%s)",
+                                  addr, connstream.session_reused)
                 threading.Thread(target=handle_client, args=(connstream, addr)).start()
             except ssl.SSLError as e:
-                print(f"[!] SSL handshake failed with {addr}: {e}", file=sys.stderr)
+                tls.record_failed_handshake()
+                logger.warning("SSL handshake failed with %s: %s", addr, e)
                 client_sock.close()
             except Exception as e:
-                print(f"[!] Unexpected error during SSL handshake with {addr}: {e}", file=sys.stderr)
+                tls.record_failed_handshake()
+                logger.error("Unexpected error during SSL handshake with %s: %s", addr, e)
                 client_sock.close()
 
+# بدء الخادم بمحرك asyncio
+def start_async_server(host=HOST, port=PORT, context=None, reuse_port=False):
+    from async_server import run_async_server
+
+    if context is None:
+        context = create_ssl_context()
+    init_pipeline()
+    run_async_server(context, process_request, host=host, port=port,
+                     max_connections=MAX_CONNECTIONS, reuse_port=reuse_port, paths=ingest.PATHS)
+
+# تشغيل الخادم في العملية الحالية حسب الوضع المختار
+def run_server(mode=SERVER_MODE, host=HOST, port=PORT, context=None, reuse_port=False):
+    if mode == "async":
+        start_async_server(host, port, context, reuse_port=reuse_port)
+    elif mode == "threaded":
+        start_server(host, port, context, reuse_port=reuse_port)
+    else:
+        logger.critical("Unknown FPM_SERVER_MODE: %r (expected 'threaded' or 'async')", mode)
+        sys.exit(1)
+
+# وضع العمليات المتعددة: مشرف + N عمليات تتشارك المنفذ عبر SO_REUSEPORT
+def start_prefork(workers=WORKERS, mode=SERVER_MODE, host=HOST, port=PORT, context=None):
+    from prefork import Supervisor
+
+    # The TLS context is built once, before forking, so every worker shares it.
+    if context is None:
+        context = create_ssl_context()
+
+    def worker_main(worker_id):
+        init_pipeline(worker_id)
+        run_server(mode, host, port, context, reuse_port=True)
+
+    Supervisor(worker_main, workers).run()
+
 if __name__ == "__main__":
-    start_server()
+    # FPM_LOG_LEVEL / FPM_LOG_FORMAT / FPM_LOG_SAMPLE_EVERY (log.py)
+    log.setup()
+    if WORKERS > 1:
+        start_prefork()
+    else:
+        run_server()
@@ -0,0 +1,353 @@
+# spool.py
+"""
+Write-ahead spool for received events (replaces the single logs/traffic_log.jsonl).
+
+SpoolWriter serializes records in the caller's thread and hands them to one
+writer thread, which group-commits everything pending in a single write(),
+fsyncs according to the configured policy, rotates segments by size or age,
+optionally gzips closed segments and keeps at most max_segments of them.
+
+SpoolReader iterates the records of the spool (plain or gzipped segments, in
+order) and can replay them into Elasticsearch after an outage:
+
+    python spool.py replay --dir logs/spool --es http://elasticsearch:9200
+"""
+import argparse
+import gzip
+import json
+import os
+import shutil
+import threading
+import time
+
+import log
+from ingest import json_dumps
+
+logger = log.get_logger("spool")
+
+SEGMENT_PREFIX = "traffic_log-"
+SEGMENT_SUFFIX = ".jsonl"
+COMPRESSED_SUFFIX = ".jsonl.gz"
+
+
+def segment_name(sequence):
+    return f"{SEGMENT_PREFIX}{sequence:08d}{SEGMENT_SUFFIX}"
+
+
+def segment_sequence(filename):
+    """Returns the sequence number of a segment file name, or None if it is not one."""
+    if not filename.startswith(SEGMENT_PREFIX):
+        return None
+    stem = filename[len(SEGMENT_PREFIX):]
+    for suffix in (COMPRESSED_SUFFIX, SEGMENT_SUFFIX):
+        if stem.endswith(suffix):
+            stem = stem[:-len(suffix)]
+            break
+    else:
+        return None
+    return int(stem) if stem.isdigit() else None
+
+
+def list_segments(directory):
+    """Returns [(sequence, path)] for every segment in the directory, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    segments = {}
+    for filename in os.listdir(directory):
+        sequence = segment_sequence(filename)
+        if sequence is None:
+            continue
+        # If both forms exist (crash during compression), the plain file is authoritative.
+        if sequence not in segments or filename.endswith(SEGMENT_SUFFIX):
+            segments[sequence] = os.path.join(directory, filename)
+    return sorted(segments.items())
+
+
+class SpoolWriter:
+    """
+    Appends JSON records to rotating segment files from a single writer thread.
+
+    Args:
+        directory (str): Where segments are kept.
+        commit_interval (float): Longest a record waits in memory before being written.
+        commit_bytes (int): Write early once this many bytes are pending.
+        fsync_interval (float|None): None never fsyncs (page cache only), 0 fsyncs
+                                     every group commit, N fsyncs at most every N seconds.
+        max_segment_bytes (int): Rotate once the active segment reaches this size.
+        max_segment_age (float): Rotate once the active segment is this many seconds old.
+        compress (bool): Gzip segments after they are closed.
+        max_segments (int|None): Delete the oldest closed segments beyond this count.
+    """
+
+    def __init__(self, directory, commit_interval=0.05, commit_bytes=256 * 1024, fsync_interval=1.0,
+                 max_segment_bytes=64 * 1024 * 1024, max_segment_age=3600.0, compress=True,
+                 max_segments=48):
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self.commit_bytes = commit_bytes
+        self.fsync_interval = fsync_interval
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_age = max_segment_age
+        self.compress = compress
+        self.max_segments = max_segments
+
+        self._pending = []
+        self._pending_bytes = 0
+        self._appended = 0      # sequence number of the last appended record
+        self._committed = 0     # sequence number of the last record handed to the OS
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = None
+
+        self._file = None
+        self._sequence = 0
+        self._segment_bytes = 0
+        self._segment_opened = 0.0
+        self._last_fsync = time.monotonic()
+
+    def start(self):
+        """Opens a fresh segment and starts the writer thread (idempotent)."""
+        with self._cond:
+            if self._thread is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            existing = list_segments(self.directory)
+            self._sequence = existing[-1][0] if existing else 0
+            self._open_next_segment()
+            # Segments left plain by a previous run are closed now.
+            for _, path in existing:
+                if path.endswith(SEGMENT_SUFFIX):
+                    if os.path.getsize(path) == 0:
+                        os.remove(path)
+                    else:
+                        self._segment_closed(path)
+            self._thread = threading.Thread(target=self._run, name="fpm-spool-writer", daemon=True)
+            self._thread.start()
+
+    @property
+    def active_sequence(self):
+        """Sequence number of the segment currently being written."""
+        return self._sequence
+
+    def append(self, record, wait=False):
+        """
+        Queues one record (a dict or already-serialized JSON bytes) for the spool.
+
+        Args:
+            wait (bool): Block until the group commit containing the record has
+                         been written (and fsynced, if fsync_interval is 0).
+        """
+        if isinstance(record, bytes):
+            line = record.rstrip(b"\n") + b"\n"
+        else:
+            line = json_dumps(record) + b"\n"
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("spool is closed")
+            self._pending.append(line)
+            self._pending_bytes += len(line)
+            self._appended += 1
+            ticket = self._appended
+            if self._pending_bytes >= self.commit_bytes:
+                self._cond.notify_all()
+            if wait:
+                self._cond.wait_for(lambda: self._committed >= ticket or self._closed)
+
+    def close(self, timeout=10.0):
+        """Writes out pending records, closes the active segment and stops the thread."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or self._pending_bytes >= self.commit_bytes,
+                                    self.commit_interval)
+                lines, self._pending = self._pending, []
+                self._pending_bytes = 0
+                ticket = self._appended
+                closing = self._closed
+            try:
+                if lines:
+                    self._commit(lines)
+                if self._rotation_due():
+                    self._rotate()
+            except OSError as e:
+                logger.error("Spool write failed in %s: %s", self.directory, e)
+            with self._cond:
+                self._committed = ticket
+                self._cond.notify_all()
+            if closing:
+                self._close_active_segment()
+                return
+
+    def _commit(self, lines):
+        data = b"".join(lines)
+        self._file.write(data)
+        self._file.flush()
+        self._segment_bytes += len(data)
+        if self.fsync_interval is not None:
+            now = time.monotonic()
+            if now - self._last_fsync >= self.fsync_interval:
+                os.fsync(self._file.fileno())
+                self._last_fsync = now
+
+    def _rotation_due(self):
+        if self._segment_bytes == 0:
+            return False
+        return (self._segment_bytes >= self.max_segment_bytes or
+                time.monotonic() - self._segment_opened >= self.max_segment_age)
+
+    def _open_next_segment(self):
+        self._sequence += 1
+        path = os.path.join(self.directory, segment_name(self._sequence))
+        self._file = open(path, "ab", buffering=0)
+        self._segment_bytes = 0
+        self._segment_opened = time.monotonic()
+
+    def _close_active_segment(self):
+        if self._file is None:
+            return
+        path = self._file.name
+        if self.fsync_interval is not None:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        if os.path.getsize(path) == 0:
+            os.remove(path)
+        else:
+            self._segment_closed(path)
+
+    def _rotate(self):
+        self._close_active_segment()
+        self._open_next_segment()
+        self._enforce_retention()
+
+    def _segment_closed(self, path):
+        if self.compress:
+            threading.Thread(target=compress_segment, args=(path,), daemon=True).start()
+
+    def _enforce_retention(self):
+        if not self.max_segments:
+            return
+        closed = [item for item in list_segments(self.directory) if item[0] != self._sequence]
+        for _, path in closed[:max(0, len(closed) - self.max_segments)]:
+            try:
+                os.remove(path)
+                logger.info("Spool retention removed %s", path)
+            except OSError:
+                pass
+
+
+def compress_segment(path):
+    """Gzips a closed segment next to itself, then removes the plain file."""
+    target = path[:-len(SEGMENT_SUFFIX)] + COMPRESSED_SUFFIX
+    temporary = target + ".tmp"
+    try:
+        with open(path, "rb") as source, gzip.open(temporary, "wb", compresslevel=6) as sink:
+            shutil.copyfileobj(source, sink, 1024 * 1024)
+        os.replace(temporary, target)
+        os.remove(path)
+    except OSError as e:
+        logger.error("Failed to compress spool segment %s: %s", path, e)
+
+
+class SpoolReader:
+    """
+    Reads records back out of a spool directory, oldest segment first.
+
+    Args:
+        directory (str): Spool directory written by SpoolWriter.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def segments(self, start=None, end=None):
+        """Returns [(sequence, path)] restricted to start <= sequence <= end."""
+        return [(seq, path) for seq, path in list_segments(self.directory)
+                if (start is None or seq >= start) and (end is None or seq <= end)]
+
+    def read_segment(self, path):
+        """Yields the records of one segment, skipping a torn last line."""
+        opener = gzip.open if path.endswith(COMPRESSED_SUFFIX) else open
+        with opener(path, "rb") as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning("Skipping unreadable record %s:%d", path, number)
+
+    def count_records(self, start=None, end=None):
+        """Number of complete records in the selected segments, counted by line without decoding them."""
+        count = 0
+        for _, path in self.segments(start, end):
+            opener = gzip.open if path.endswith(COMPRESSED_SUFFIX) else open
+            with opener(path, "rb") as f:
+                count += sum(1 for line in f if line.endswith(b"\n") and line.strip())
+        return count
+
+    def records(self, start=None, end=None):
+        """Yields (sequence, record) for every record in the selected segments."""
+        for sequence, path in self.segments(start, end):
+            for record in self.read_segment(path):
+                yield sequence, record
+
+    def replay(self, indexer, start=None, end=None):
+        """
+        Feeds spooled records into a BulkIndexer (see es_bulk.py).
+
+        Returns:
+            int: Number of records handed to the indexer.
+        """
+        count = 0
+        for _, record in self.records(start, end):
+            indexer.add(record)
+            count += 1
+        return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or replay the FPM event spool")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("list", help="list segments")
+    p.add_argument("--dir", nargs="+", default=["logs/spool"],
+                   help="spool directories (one per worker in pre-fork mode)")
+    p = sub.add_parser("replay", help="re-index segments into Elasticsearch")
+    p.add_argument("--dir", nargs="+", default=["logs/spool"],
+                   help="spool directories (one per worker in pre-fork mode)")
+    p.add_argument("--es", default="http://elasticsearch:9200")
+    p.add_argument("--index", default="forensic-logs")
+    p.add_argument("--from-segment", type=int, default=None)
+    p.add_argument("--to-segment", type=int, default=None)
+    args = parser.parse_args()
+
+    readers = [SpoolReader(directory) for directory in args.dir]
+    if args.command == "list":
+        for reader in readers:
+            for sequence, path in reader.segments():
+                print(f"{sequence:>8}  {os.path.getsize(path):>12}  {path}")
+        return
+
+    from elasticsearch import Elasticsearch
+    from dedup import document_id
+    from es_bulk import BulkIndexer
+
+    # Same _id as at ingest time, so replaying events that did reach Elasticsearch overwrites them.
+    indexer = BulkIndexer(Elasticsearch(args.es), index=args.index, id_func=document_id)
+    indexer.start()
+    count = sum(reader.replay(indexer, args.from_segment, args.to_segment) for reader in readers)
+    indexer.close(timeout=None)
+    print(f"[✓] Replayed {count} spooled events into {args.index}.")
+
+
+if __name__ == "__main__":
+    main()
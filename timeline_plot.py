@@ -47,9 +47,9 @@ def generate_timeline_plot(save_path="static/timeline.png"):
         with open(LINKED_ALERTS_FILE, 'r') as file:
             for line in file:
                 try:
-                    alert = json.loads(line.strip())
-                    ts_str = alert.get("timestamp")
-                    entry = alert.get("entry", {})
+                    # One record per correlated incident (see correlation.py); plotted at its first event
+                    incident = json.loads(line.strip())
+                    ts_str = incident.get("start", incident.get("timestamp"))
                     
                     if ts_str:
                         # Parse timestamp as UTC, then convert to target timezone
@@ -70,13 +70,15 @@ def generate_timeline_plot(save_path="static/timeline.png"):
                             print(f"[!] Invalid timestamp format encountered: {ts_str} - {ve}", file=sys.stderr)
                             continue # Skip this entry if timestamp parsing fails
                         
-                        # Construct a more informative label
-                        alert_reason = alert.get('alert_reason', entry.get('alert_reason', 'N/A'))
-                        src_ip = entry.get('src_ip', 'N/A')
-                        dst_ip = entry.get('dst_ip', 'N/A')
-                        dst_port = entry.get('dst_port', 'N/A')
+                        # Construct a more informative label (the destination is the incident's most common one)
+                        alert_reason = incident.get('alert_reason', 'N/A')
+                        src_ip = incident.get('src_ip', 'N/A')
+                        dst_ip = incident.get('dst_ip', 'N/A')
+                        dst_port = incident.get('dst_port', 'N/A')
+                        event_count = incident.get('event_count', 'N/A')
+                        duration = incident.get('duration_seconds', 0)
                         
-                        labels.append(f"Src: {src_ip}\nDst: {dst_ip}:{dst_port}\nAlert: {alert_reason}")
+                        labels.append(f"Src: {src_ip}\nDst: {dst_ip}:{dst_port}\nAlert: {alert_reason}\nEvents: {event_count} over {duration:.0f}s")
                 except Exception as e:
                     print(f"[!] Failed to parse line in {LINKED_ALERTS_FILE}: {line.strip()} - {e}", file=sys.stderr)
                     continue
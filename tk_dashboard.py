@@ -10,8 +10,10 @@ import json
 import requests
 import csv
 import io
-from datetime import datetime, timedelta
+from datetime import datetime
 from PIL import ImageTk, Image
+from correlation import cluster_incidents
+from es_scan import SORT_RESOLUTION_SECONDS, get_documents, sliced_scan, time_range_query
 from timeline_plot import generate_timeline_plot # This line imports the function from the new timeline_plot.py file
 
 # --- Configuration ---
@@ -20,6 +22,8 @@ ES_INDEX = "forensic-logs"
 LINKED_ALERTS_FILE = "logs/linked_alerts.jsonl"
 EXPORT_FOLDER = "reports"
 TIMELINE_IMAGE_PATH = "static/timeline.png"
+CORRELATION_HOURS = 24 # "Correlate Incidents" links the events of the last 24 hours
+MAX_EXPANDED_MEMBERS = 1000 # أحداث الحادث اللي تنجلب عند فتحه (double-click)
 REFRESH_INTERVAL_MS = 5000 # تحديث كل 5 ثوانٍ (5000 ميلي ثانية)
 
 # Ensure necessary directories exist
@@ -88,6 +92,7 @@ class FPMDashboardGUI:
         self.style.map("Treeview.Heading",
                        background=[('active', TABLE_HEADER_BG)])
 
+        self.incidents = {} # cluster_id -> incident record of the linked incidents shown
         self.create_widgets()
         self.load_alerts()
         self.root.after(REFRESH_INTERVAL_MS, self.auto_refresh) # بدء التحديث التلقائي
@@ -143,6 +148,7 @@ class FPMDashboardGUI:
         self.tree.column("alert_reason", width=250, anchor="w")
 
         self.tree.pack(expand=True, fill="both", padx=10, pady=10)
+        self.tree.bind("<Double-1>", lambda event: self.on_tree_double_click())
 
         scrollbar = ttk.Scrollbar(self.tree, orient="vertical", command=self.tree.yview)
         self.tree.configure(yscrollcommand=scrollbar.set)
@@ -191,42 +197,21 @@ class FPMDashboardGUI:
             return
 
         try:
-            res = es.search(index=ES_INDEX, body={"query": {"match_all": {}}}, size=100)
-            entries = [hit["_source"] for hit in res["hits"]["hits"]]
-
-            linked_alerts = []
-            for i, entry in enumerate(entries):
-                try:
-                    entry_timestamp = datetime.fromisoformat(entry["timestamp"].replace('Z', '+00:00'))
-                except ValueError:
-                    print(f"Warning: Invalid timestamp format for entry: {entry.get('timestamp')}")
-                    continue
-
-                for j in range(i + 1, len(entries)):
-                    other = entries[j]
-                    try:
-                        other_timestamp = datetime.fromisoformat(other["timestamp"].replace('Z', '+00:00'))
-                    except ValueError:
-                        print(f"Warning: Invalid timestamp format for other entry: {other.get('timestamp')}")
-                        continue
+            # كل السجلات في المدى الزمني (PIT slices بالتوازي، بترتيب الوقت)
+            start = int((datetime.now().timestamp() - CORRELATION_HOURS * 3600) * 1000000)
+            hits = sliced_scan(es, ES_INDEX, time_range_query(start))
 
-                    if (
-                        entry.get("src_ip") == other.get("src_ip") and
-                        abs(entry_timestamp - other_timestamp) <= timedelta(minutes=5)
-                    ):
-                        linked_alert = {
-                            "timestamp": datetime.now().isoformat() + "Z",
-                            "entry": entry,
-                            "linked_with": other,
-                            "alert_reason": "Correlated Incident"
-                        }
-                        linked_alerts.append(linked_alert)
-            
+            # سجل واحد لكل حادث (مجموعة أحداث مترابطة)، بدل سطر لكل زوج
+            incidents = 0
+            skipped = []
             with open(LINKED_ALERTS_FILE, "w") as f:
-                for alert in linked_alerts:
-                    f.write(json.dumps(alert) + "\n")
+                for incident in cluster_incidents(hits, index=ES_INDEX, skipped=skipped, lateness=SORT_RESOLUTION_SECONDS):
+                    f.write(json.dumps(incident) + "\n")
+                    incidents += 1
+            for entry in skipped:
+                print(f"Warning: Invalid timestamp format for entry: {entry.get('timestamp')}")
             
-            messagebox.showinfo("Success", f"✅ {len(linked_alerts)} incidents correlated and saved.")
+            messagebox.showinfo("Success", f"✅ {incidents} incidents correlated and saved.")
             self.load_linked_incidents()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to perform correlation:\n{e}")
@@ -380,31 +365,30 @@ class FPMDashboardGUI:
         if os.path.exists(LINKED_ALERTS_FILE):
             try:
                 with open(LINKED_ALERTS_FILE, 'r') as file:
-                    linked_alerts = []
+                    incidents = []
                     for line in file:
                         try:
-                            alert = json.loads(line.strip())
-                            entry = alert.get("entry", {})
-                            linked_alerts.append({
-                                "timestamp": alert.get("timestamp"),
-                                "src_ip": entry.get("src_ip"),
-                                "dst_ip": entry.get("dst_ip"),
-                                "dst_port": entry.get("dst_port"),
-                                "alert_reason": "🔗 Linked Incident"
-                            })
+                            incidents.append(json.loads(line.strip()))
                         except Exception as e:
                             print(f"Error parsing linked alert: {e} - Line: {line.strip()}")
                             continue
                 
-                for alert in linked_alerts:
-                    self.tree.insert("", "end", values=(
-                        alert.get("timestamp"),
-                        alert.get("src_ip"),
-                        alert.get("dst_ip"),
-                        alert.get("dst_port"),
-                        alert.get("alert_reason")
+                # صف واحد لكل حادث؛ double-click يفتح أحداثه
+                self.incidents = {}
+                for incident in incidents:
+                    cluster_id = incident.get("cluster_id")
+                    if not cluster_id or cluster_id in self.incidents:
+                        continue
+                    self.incidents[cluster_id] = incident
+                    self.tree.insert("", "end", iid=cluster_id, values=(
+                        incident.get("start"),
+                        incident.get("src_ip"),
+                        incident.get("dst_ip"),
+                        incident.get("dst_port"),
+                        f"🔗 {incident.get('event_count')} events, {incident.get('link_count')} links over {incident.get('duration_seconds', 0):.0f}s"
+                        + (f" (part {incident['part']})" if incident.get("part", 1) > 1 else "")
                     ))
-                self.status_label.config(text=f"{len(linked_alerts)} linked incidents loaded.", foreground=TEXT_COLOR)
+                self.status_label.config(text=f"{len(self.incidents)} linked incidents loaded (double-click to expand).", foreground=TEXT_COLOR)
             except Exception as e:
                 self.status_label.config(text=f"Failed to load linked incidents: {e}", foreground=ERROR_COLOR)
                 messagebox.showerror("Error", f"Failed to load linked incidents:\n{e}")
@@ -412,6 +396,38 @@ class FPMDashboardGUI:
             self.status_label.config(text=f"Warning: {LINKED_ALERTS_FILE} not found.", foreground=ERROR_COLOR)
             messagebox.showwarning("Warning", f"Linked incidents file not found: {LINKED_ALERTS_FILE}\nPlease run 'Correlate Incidents' first.")
 
+    def on_tree_double_click(self):
+        selection = self.tree.selection()
+        if selection and selection[0] in self.incidents:
+            threading.Thread(target=self.expand_incident, args=(selection[0],)).start()
+
+    def expand_incident(self, cluster_id):
+        """Replaces the incident rows with the incident's member events, fetched from Elasticsearch by id."""
+        incident = self.incidents.get(cluster_id)
+        if incident is None or not es:
+            return
+        try:
+            ids = incident.get("member_ids", [])[:MAX_EXPANDED_MEMBERS]
+            members = list(get_documents(es, incident.get("index", ES_INDEX), ids))
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to expand incident:\n{e}")
+            return
+
+        self.tree.delete(*self.tree.get_children())
+        for hit in members:
+            doc = hit["_source"]
+            alert_reason = "(Live Packet)"
+            if "alerts" in doc and doc["alerts"]:
+                alert_reason = doc["alerts"][0]
+            self.tree.insert("", "end", values=(
+                doc.get("timestamp"),
+                doc.get("src_ip"),
+                doc.get("dst_ip"),
+                doc.get("dst_port"),
+                doc.get("alert_reason", alert_reason)
+            ))
+        self.status_label.config(text=f"Incident {cluster_id}: {len(members)} of {incident.get('event_count')} events.", foreground=TEXT_COLOR)
+
 
 if __name__ == '__main__':
     root = tk.Tk()
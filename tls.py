@@ -0,0 +1,54 @@
+# tls.py
+"""
+TLS tuning and connection/handshake accounting for the FPM server.
+
+Session resumption is what keeps agent reconnects cheap: the server issues
+TLS 1.3 session tickets (and TLS 1.2 tickets), and an agent that presents one
+on reconnect skips the certificate signature and key exchange. The ticket keys
+live in the SSLContext, so the context is built once before pre-fork workers
+are started and every worker can resume sessions issued by the others.
+"""
+import os
+import ssl
+
+import metrics
+
+# ECDHE only, AEAD only; TLS 1.3 suites are OpenSSL's defaults.
+TLS_CIPHERS = os.environ.get("FPM_TLS_CIPHERS", "ECDHE+AESGCM:ECDHE+CHACHA20")
+# "" keeps OpenSSL's default group list (X25519 first); e.g. "prime256v1" pins one curve.
+TLS_ECDH_CURVE = os.environ.get("FPM_TLS_ECDH_CURVE", "")
+# Tickets sent after each full TLS 1.3 handshake; agents only ever need one.
+TLS_NUM_TICKETS = int(os.environ.get("FPM_TLS_NUM_TICKETS", "1"))
+TLS_MIN_VERSION = os.environ.get("FPM_TLS_MIN_VERSION", "TLSv1_2")
+
+CONNECTIONS_ACCEPTED = metrics.counter(
+    "fpm_connections_accepted_total", "TCP connections accepted on the TLS listener")
+HANDSHAKES = metrics.counter(
+    "fpm_tls_handshakes_total", "TLS handshakes by outcome (full, resumed, failed)",
+    labelnames=("kind",))
+HANDSHAKE_SECONDS = metrics.histogram(
+    "fpm_tls_handshake_seconds", "Time to complete a TLS handshake", labelnames=("kind",))
+
+
+def tune_server_context(context):
+    """Applies the FPM cipher/curve/ticket settings to a server-side SSLContext."""
+    context.minimum_version = getattr(ssl.TLSVersion, TLS_MIN_VERSION)
+    context.set_ciphers(TLS_CIPHERS)
+    if TLS_ECDH_CURVE:
+        context.set_ecdh_curve(TLS_ECDH_CURVE)
+    context.options |= ssl.OP_NO_COMPRESSION | ssl.OP_NO_RENEGOTIATION | ssl.OP_CIPHER_SERVER_PREFERENCE
+    # Session tickets must stay enabled for resumption.
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = TLS_NUM_TICKETS
+    return context
+
+
+def record_handshake(ssl_object, seconds):
+    """Counts a completed handshake as full or resumed and records how long it took."""
+    kind = "resumed" if ssl_object.session_reused else "full"
+    HANDSHAKES.inc(kind=kind)
+    HANDSHAKE_SECONDS.observe(seconds, kind=kind)
+
+
+def record_failed_handshake():
+    HANDSHAKES.inc(kind="failed")